@@ -1,6 +1,9 @@
 # add_dummy_data.py
+import argparse
+import random
+import bulk_io
 import db
-from datetime import date
+from datetime import date, timedelta
 
 # --- 設定 ---
 user_id_to_add = 1 # データを入れたいユーザーのID (testuser の ID)
@@ -32,38 +35,90 @@ dummy_entries = [
         "emotions": {'joy': 60, 'anger': 20, 'sadness': 5, 'anxiety': 5, 'relief': 10}
     },
 ]
+
+# 合成データ用の会話の材料
+SYNTHETIC_TOPICS = [
+    ("新しいカフェに行きました", "コーヒーが美味しくて嬉しかったです"),
+    ("仕事で少しミスをしました", "上司に謝って、なんとか解決しました"),
+    ("友達と久しぶりに電話しました", "昔の話で盛り上がって楽しかったです"),
+    ("一日中雨でした", "家で本を読んでのんびり過ごしました"),
+    ("週末の予定がまだ決まりません", "少し焦っていますが、ゆっくり考えます"),
+    ("ジムで運動しました", "体は疲れましたが、気分はすっきりしています"),
+    ("電車が遅れて会議に遅刻しました", "イライラしましたが、仕方ないと割り切りました"),
+]
 # --- 設定ここまで ---
 
-print("--- ダミーデータ追加開始 ---")
-added_count = 0
-skipped_count = 0
+def generate_synthetic_entries(years, end_date=None, seed=0, skip_rate=0.1):
+    """
+    end_date から遡って years 年分の日記データを日付の昇順で生成する。
+    毎日ではなく、skip_rate の割合で書かない日を作る。同じ seed なら同じデータになる。
+    """
+    rng = random.Random(seed)
+    end_date = end_date or date.today()
+    start_date = end_date - timedelta(days=int(365 * years))
+    # 感情はランダムウォークさせて、グラフ上で現実的な推移にする
+    levels = {'joy': 50, 'anger': 10, 'sadness': 20, 'anxiety': 20, 'relief': 30}
+    current = start_date
+    while current <= end_date:
+        if rng.random() >= skip_rate:
+            topic, detail = rng.choice(SYNTHETIC_TOPICS)
+            for key in levels:
+                levels[key] = min(100, max(0, levels[key] + rng.randint(-12, 12)))
+            yield {
+                "entry_date": current,
+                "chat_log": (
+                    "AI: こんにちは！今日はどんな一日でしたか？\n"
+                    f"あなた: {topic}。\n"
+                    "AI: そうだったんですね。どう感じましたか？\n"
+                    f"あなた: {detail}。"
+                ),
+                "summary": f"{topic}。{detail}。",
+                "emotions": dict(levels),
+            }
+        current += timedelta(days=1)
 
-for entry_data in dummy_entries:
-    entry_date_str = entry_data["entry_date"].isoformat()
-    print(f"{entry_date_str} のデータを追加試行...")
+def insert_entries_batch(user_id, entries):
+    """日記データをまとめて保存する (同じ日付の日記は読み飛ばす)。保存した件数を返す。"""
+    records = ({**entry, "user_id": user_id} for entry in entries)
+    return bulk_io.import_entries(records)['inserted']
 
-    # 同じユーザーIDと日付のエントリが既に存在しないか簡易チェック
-    # (厳密ではないが、重複エラーを防ぐため)
-    existing_entries = db.get_entry_list_by_user(user_id_to_add)
-    is_duplicate = any(e['entry_date'] == entry_date_str for e in existing_entries)
+def populate_synthetic_users(num_users, years, password_hash, seed=0, username_prefix="synthetic_user"):
+    """
+    num_users 人のユーザーを作成し、それぞれに years 年分の日記を追加する。
+    bcrypt は遅いため、password_hash は呼び出し側で一度だけ計算したものを全員で共有する。
+    Returns:
+        list: 作成した (または既存の) ユーザーIDのリスト。
+    """
+    user_ids = []
+    for n in range(num_users):
+        username = f"{username_prefix}{n + 1}"
+        created = db.create_user(username, password_hash)
+        user = db.get_user_by_username(username)
+        user_ids.append(user['id'])
+        if not created:
+            print(f"{username} は既に存在するため、日記の追加をスキップします。")
+            continue
+        count = insert_entries_batch(user['id'], generate_synthetic_entries(years, seed=seed + n))
+        print(f"{username} (ID: {user['id']}) に {count} 件の日記を追加しました。")
+    return user_ids
 
-    if not is_duplicate:
-        entry_id = db.create_entry_and_emotions(
-            user_id=user_id_to_add,
-            entry_date=entry_data["entry_date"],
-            chat_log=entry_data["chat_log"],
-            summary=entry_data["summary"],
-            emotions=entry_data["emotions"]
-        )
-        if entry_id:
-            print(f"  -> 成功 (Entry ID: {entry_id})")
-            added_count += 1
-        else:
-            print(f"  -> 失敗 (DBエラー)")
-            skipped_count += 1
-    else:
-        print(f"  -> スキップ (同じ日付のエントリが存在)")
-        skipped_count += 1
+def add_dummy_entries():
+    """dummy_entries を user_id_to_add のユーザーに追加する (同じ日付のエントリはスキップ)"""
+    print("--- ダミーデータ追加開始 ---")
+    added_count = insert_entries_batch(user_id_to_add, dummy_entries)
+    print("--- ダミーデータ追加完了 ---")
+    print(f"追加: {added_count}件, スキップ: {len(dummy_entries) - added_count}件")
 
-print("--- ダミーデータ追加完了 ---")
-print(f"追加: {added_count}件, スキップ/失敗: {skipped_count}件") 
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ダミーの日記データを追加する")
+    parser.add_argument("--users", type=int, default=0, help="合成データを作るユーザー数 (省略時は dummy_entries を testuser に追加)")
+    parser.add_argument("--years", type=float, default=1, help="ユーザーごとに生成する日記の年数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    parser.add_argument("--password", default="password123", help="合成ユーザーのパスワード")
+    args = parser.parse_args()
+
+    if args.users > 0:
+        import auth
+        populate_synthetic_users(args.users, args.years, auth.hash_password(args.password), seed=args.seed)
+    else:
+        add_dummy_entries()
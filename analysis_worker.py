@@ -0,0 +1,163 @@
+# analysis_worker.py
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import db
+import gemini_chat
+
+logger = logging.getLogger(__name__)
+
+# --- 設定 ---
+MAX_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "2")) # 同時に実行する分析の数
+MAX_ATTEMPTS = int(os.getenv("ANALYSIS_MAX_ATTEMPTS", "5")) # これを超えたら 'failed' にする
+BACKOFF_BASE = 2.0 # リトライ間隔の基準 (秒)。2, 4, 8, ... と倍々に伸ばす
+BACKOFF_MAX = 60.0 # リトライ間隔の上限 (秒)
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = {} # エントリーID -> Future (同じエントリーを二重に分析しないため。再試行待ちの間も残し、成功・断念で完了する)
+_retry_timers = {} # エントリーID -> 再試行待ちの threading.Timer
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="analysis")
+        return _executor
+
+
+def backoff_delay(attempts):
+    """attempts 回失敗した後の待ち時間 (秒) を返す。同時に失敗したジョブが揃って再試行しないよう揺らぎを入れる。"""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+    return random.uniform(delay / 2, delay)
+
+
+def _finish(entry_id):
+    """エントリーの分析を終える (成功・断念・予期せぬエラー)"""
+    with _executor_lock:
+        _retry_timers.pop(entry_id, None)
+        job = _in_flight.pop(entry_id, None)
+    if job is not None and not job.done():
+        job.set_result(None)
+
+
+def _schedule_retry(entry_id, delay):
+    """
+    delay 秒後にエントリーをワーカーに登録し直す。待っている間はワーカーを占有しない
+    (ワーカーは MAX_WORKERS 個しかなく、失敗し続けるエントリーが他のユーザーの分析を止めないように)。
+    Returns:
+        bool: 登録したら True。停止済みなら False。
+    """
+    timer = threading.Timer(delay, _retry, (entry_id,))
+    timer.daemon = True
+    with _executor_lock:
+        if entry_id not in _in_flight:
+            return False # shutdown 済み
+        _retry_timers[entry_id] = timer
+    timer.start()
+    return True
+
+
+def _retry(entry_id):
+    with _executor_lock:
+        _retry_timers.pop(entry_id, None)
+        if entry_id not in _in_flight:
+            return # 待っている間に shutdown した (DB には 'pending' のまま残る)
+    try:
+        _get_executor().submit(_run, entry_id)
+    except RuntimeError:
+        _finish(entry_id) # 終了処理中
+
+
+def _run(entry_id):
+    """1つのエントリーを1回分析する。失敗したらバックオフ後に登録し直し、MAX_ATTEMPTS 回まで再試行する"""
+    delay = None
+    try:
+        entry = db.get_entry_for_analysis(entry_id)
+        if not entry or entry['analysis_status'] != db.ANALYSIS_PENDING:
+            return # 削除済み、または既に分析済み
+
+        summary, emotions = gemini_chat.analyze_diary_entry(entry['chat_log'])
+        if summary and emotions and db.complete_entry_analysis(entry_id, summary, emotions):
+            return
+
+        give_up = entry['analysis_attempts'] + 1 >= MAX_ATTEMPTS
+        attempts = db.record_analysis_failure(entry_id, "AI分析または保存に失敗しました。", give_up=give_up)
+        if give_up or attempts is None:
+            logger.error(f"エントリーID {entry_id} の分析を {MAX_ATTEMPTS} 回試行しましたが失敗しました。")
+            return
+        delay = backoff_delay(attempts)
+        logger.warning(f"エントリーID {entry_id} の分析に失敗しました。{delay:.1f}秒後に再試行します ({attempts}/{MAX_ATTEMPTS})。")
+    except Exception as e:
+        delay = None
+        logger.exception(f"エントリーID {entry_id} の分析中に予期せぬエラーが発生しました: {e}")
+    finally:
+        if delay is None or not _schedule_retry(entry_id, delay):
+            _finish(entry_id)
+
+
+def submit(entry_id):
+    """エントリーの分析をバックグラウンドに登録する (既に実行中・再試行待ちなら何もしない)"""
+    with _executor_lock:
+        if entry_id in _in_flight:
+            return _in_flight[entry_id]
+        job = _in_flight[entry_id] = Future()
+    try:
+        _get_executor().submit(_run, entry_id)
+    except Exception:
+        _finish(entry_id)
+        raise
+    return job
+
+
+def resume_pending():
+    """
+    前回の起動で終わらなかった分析待ちのエントリーを全て登録し直す。
+    Returns:
+        int: 登録したエントリー数。
+    """
+    entry_ids = db.get_pending_entry_ids()
+    for entry_id in entry_ids:
+        submit(entry_id)
+    if entry_ids:
+        logger.info(f"分析待ちのエントリー {len(entry_ids)} 件の分析を再開しました。")
+    return len(entry_ids)
+
+
+def wait_idle(timeout=None):
+    """実行中の分析が全て終わるまで待つ (ベンチマークや終了処理用)。時間内に終われば True。"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        with _executor_lock:
+            futures = list(_in_flight.values())
+        if not futures:
+            return True
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            return False
+        try:
+            futures[0].result(timeout=remaining)
+        except FutureTimeoutError:
+            return False
+
+
+def shutdown(wait=False):
+    """ワーカーを停止する。未着手のジョブは DB に 'pending' のまま残り、次回起動時に再開される。"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+        jobs = list(_in_flight.values())
+        _in_flight.clear()
+        timers = list(_retry_timers.values())
+        _retry_timers.clear()
+    for timer in timers:
+        timer.cancel()
+    for job in jobs:
+        job.cancel()
+    if executor:
+        executor.shutdown(wait=wait, cancel_futures=True)
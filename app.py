@@ -3,39 +3,152 @@ import streamlit as st
 import db
 import auth
 import gemini_chat
+import gemini_async
 from datetime import date
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+import logging
 import os
 import init_db # init_db.py をインポート
+import analysis_worker
+import emotion_chart
+import diary_list
+import emotion_index
+import session_store
+import tracing
 # import add_dummy_data # add_dummy_data.py をインポート
 
-print("--- app.py execution started ---") # 実行開始ログ
-
-# --- データベース初期化処理 (init_db のみ) ---
-print(f"--- Attempting DB initialization (init_db only) ---") # 初期化試行ログ
+tracing.setup_logging() # ログは別スレッドで出力する (2回目以降の rerun では何もしない)
+logger = logging.getLogger("app")
+
+@st.cache_resource
+def bootstrap_database():
+    """
+    DB初期化をプロセス全体で一度だけ実行する。
+    Streamlit は操作のたびにスクリプトを再実行するため、DDL や bcrypt を毎回走らせないようにキャッシュする。
+    """
+    with tracing.span('app.bootstrap', level=logging.INFO):
+        init_db.initialize_database() # テーブル作成とテストユーザー追加
+    analysis_worker.resume_pending() # 前回終わらなかったバックグラウンド分析を再開する
+    session_store.evict() # 期限切れのログインセッションを削除する
+    return True
+
+# --- データベース初期化処理 (init_db のみ、初回のみ実行) ---
 try:
-    print("--- Calling init_db.initialize_database() ---") # init_db 呼び出し前ログ
-    init_db.initialize_database() # テーブル作成とテストユーザー追加
-    print("--- Finished calling init_db.initialize_database() ---") # init_db 呼び出し後ログ
+    bootstrap_database() # 2回目以降の rerun ではキャッシュ済みの結果を返すだけ
 except Exception as e:
-    print(f"データベース初期化(init_db)中にエラーが発生しました: {e}")
+    logger.exception(f"データベース初期化(init_db)中にエラーが発生しました: {e}")
     st.error("アプリケーションの初期設定中にエラーが発生しました。機能が制限される可能性があります。")
 # --- 初期化処理ここまで ---
 
+# 感情グラフの集計単位 (db.get_emotion_series の rollup) と表示名
+GRAPH_ROLLUP_LABELS = {
+    'raw': "日記ごと (多い場合は間引き)",
+    'day': "日ごと",
+    'week': "週ごと (平均と最小〜最大)",
+    'month': "月ごと (平均と最小〜最大)",
+}
+
+SEARCH_RESULT_LIMIT = 10 # サイドバーに表示する検索結果の数
+SIMILAR_ENTRY_COUNT = 3 # 日記の詳細に表示する、感情スコアが近い日記の数
+SESSION_COOKIE = "diary_session" # ログインセッションのトークンを置く cookie (URL には置かない)
+
 # --- セッション状態の初期化 ---
 required_keys = {
     'logged_in': False,
     'username': None,
     'user_id': None,
+    'session_token': None, # session_store のトークン (cookie の SESSION_COOKIE にも置く)
     'chat_history': [],
     'conversation_started': False,
-    'selected_diary_id': None
+    'selected_diary_id': None,
+    'sidebar_month': None, # サイドバーで表示中の年月 ('YYYY-MM'、None は最近の日記)
+    'sidebar_cursors': (), # 表示中のページまでの各ページのカーソル (「新しい日記へ」で1つ戻る)
+    'search_query': '', # サイドバーの検索語
+    'chat_context': None, # gemini_chat.ChatContextManager (古い会話の要約を保持する)
+    'chat_session_id': None, # 会話をターンごとに保存している chat_sessions のID (最初の発言で作る)
+    'chat_turns_saved': 0, # chat_history のうち chat_turns に保存済みのターン数
+    'chat_restore_checked': False, # ログイン後、途中の会話の再開を確認したか
+    'flash_message': None # rerun 後に一度だけ表示するメッセージ
 }
 for key, default_value in required_keys.items():
     if key not in st.session_state:
         st.session_state[key] = default_value
+# ブラウザの cookie にあるトークン (ログアウトで required_keys をクリアしても残るよう別に持つ)。
+# st.context.cookies は接続時の値のままなので、書き換えたらここに控える
+if 'session_cookie' not in st.session_state:
+    st.session_state['session_cookie'] = st.context.cookies.get(SESSION_COOKIE)
+
+def reset_chat_state():
+    """新しい日記のチャットの状態を初期化する (保存・破棄の後)"""
+    st.session_state['chat_history'] = []
+    st.session_state['conversation_started'] = False
+    st.session_state['chat_context'] = None
+    st.session_state['chat_session_id'] = None
+    st.session_state['chat_turns_saved'] = 0
+
+def start_user_session(user_id, username, token):
+    """ログイン状態にする (ログイン画面とセッションの復元から呼ぶ)"""
+    st.session_state['logged_in'] = True
+    st.session_state['username'] = username
+    st.session_state['user_id'] = user_id
+    st.session_state['session_token'] = token
+    # 状態をリセット (途中の会話は新しい日記の画面で再開する)
+    reset_chat_state()
+    st.session_state['selected_diary_id'] = None
+    st.session_state['chat_restore_checked'] = False
+
+def clear_user_session():
+    """セッション情報をクリアする (ウィジェットのキーも含むため、ウィジェット作成前に呼ぶこと)"""
+    for key in required_keys.keys(): # 定義したキーを全てクリア
+        st.session_state[key] = required_keys[key]
+
+def restore_user_session():
+    """
+    cookie のトークンからログイン状態を復元し、ログイン中なら rerun ごとにセッションがまだ有効かを確かめる。
+    ブラウザの再読み込みや別のプロセスへの接続でも、ユーザーの検索と bcrypt の検証をやり直さずに済む。
+    """
+    token = st.session_state['session_token'] or st.session_state['session_cookie']
+    if not token:
+        return
+    session = session_store.resolve(token)
+    if session is None:
+        # 期限切れ・ログアウト済み (別のタブやプロセスでのログアウトを含む)
+        logged_in = st.session_state['logged_in']
+        clear_user_session()
+        if logged_in:
+            st.session_state['flash_message'] = "セッションの有効期限が切れました。もう一度ログインしてください。"
+        return
+    if not st.session_state['logged_in']:
+        start_user_session(session['user_id'], session['username'], token)
+
+def sync_session_cookie():
+    """
+    ブラウザの cookie をログイン中のトークンに合わせる (ログインで設定し、ログアウト・期限切れで削除する)。
+    cookie はサーバーから設定できないため、スクリプトで書く (HttpOnly にはできないので SameSite=Strict にする)。
+    st.rerun() で中断した描画はブラウザに届かないことがあるため、画面の最後で呼ぶ。
+    """
+    token = st.session_state['session_token']
+    if st.session_state['session_cookie'] == token:
+        return
+    attributes = f"Max-Age={int(session_store.SESSION_TTL)}" if token else "Max-Age=0"
+    st.html(
+        f"<script>document.cookie = '{SESSION_COOKIE}={token or ''}; Path=/; {attributes}; SameSite=Strict'"
+        " + (location.protocol === 'https:' ? '; Secure' : '');</script>",
+        unsafe_allow_javascript=True
+    )
+    st.session_state['session_cookie'] = token
+
+def persist_chat_history():
+    """chat_history のうち未保存のターンを chat_turns に追記する (タブが落ちても会話を再開できるように)"""
+    history = st.session_state['chat_history']
+    saved = st.session_state['chat_turns_saved']
+    if saved > len(history):
+        # 応答を得られなかった発言を取り消した
+        db.truncate_chat_turns(st.session_state['chat_session_id'], len(history))
+    elif saved < len(history):
+        if st.session_state['chat_session_id'] is None:
+            st.session_state['chat_session_id'] = db.start_chat_session(st.session_state['user_id'])
+        db.append_chat_turns(st.session_state['chat_session_id'], saved, history[saved:])
+    st.session_state['chat_turns_saved'] = len(history)
 
 # --- テスト用ユーザー作成（初回起動時など） ---
 # 必要に応じてコメント解除して実行し、ユーザーを作成してください。
@@ -51,8 +164,11 @@ for key, default_value in required_keys.items():
 # create_initial_user_if_not_exists('testuser', 'password') # 例
 
 # --- ログイン画面 ---
-if not st.session_state['logged_in']:
+def render_login_page():
     st.title("AIチャット日記アプリ - ログイン")
+    if st.session_state['flash_message']:
+        st.info(st.session_state['flash_message']) # セッションの期限切れなど
+        st.session_state['flash_message'] = None
 
     with st.form("login_form"):
         username_input = st.text_input("ユーザー名")
@@ -89,41 +205,92 @@ if not st.session_state['logged_in']:
                 # verify_password に渡す前に user と password_hash が存在するか確認 <-- このコメントは元のロジックのもの
                 # 修正: verification_result を直接使うようにする <-- このコメントも不要になる可能性
                 # 再度 auth.verify_password を呼び出す形に戻す
-                if user and 'password_hash' in user and auth.verify_password(password_input, user['password_hash']):
-                    st.session_state['logged_in'] = True
-                    st.session_state['username'] = user['username']
-                    st.session_state['user_id'] = user['id']
-                    # ログイン成功時に状態をリセット
-                    st.session_state['chat_history'] = []
-                    st.session_state['conversation_started'] = False
-                    st.session_state['selected_diary_id'] = None
+                try:
+                    verified, new_hash = (
+                        auth.verify_and_update(password_input, user['password_hash'])
+                        if user and 'password_hash' in user else (False, None)
+                    )
+                except auth.AuthBusyError as e:
+                    verified, new_hash = None, None
+                    st.warning(str(e))
+                if verified and new_hash:
+                    # bcrypt のコスト設定が変わっていれば、ログインのついでにハッシュを作り直す
+                    db.update_password_hash(user['id'], user['password_hash'], new_hash)
+                if verified:
+                    # 再読み込み・別のプロセスでもログイン状態を保つセッションを作る (失敗してもこのタブではログインできる)
+                    start_user_session(user['id'], user['username'], session_store.create(user['id'], user['username']))
                     st.success(f"{user['username']} としてログインしました。")
                     st.rerun() # メイン画面へ遷移
-                else:
+                elif verified is False:
                     st.error("ユーザー名またはパスワードが正しくありません。")
 
 # --- メインアプリケーション画面（ログイン後） ---
-else:
+def render_main_page():
     # --- サイドバー ---
     with st.sidebar:
         st.title("メニュー")
         st.write(f"ユーザー: {st.session_state['username']}")
         user_id = st.session_state.get('user_id')
 
-        # 日記選択肢の準備
+        # 日記選択肢の準備 (表示中の1ページ分だけを取得する)
         diary_options = {None: "✨ 新しい日記を書く"} # Noneをキーに
+        unanalyzed_entries = {} # 分析が終わっていない日記 {ID: 状態}
+        next_cursor = None
         if user_id:
-            diary_entries = db.get_entry_list_by_user(user_id)
-            for entry in diary_entries:
-                # 日付が見やすいようにフォーマット（必要なら）
-                entry_date_str = entry['entry_date']
-                try:
-                     # 日付文字列をパースしてフォーマットし直す例（環境によるかも）
-                     parsed_date = date.fromisoformat(entry_date_str)
-                     entry_date_str = parsed_date.strftime('%Y年%m月%d日') # 例: 2023年10月27日
-                except ValueError:
-                     pass # パース失敗時は元の文字列を使う
-                diary_options[entry['id']] = f"📖 {entry_date_str}" # 絵文字を追加
+            # 全文検索 (結果をクリックするとその日記を表示する)
+            def select_diary(entry_id):
+                st.session_state['selected_diary_id'] = entry_id
+
+            search_query = st.text_input("🔍 日記を検索", key='search_query', placeholder="キーワード (例: カフェ)")
+            if search_query.strip():
+                search_results = db.search_entries(user_id, search_query, limit=SEARCH_RESULT_LIMIT)
+                if not search_results:
+                    st.caption("一致する日記はありません。")
+                for result in search_results:
+                    st.button(
+                        diary_list.format_entry_label(result['entry_date']),
+                        key=f"search_result_{result['id']}",
+                        on_click=select_diary,
+                        args=(result['id'],)
+                    )
+                    if result['snippet']:
+                        st.caption(result['snippet'].replace('\n', ' '))
+                st.markdown("---")
+
+            unanalyzed_entries = db.get_unanalyzed_entries_by_user(user_id)
+            months = diary_list.get_months(user_id)
+            month_labels = {None: "🕘 最近の日記"}
+            month_labels.update((month, diary_list.format_month_label(month, count)) for month, count in months)
+            if st.session_state['sidebar_month'] not in month_labels:
+                st.session_state['sidebar_month'] = None
+
+            def reset_sidebar_page():
+                st.session_state['sidebar_cursors'] = ()
+
+            st.selectbox(
+                "表示する月",
+                options=list(month_labels.keys()),
+                format_func=lambda x: month_labels[x],
+                key='sidebar_month',
+                on_change=reset_sidebar_page # 月を変えたら先頭ページに戻る
+            )
+            cursors = st.session_state['sidebar_cursors']
+            page_options, next_cursor = diary_list.get_page_options(
+                user_id,
+                month=st.session_state['sidebar_month'],
+                before=cursors[-1] if cursors else None,
+                unanalyzed_entries=unanalyzed_entries
+            )
+            diary_options.update(page_options)
+
+            # 選択中の日記が表示中のページにない場合も、選択を保ったまま選択肢に加える
+            selected_id = st.session_state['selected_diary_id']
+            if selected_id is not None and selected_id not in diary_options:
+                brief = db.get_entry_brief(selected_id)
+                if brief and brief['user_id'] == user_id:
+                    diary_options[selected_id] = diary_list.format_entry_label(brief['entry_date'], unanalyzed_entries.get(selected_id))
+                else:
+                    st.session_state['selected_diary_id'] = None
 
         # 日記選択セレクトボックス
         # key を使うことで、rerun後も選択状態が維持される
@@ -134,16 +301,33 @@ else:
             key='selected_diary_id' # このキーで選択中のIDが session_state に保存される
         )
 
+        # ページ送り (カーソルを積んだり戻したりするだけで、前のページを読み直すことはない)
+        def show_newer_page():
+            st.session_state['sidebar_cursors'] = st.session_state['sidebar_cursors'][:-1]
+
+        def show_older_page(cursor):
+            st.session_state['sidebar_cursors'] = st.session_state['sidebar_cursors'] + (cursor,)
+
+        newer_col, older_col = st.columns(2)
+        with newer_col:
+            st.button("← 新しい日記", on_click=show_newer_page, disabled=not st.session_state['sidebar_cursors'])
+        with older_col:
+            st.button("古い日記 →", on_click=show_older_page, args=(next_cursor,), disabled=next_cursor is None)
+
         # ログアウトボタン
-        if st.button("ログアウト"):
-            # セッション情報をクリア
-            for key in required_keys.keys(): # 定義したキーを全てクリア
-                st.session_state[key] = required_keys[key]
-            st.success("ログアウトしました。")
-            st.rerun() # ログイン画面へ遷移
+        def logout():
+            # ウィジェットのキーも含むため、ウィジェット作成前に走るコールバックでクリアする
+            if st.session_state['session_token']:
+                session_store.revoke(st.session_state['session_token'])
+            clear_user_session()
+
+        st.button("ログアウト", on_click=logout) # クリック後の rerun でログイン画面へ遷移
 
     # --- メインエリア ---
     st.title("AIチャット日記")
+    if st.session_state['flash_message']:
+        st.success(st.session_state['flash_message'])
+        st.session_state['flash_message'] = None
 
     # --- 過去の日記詳細表示 ---
     if st.session_state.selected_diary_id is not None:
@@ -155,23 +339,53 @@ else:
 
         if entry_details:
             st.write(f"**日付:** {entry_details['entry_date']}")
-            st.write("**AIによる要約:**")
-            st.info(entry_details['summary'])
-
-            st.write("**感情スコア:**")
-            emotions_to_display = {k: entry_details[k] for k in ['joy', 'anger', 'sadness', 'anxiety', 'relief']}
-            cols = st.columns(len(emotions_to_display))
-            i = 0
-            for emotion, score in emotions_to_display.items():
-                with cols[i]:
-                    st.metric(label=emotion.capitalize(), value=score)
-                i += 1
-
-            with st.expander("チャットログを見る"):
-                st.text_area(
-                    "ログ", value=entry_details['chat_log'], height=300,
-                    disabled=True, key=f"log_{entry_details['id']}"
-                )
+            if entry_details['analysis_status'] == db.ANALYSIS_PENDING:
+                st.info("⏳ AIが要約と感情分析を行っています。しばらくしてから更新してください。")
+                if st.button("表示を更新"):
+                    st.rerun()
+            elif entry_details['analysis_status'] == db.ANALYSIS_FAILED:
+                st.warning(f"AI分析に失敗しました: {entry_details['analysis_error']}")
+                if st.button("もう一度分析する"):
+                    db.requeue_entry_analysis(selected_id)
+                    analysis_worker.submit(selected_id)
+                    st.rerun()
+            else:
+                st.write("**AIによる要約:**")
+                st.info(entry_details['summary'])
+
+                st.write("**感情スコア:**")
+                emotions_to_display = {k: entry_details[k] for k in ['joy', 'anger', 'sadness', 'anxiety', 'relief']}
+                cols = st.columns(len(emotions_to_display))
+                i = 0
+                for emotion, score in emotions_to_display.items():
+                    with cols[i]:
+                        st.metric(label=emotion.capitalize(), value=score)
+                    i += 1
+
+                # 感情スコアが近い過去の日記 (メモリ上の行列で検索する)
+                similar_entries = emotion_index.find_similar_entries(user_id, selected_id, k=SIMILAR_ENTRY_COUNT)
+                if similar_entries:
+                    st.write("**似た気持ちだった日:**")
+                    similar_cols = st.columns(len(similar_entries))
+                    for col, similar in zip(similar_cols, similar_entries):
+                        with col:
+                            st.button(
+                                diary_list.format_entry_label(similar['entry_date']),
+                                key=f"similar_entry_{similar['id']}",
+                                on_click=select_diary,
+                                args=(similar['id'],)
+                            )
+                            st.caption(f"距離 {similar['distance']:.0f}")
+
+            # チャットログは開いたときだけ読み込んで展開する (閉じている間は DB から読まない)
+            with st.expander(
+                "チャットログを見る", key=f"log_expander_{entry_details['id']}", on_change="rerun"
+            ) as log_expander:
+                if log_expander.open:
+                    st.text_area(
+                        "ログ", value=db.get_chat_log(entry_details['id']) or "", height=300,
+                        disabled=True, key=f"log_{entry_details['id']}"
+                    )
         else:
             st.error("選択された日記の詳細情報の取得に失敗しました。")
         st.markdown("---")
@@ -184,6 +398,17 @@ else:
         # チャット履歴表示エリア
         chat_container = st.container(height=400)
         with chat_container:
+            # 前回のログイン中に保存まで進まなかった会話があれば、その続きから再開する
+            if not st.session_state['chat_restore_checked']:
+                st.session_state['chat_restore_checked'] = True
+                open_session_id = db.get_open_chat_session(st.session_state['user_id'])
+                if open_session_id and not st.session_state['chat_history']:
+                    st.session_state['chat_history'] = db.get_chat_history(open_session_id)
+                    st.session_state['chat_session_id'] = open_session_id
+                    st.session_state['chat_turns_saved'] = len(st.session_state['chat_history'])
+                    st.session_state['conversation_started'] = True
+                    st.info("前回の途中の会話を再開しました。")
+
             # 最初のAIからの問いかけ
             if not st.session_state['conversation_started'] and not st.session_state['chat_history']:
                  initial_prompt = "こんにちは！今日はどんな一日でしたか？"
@@ -204,24 +429,49 @@ else:
         if user_input:
             # 1. ユーザーのメッセージを履歴に追加
             st.session_state['chat_history'].append({'role': 'user', 'parts': [user_input]})
-
-            # 2. AIの応答を取得 (gemini_chat を呼び出す)
-            with st.spinner("AIが応答を考えています..."):
-                # 応答取得時には最新の履歴全体を渡す
-                ai_response_text, _ = gemini_chat.get_chat_response(
-                    user_input, # 最新の入力（これは履歴に含まれているが、念のため渡しても良い）
-                    st.session_state['chat_history'] # 最新の履歴
-                )
-
-            # 3. AIの応答を履歴に追加
-            if ai_response_text and not ai_response_text.startswith("エラー"):
+            persist_chat_history()
+
+            # 2. AIの応答をストリーミングで取得し、届いた分から表示する (gemini_chat を呼び出す)
+            # 長い会話でも送る量が一定になるよう、古いやり取りは要約に置き換えて送る
+            if st.session_state['chat_context'] is None:
+                st.session_state['chat_context'] = gemini_chat.ChatContextManager()
+            with chat_container:
+                with st.chat_message(name='user', avatar="👤"):
+                    st.write(user_input)
+                with st.chat_message(name='model', avatar="🤖"):
+                    # 応答取得時には最新の履歴全体を渡す。st.write_stream は全文を連結して返す
+                    # 通信は全セッション共有のイベントループで行い、このスレッドは届いた断片を受け取るだけにする
+                    try:
+                        ai_response_text = st.write_stream(
+                            gemini_async.stream_chat_response(
+                                st.session_state['chat_history'], st.session_state['chat_context'],
+                                user_id=st.session_state['user_id']
+                            )
+                        )
+                    except gemini_chat.GeminiUnavailableError as e:
+                        # 混雑などで応答を得られなかった。エラー文を履歴に残さず、同じ内容を送り直せるようにする
+                        logger.warning(f"チャット応答を取得できませんでした: {e}")
+                        ai_response_text = None
+                        st.session_state['chat_history'].pop()
+                        st.warning("AIが混み合っているため応答を取得できませんでした。少し待ってからもう一度送信してください。")
+                    except gemini_chat.ChatResponseError as e:
+                        # 応答を得られなかった。エラー文は履歴に残さず (日記や Gemini に送る履歴に混ざらないように)、入力をやり直してもらう
+                        logger.warning(f"チャット応答を取得できませんでした: {e}")
+                        ai_response_text = None
+                        st.session_state['chat_history'].pop()
+                        st.warning("AIの応答を取得できませんでした。この発言は保存していません。もう一度送信してください。")
+                    except gemini_chat.ChatStreamInterruptedError as e:
+                        # 途中まで表示した応答は保存しない (中途半端な応答が日記に残らないようにする)
+                        logger.warning(f"チャット応答が途中で途切れました ({len(e.partial_text)} 文字): {e}")
+                        ai_response_text = None
+                        st.session_state['chat_history'].pop()
+                        st.warning("AIの応答が途中で途切れました。この応答は保存していません。もう一度送信してください。")
+
+            # 3. AIの応答を履歴に追加 (表示は済んでいるので rerun は不要)
+            # 失敗した場合 (None) はユーザーの発言も取り除いてあるので、入力をやり直してもらう
+            if ai_response_text is not None:
                  st.session_state['chat_history'].append({'role': 'model', 'parts': [ai_response_text]})
-            else:
-                 # エラーメッセージも履歴に（あるいは st.error で表示）
-                 st.session_state['chat_history'].append({'role': 'model', 'parts': [f"エラーが発生しました: {ai_response_text}"]})
-
-            # 4. UIを更新するために再実行
-            st.rerun()
+            persist_chat_history()
 
         # --- 会話終了と分析・保存ボタン ---
         st.markdown("---")
@@ -232,79 +482,101 @@ else:
 
         if st.button("会話を終了して日記を保存する", disabled=not can_save):
             if st.session_state['chat_history']:
-                with st.spinner("日記を分析・保存中..."):
-                    # 1. ログ整形
-                    chat_log_lines = []
-                    for msg in st.session_state['chat_history']:
-                        role = "あなた" if msg.get('role') == 'user' else "AI"
-                        text = msg.get('parts', [""])[0]
-                        chat_log_lines.append(f"{role}: {text}")
-                    full_chat_log_text = "\n".join(chat_log_lines)
-
-                    # 2. 分析
-                    summary, emotions = gemini_chat.analyze_diary_entry(full_chat_log_text)
-
-                    if summary and emotions:
-                        # 3. 保存
-                        today = date.today()
-                        current_user_id = st.session_state.get('user_id')
-                        if current_user_id:
-                            entry_id = db.create_entry_and_emotions(
-                                user_id=current_user_id, entry_date=today,
-                                chat_log=full_chat_log_text, summary=summary, emotions=emotions
-                            )
-                            if entry_id:
-                                analysis_placeholder.success("日記を保存しました！")
-                                # 保存結果を表示
-                                with analysis_placeholder.container():
-                                    st.subheader("保存された日記の分析結果")
-                                    st.write("**要約:**"); st.write(summary)
-                                    st.write("**感情スコア:**")
-                                    cols = st.columns(len(emotions))
-                                    i = 0
-                                    for emo, score in emotions.items():
-                                        with cols[i]: st.metric(label=emo.capitalize(), value=score)
-                                        i += 1
-                                # 状態リセットして rerun
-                                st.session_state['chat_history'] = []
-                                st.session_state['conversation_started'] = False
-                                st.info("新しい日記を始める準備ができました。（ページが更新されます）")
-                                # 少し待ってから rerun する方がユーザー体験が良いかも
-                                import time; time.sleep(2)
-                                st.rerun()
-                            else: analysis_placeholder.error("DB保存エラー")
-                        else: analysis_placeholder.error("ユーザーIDエラー")
-                    else: analysis_placeholder.error("AI分析エラー")
+                # 1. 会話はターンごとに chat_turns に保存済み (未保存の分があれば追記する)
+                persist_chat_history()
+
+                # 2. ターンからチャットログを作って先に保存し、分析 (要約・感情スコア) はバックグラウンドで行う
+                current_user_id = st.session_state.get('user_id')
+                if current_user_id:
+                    entry_id = db.save_chat_session(
+                        st.session_state['chat_session_id'], current_user_id, date.today()
+                    )
+                    if entry_id:
+                        analysis_worker.submit(entry_id)
+                        # 状態リセットして rerun
+                        reset_chat_state()
+                        st.session_state['flash_message'] = "日記を保存しました！AIによる要約と感情分析はバックグラウンドで行います。"
+                        st.rerun()
+                    else: analysis_placeholder.error("DB保存エラー")
+                else: analysis_placeholder.error("ユーザーIDエラー")
             else:
                 st.warning("まだ会話がありません。")
 
+        def discard_chat():
+            # 保存せずに会話をやめる (次回ログイン時にも再開しない)
+            if st.session_state['chat_session_id'] is not None:
+                db.discard_chat_session(st.session_state['chat_session_id'])
+            reset_chat_state()
+        st.button("会話を破棄する", on_click=discard_chat, disabled=not can_save)
+
     # --- 感情グラフの表示 (ログイン中なら常に表示) ---
     st.markdown("---")
     st.header("📊 感情の推移グラフ")
     current_user_id_for_graph = st.session_state.get('user_id')
     if current_user_id_for_graph:
-        emotion_df = db.get_emotions_by_user(current_user_id_for_graph)
-        if not emotion_df.empty:
-            try:
-                fig, ax = plt.subplots(figsize=(10, 5))
-                for emotion in ['joy', 'anger', 'sadness', 'anxiety', 'relief']:
-                    if emotion in emotion_df.columns: # 念のためカラム存在確認
-                        ax.plot(emotion_df['entry_date'], emotion_df[emotion], marker='o', linestyle='-', label=emotion.capitalize())
-
-                ax.set_title('感情スコアの推移')
-                ax.set_xlabel('日付'); ax.set_ylabel('スコア (0-100)')
-                ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-                ax.grid(axis='y', linestyle='--') # Y軸のみグリッド
-                ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d')) # YYYY-MM-DD から MM/DD に変更
-                ax.xaxis.set_major_locator(mdates.AutoDateLocator(minticks=3, maxticks=10)) # 目盛り数を自動調整
-                fig.autofmt_xdate()
-                ax.set_ylim(0, 105)
-                plt.tight_layout() # レイアウト調整
-                st.pyplot(fig)
-                plt.close(fig) # メモリ解放のために閉じる
-            except Exception as e:
-                st.error(f"グラフの描画中にエラーが発生しました: {e}")
-        else:
-             st.info("まだ記録された感情データがありません。日記を保存するとグラフが表示されます。")
+        pending_count = sum(1 for status in unanalyzed_entries.values() if status == db.ANALYSIS_PENDING)
+        if pending_count:
+            st.caption(f"⏳ 分析中の日記が {pending_count} 件あります。分析が終わるとグラフに反映されます。")
+
+        # 集計値 (感情スコアの書き込み時に更新済みの1行を読むだけで、履歴は走査しない)
+        emotion_stats = db.get_user_emotion_stats(current_user_id_for_graph)
+        if emotion_stats:
+            last_entry_date = date.fromisoformat(emotion_stats['last_entry_date'])
+            # 昨日までに書いていれば連続記録は続いている
+            streak_days = emotion_stats['streak_days'] if (date.today() - last_entry_date).days <= 1 else 0
+            stat_cols = st.columns(3)
+            stat_cols[0].metric("日記の数", f"{emotion_stats['entry_count']} 件")
+            stat_cols[1].metric("連続記録", f"{streak_days} 日")
+            stat_cols[2].metric("最後の記録", last_entry_date.strftime('%Y年%m月%d日'))
+            st.caption(f"直近7日 ({emotion_stats['count_7d']} 件) の平均と、その前の7日との差 (今日まで)")
+            emotion_cols = st.columns(len(db.EMOTION_KEYS))
+            for col, key in zip(emotion_cols, db.EMOTION_KEYS):
+                value, previous = emotion_stats[f"{key}_7d"], emotion_stats[f"{key}_prev_7d"]
+                col.metric(
+                    key.capitalize(), "-" if value is None else f"{value:.0f}",
+                    delta=None if value is None or previous is None else f"{value - previous:+.0f}"
+                )
+        first_entry_date = db.get_first_entry_date(current_user_id_for_graph)
+        if first_entry_date:
+            # 表示期間と集計単位の選択 (長期間でも点数が増えすぎないよう、DB側で集計・間引きする)
+            graph_cols = st.columns([2, 1])
+            with graph_cols[0]:
+                date_range = st.date_input(
+                    "表示期間", value=(first_entry_date, max(first_entry_date, date.today())), key='graph_date_range'
+                )
+            with graph_cols[1]:
+                rollup = st.selectbox(
+                    "集計単位", options=list(GRAPH_ROLLUP_LABELS.keys()),
+                    format_func=lambda x: GRAPH_ROLLUP_LABELS[x], key='graph_rollup'
+                )
+            # 期間を選択している途中 (開始日だけ選んだ状態) は終了日を指定なしとして扱う
+            start_date, end_date = (tuple(date_range) + (None, None))[:2]
+
+        # データと表示条件が変わっていなければ、クエリも描画も行わずにキャッシュ済みの画像を表示する
+        try:
+            chart_png = None
+            if first_entry_date:
+                chart_png = emotion_chart.get_emotion_chart_png(
+                    current_user_id_for_graph, start=start_date, end=end_date, rollup=rollup
+                )
+            if chart_png:
+                st.image(chart_png, width="stretch")
+            else:
+                 st.info("まだ記録された感情データがありません。日記を保存するとグラフが表示されます。")
+        except Exception as e:
+            st.error(f"グラフの描画中にエラーが発生しました: {e}")
     # else: # ログインしてない場合は表示されない (メイン画面に入れないため不要)
     #     st.warning("グラフを表示するにはログインしてください。")
+
+restore_user_session()
+
+# --- 画面の描画 ---
+# rerun 全体の所要時間を計測する (TRACE_PROFILE=1 なら cProfile も取る)
+with tracing.rerun('app.rerun', logged_in=st.session_state['logged_in']):
+    if not st.session_state['logged_in']:
+        render_login_page()
+    else:
+        render_main_page()
+
+# ログイン・ログアウトを cookie に反映する (st.rerun() で中断せず最後まで描画した rerun で書く)
+sync_session_cookie()
@@ -1,27 +1,168 @@
 # auth.py
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
 import bcrypt
 
-def hash_password(password):
-    """パスワードをハッシュ化する"""
+logger = logging.getLogger(__name__)
+
+# --- 設定 ---
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12")) # bcrypt のコスト (1増えるごとに計算時間が2倍)
+AUTH_WORKERS = int(os.getenv("AUTH_WORKERS", str(os.cpu_count() or 2))) # bcrypt を同時に計算するスレッド数
+AUTH_MAX_PENDING = int(os.getenv("AUTH_MAX_PENDING", str(AUTH_WORKERS * 8))) # 実行中 + 順番待ちの上限
+AUTH_TIMEOUT = float(os.getenv("AUTH_TIMEOUT", "10")) # 順番待ちを含めた1回の検証の待ち時間の上限 (秒)
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(AUTH_MAX_PENDING)
+_stats_lock = threading.Lock()
+_stats = {'jobs': 0, 'verifications': 0, 'rehashes': 0, 'rejected_busy': 0, 'wait_seconds': 0.0, 'work_seconds': 0.0}
+
+
+class AuthBusyError(Exception):
+    """ログインが集中して、時間内にパスワードを検証できなかった"""
+
+
+def _get_executor():
+    # bcrypt は計算中に GIL を解放するため、スレッドでも CPU コア数まで並列に動く
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="bcrypt")
+        return _executor
+
+
+def _run_in_pool(func, *args):
+    """
+    bcrypt の計算をワーカースレッドで実行して結果を待つ。
+    順番待ちが AUTH_MAX_PENDING 件を超えている、または AUTH_TIMEOUT 秒以内に終わらない場合は AuthBusyError。
+    """
+    submitted = time.perf_counter()
+    if not _slots.acquire(timeout=AUTH_TIMEOUT):
+        with _stats_lock:
+            _stats['rejected_busy'] += 1
+        raise AuthBusyError("ログインが混み合っています。しばらくしてからもう一度お試しください。")
+
+    def task():
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            finished = time.perf_counter()
+            with _stats_lock:
+                _stats['jobs'] += 1
+                _stats['wait_seconds'] += started - submitted
+                _stats['work_seconds'] += finished - started
+            _slots.release()
+
+    try:
+        future = _get_executor().submit(task)
+    except Exception:
+        _slots.release()
+        raise
+    remaining = max(0.0, AUTH_TIMEOUT - (time.perf_counter() - submitted))
+    try:
+        return future.result(timeout=remaining)
+    except FutureTimeoutError:
+        # 計算自体は最後まで走り、終わった時点で枠が返される
+        with _stats_lock:
+            _stats['rejected_busy'] += 1
+        raise AuthBusyError("ログインが混み合っています。しばらくしてからもう一度お試しください。")
+
+
+def _hash(password, rounds):
     password_bytes = password.encode('utf-8')
-    salt = bcrypt.gensalt()
-    hashed_password = bcrypt.hashpw(password_bytes, salt)
-    return hashed_password.decode('utf-8') # DB保存用に文字列で返す
+    salt = bcrypt.gensalt(rounds=rounds)
+    return bcrypt.hashpw(password_bytes, salt).decode('utf-8') # DB保存用に文字列で返す
 
-def verify_password(plain_password, hashed_password):
-    """入力されたパスワードがハッシュと一致するか検証する"""
+
+def _check(plain_password, hashed_password):
+    """入力されたパスワードがハッシュと一致するか検証する (呼び出したスレッドで計算する)"""
     plain_password_bytes = plain_password.encode('utf-8')
     hashed_password_bytes = hashed_password.encode('utf-8')
     try:
         # ハッシュ値が bcrypt 形式でない場合にエラーになる可能性を考慮
         if not hashed_password or not hashed_password.startswith('$2b$'):
-             print("警告: 無効な形式のハッシュ値です。")
+             logger.warning("無効な形式のハッシュ値です。")
              return False
         return bcrypt.checkpw(plain_password_bytes, hashed_password_bytes)
     except ValueError as e:
         # ハッシュ形式が不正な場合などに ValueError が発生することがある
-        print(f"パスワード検証中にエラーが発生しました: {e}")
+        logger.error(f"パスワード検証中にエラーが発生しました: {e}")
         return False
     except Exception as e:
-        print(f"パスワード検証中に予期せぬエラーが発生しました: {e}")
-        return False
\ No newline at end of file
+        logger.exception(f"パスワード検証中に予期せぬエラーが発生しました: {e}")
+        return False
+
+
+def hash_password(password, rounds=None):
+    """パスワードをハッシュ化する (コストは BCRYPT_ROUNDS)"""
+    return _run_in_pool(_hash, password, rounds or BCRYPT_ROUNDS)
+
+
+def verify_password(plain_password, hashed_password):
+    """入力されたパスワードがハッシュと一致するか、ワーカースレッドで検証する"""
+    result = _run_in_pool(_check, plain_password, hashed_password)
+    with _stats_lock:
+        _stats['verifications'] += 1
+    return result
+
+
+def get_hash_rounds(hashed_password):
+    """'$2b$12$...' 形式のハッシュからコストを取り出す (読めなければ None)"""
+    try:
+        return int(hashed_password.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def needs_rehash(hashed_password):
+    """ハッシュのコストが現在の BCRYPT_ROUNDS と違えば True"""
+    return get_hash_rounds(hashed_password) != BCRYPT_ROUNDS
+
+
+def verify_and_update(plain_password, hashed_password):
+    """
+    パスワードを検証し、ハッシュのコストが BCRYPT_ROUNDS と違えば新しいコストで作り直す。
+    平文のパスワードが手元にあるのはログイン時だけなので、このときに移行する。
+    Returns:
+        bool: パスワードが一致したか。
+        str: 作り直したハッシュ (不要・混雑で作れなかったときは None)。呼び出し側で DB に保存する。
+    Raises:
+        AuthBusyError: 混雑して検証できなかった (作り直しが混雑しただけならログインは成功させる)。
+    """
+    if not verify_password(plain_password, hashed_password):
+        return False, None
+    if not needs_rehash(hashed_password):
+        return True, None
+    try:
+        new_hash = hash_password(plain_password)
+    except AuthBusyError:
+        # 検証は済んでいるのでログインは通し、作り直しは次のログインに回す
+        logger.info("ログインが集中しているため、パスワードハッシュの作り直しを見送りました。")
+        return True, None
+    with _stats_lock:
+        _stats['rehashes'] += 1
+    return True, new_hash
+
+
+def get_stats():
+    """bcrypt の計算回数・検証回数・作り直し回数・混雑で断った回数と、順番待ち・計算時間の平均 (ms) を返す"""
+    with _stats_lock:
+        stats = dict(_stats)
+    jobs = stats['jobs']
+    stats['avg_wait_ms'] = stats.pop('wait_seconds') / jobs * 1000 if jobs else 0.0
+    stats['avg_work_ms'] = stats.pop('work_seconds') / jobs * 1000 if jobs else 0.0
+    return stats
+
+
+def shutdown(wait=False):
+    """ワーカースレッドを停止する (ベンチマーク・テスト用)"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor:
+        executor.shutdown(wait=wait)
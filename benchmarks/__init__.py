@@ -0,0 +1,2 @@
+# benchmarks/__init__.py
+# ネットワークなしで実行できる性能計測スクリプト群 (リポジトリのルートで python -m benchmarks.<名前> として実行する)
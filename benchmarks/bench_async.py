@@ -0,0 +1,146 @@
+# benchmarks/bench_async.py
+"""
+100 以上のセッションが同時にチャットしたときのスループットを、同期版と非同期版で比較する負荷試験。
+Gemini はローカルのスタブ (generate_content / generate_content_async) を使う。
+
+- sync_threads: 同期版 (gemini_chat)。セッションごとにスレッドを1つ使う
+- sync_pool:    同期版。セッションが少数のスレッド (--threads) を共有する (待ち時間中もスレッドを占有する)
+- async:        非同期版 (gemini_async)。全セッションのリクエストを共有のイベントループ1つで待つ
+
+実行例 (リポジトリのルートで):
+    python -m benchmarks.bench_async --sessions 100 200 --turns 3 --latency-ms 300
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import gemini_async
+import gemini_chat
+import gemini_client
+import init_db
+from benchmarks.common import summarize
+from benchmarks.fake_gemini import FakeGenerativeModel
+
+
+def _history(session, turn, run_id):
+    # セッション・ターンごとに内容を変えて、応答キャッシュに当たらないようにする
+    return [{'role': 'user', 'parts': [f"[{run_id}] セッション {session} の {turn} 回目の発言です。"]}]
+
+
+class ThreadSampler:
+    """計測中のスレッド数の最大を記録する"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.max_threads = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.max_threads = max(self.max_threads, threading.active_count())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_sync(sessions, turns, threads, run_id):
+    latencies = []
+
+    def session(n):
+        for turn in range(turns):
+            started = time.perf_counter()
+            gemini_chat.get_chat_response(None, _history(n, turn, run_id))
+            latencies.append(time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(session, range(sessions)))
+    return latencies
+
+
+def run_async(sessions, turns, run_id):
+    latencies = []
+
+    async def session(n):
+        for turn in range(turns):
+            started = time.perf_counter()
+            await gemini_async.get_chat_response_async(_history(n, turn, run_id))
+            latencies.append(time.perf_counter() - started)
+
+    async def all_sessions():
+        await asyncio.gather(*(session(n) for n in range(sessions)))
+
+    gemini_async.get_runner().run(all_sessions())
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="同期版と非同期版の Gemini 呼び出しの負荷試験")
+    parser.add_argument("--sessions", type=int, nargs="*", default=[100, 200], help="同時にチャットするセッション数")
+    parser.add_argument("--turns", type=int, default=3, help="セッションごとの発言回数")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="スタブの応答遅延")
+    parser.add_argument("--jitter-ms", type=float, default=100.0)
+    parser.add_argument("--max-concurrent", type=int, default=64, help="同期版・非同期版共通の同時実行数の上限")
+    parser.add_argument("--threads", type=int, default=8, help="sync_pool で共有するスレッド数")
+    parser.add_argument("--modes", nargs="*", default=["sync_threads", "sync_pool", "async"])
+    parser.add_argument("--verbose", action="store_true", help="アプリのログ出力を表示する")
+    args = parser.parse_args(argv)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir, contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        # 応答キャッシュは一時DBに保存する
+        db.DB_NAME = os.path.join(tmp_dir, "bench.db")
+        with contextlib.closing(sqlite3.connect(db.DB_NAME)) as conn:
+            init_db.apply_migrations(conn)
+        for sessions in args.sessions:
+            for mode in args.modes:
+                fake = FakeGenerativeModel(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, seed=sessions)
+                previous_model = gemini_chat.set_model(fake)
+                gemini_client.configure(max_concurrent=args.max_concurrent, rate_per_minute=0)
+                gemini_async.configure(max_concurrent=args.max_concurrent)
+                run_id = f"{mode}-{sessions}"
+                try:
+                    with ThreadSampler() as sampler:
+                        started = time.perf_counter()
+                        if mode == 'async':
+                            latencies = run_async(sessions, args.turns, run_id)
+                        else:
+                            threads = sessions if mode == 'sync_threads' else args.threads
+                            latencies = run_sync(sessions, args.turns, threads, run_id)
+                        elapsed = time.perf_counter() - started
+                finally:
+                    gemini_chat.set_model(previous_model)
+                stats = summarize(run_id, latencies)
+                rows.append((mode, sessions, len(latencies) / elapsed, stats, sampler.max_threads, fake.max_concurrent))
+        gemini_async.get_runner().stop()
+        db.close_pool()
+
+    print(f"turns={args.turns} latency={args.latency_ms}ms±{args.jitter_ms}ms max_concurrent={args.max_concurrent}")
+    header = (f"{'mode':<14}{'sessions':>9}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+              f"{'threads':>9}{'in-flight':>11}  (ms)")
+    print(header)
+    print("-" * len(header))
+    for mode, sessions, throughput, stats, max_threads, in_flight in rows:
+        print(f"{mode:<14}{sessions:>9}{throughput:>9.1f}{stats['p50_ms']:>9.0f}{stats['p95_ms']:>9.0f}"
+              f"{stats['p99_ms']:>9.0f}{max_threads:>9}{in_flight:>11}")
+    return rows
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,117 @@
+# benchmarks/bench_gemini_client.py
+"""
+多数のセッションが同時に Gemini を呼んだときに、429 (クォータ超過) を注入したスタブに対して
+- direct: 以前の実装 (model.generate_content を直接呼ぶ。失敗はそのままエラーになる)
+- client: gemini_client 経由 (同時実行数・レート制限、リトライ、同じ分析の合流)
+の成功率・API 呼び出し回数・同時実行数・所要時間を比較するベンチマーク。
+
+実行例 (リポジトリのルートで):
+    python -m benchmarks.bench_gemini_client --sessions 40 --error-rate 0.3 --latency-ms 200
+"""
+import argparse
+import contextlib
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import gemini_chat
+import gemini_client
+import init_db
+import response_cache
+from benchmarks.common import print_results, summarize
+from benchmarks.fake_gemini import ANALYSIS_MARKER, FakeGenerativeModel
+
+
+def make_requests(sessions, duplicate_rate):
+    """セッションごとの分析対象のチャットログ。duplicate_rate の割合は同じログ (保存の連打など) にする"""
+    duplicates = int(sessions * duplicate_rate)
+    return ["あなた: 同じ日記を何度も保存しました。"] * duplicates + [
+        f"あなた: 今日は {i} 番目の日記です。" for i in range(sessions - duplicates)
+    ]
+
+
+def run(mode, fake, chat_logs, concurrency):
+    """全セッションを同時に実行し、成功数と1件ごとの所要時間を返す"""
+    durations = []
+
+    def direct(chat_log):
+        prompt = f"{ANALYSIS_MARKER}\n{chat_log}"
+        try:
+            return fake.generate_content(prompt).text is not None
+        except Exception:
+            return False
+
+    def through_client(chat_log):
+        summary, emotions = gemini_chat.analyze_diary_entry(chat_log)
+        return summary is not None
+
+    call = direct if mode == 'direct' else through_client
+
+    def session(chat_log):
+        started = time.perf_counter()
+        ok = call(chat_log)
+        durations.append(time.perf_counter() - started)
+        return ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        successes = sum(pool.map(session, chat_logs))
+    return successes, durations, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gemini クライアント (制限・リトライ・合流) のベンチマーク")
+    parser.add_argument("--sessions", type=int, default=40, help="同時に分析を依頼するセッション数")
+    parser.add_argument("--duplicate-rate", type=float, default=0.25, help="同じチャットログを送るセッションの割合")
+    parser.add_argument("--error-rate", type=float, default=0.3, help="スタブが 429 を返す割合")
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--error-latency-ms", type=float, default=50.0, help="スタブが 429 を返すまでの遅延")
+    parser.add_argument("--max-concurrent", type=int, default=4, help="クライアントの同時実行数の上限")
+    parser.add_argument("--rate-per-minute", type=float, default=0, help="クライアントのレート制限 (0 で無制限)")
+    parser.add_argument("--backoff-base", type=float, default=0.1, help="リトライ間隔の基準 (秒)")
+    parser.add_argument("--verbose", action="store_true", help="リトライなどのログ出力を表示する")
+    args = parser.parse_args(argv)
+
+    chat_logs = make_requests(args.sessions, args.duplicate_rate)
+    results = []
+    report = []
+    with tempfile.TemporaryDirectory() as tmp_dir, contextlib.ExitStack() as stack:
+        # 応答キャッシュは一時DBに保存する。期限 0 にして、キャッシュではなく API 呼び出しの振る舞いを比べる
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        db.DB_NAME = os.path.join(tmp_dir, "bench.db")
+        with contextlib.closing(sqlite3.connect(db.DB_NAME)) as conn:
+            init_db.apply_migrations(conn)
+        response_cache.CACHE_TTL['analysis'] = 0
+        for mode in ('direct', 'client'):
+            fake = FakeGenerativeModel(latency=args.latency_ms / 1000, error_rate=args.error_rate,
+                                       error_latency=args.error_latency_ms / 1000, seed=1)
+            previous_model = gemini_chat.set_model(fake)
+            gemini_client.configure(max_concurrent=args.max_concurrent, rate_per_minute=args.rate_per_minute,
+                                    backoff_base=args.backoff_base)
+            try:
+                successes, durations, elapsed = run(mode, fake, chat_logs, args.sessions)
+            finally:
+                gemini_chat.set_model(previous_model)
+            results.append(summarize(mode, durations))
+            report.append((mode, successes, fake.calls, fake.errors, fake.max_concurrent, elapsed,
+                           gemini_client.get_stats() if mode == 'client' else None))
+        db.close_pool()
+
+    print(f"sessions={args.sessions} error_rate={args.error_rate} latency={args.latency_ms}ms "
+          f"max_concurrent={args.max_concurrent}")
+    print_results(results)
+    for mode, successes, calls, errors, max_concurrent, elapsed, stats in report:
+        print(f"{mode}: 成功 {successes}/{len(chat_logs)}  API呼び出し {calls} (429: {errors})  "
+              f"最大同時実行 {max_concurrent}  全体 {elapsed:.2f}s")
+        if stats:
+            print(f"  client stats: {stats}")
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
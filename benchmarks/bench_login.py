@@ -0,0 +1,97 @@
+# benchmarks/bench_login.py
+"""
+ログインが集中したときの bcrypt 検証のスループット (logins/sec と1コアあたりの値) と、
+その間に他のセッションの処理がどれだけ待たされるかを計測するベンチマーク。
+
+- inline: 以前の実装。各セッションのスレッドでそのまま bcrypt.checkpw を実行する
+- pool:   auth.verify_password。CPU コア数に合わせたワーカースレッドで実行する
+
+実行例 (リポジトリのルートで):
+    python -m benchmarks.bench_login --rounds 10 --logins 64 --concurrency 1 4 16 64
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+import auth
+from benchmarks.common import summarize
+
+BENCH_PASSWORD = "password123"
+
+
+def _other_session_probe(stop, durations):
+    """ログイン処理と並行して、軽い処理 (他のセッションの rerun 相当) の所要時間を測り続ける"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        sum(range(20000))
+        durations.append(time.perf_counter() - started)
+        time.sleep(0.005)
+
+
+def run_burst(verify, password_hash, logins, concurrency):
+    """concurrency 人が同時にログインし続け、合計 logins 回検証するまでの結果を返す"""
+    latencies = []
+    probe = []
+    stop = threading.Event()
+    prober = threading.Thread(target=_other_session_probe, args=(stop, probe), daemon=True)
+    prober.start()
+
+    def login(_):
+        started = time.perf_counter()
+        assert verify(BENCH_PASSWORD, password_hash)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as sessions:
+        list(sessions.map(login, range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    prober.join()
+    return elapsed, latencies, probe
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ログイン (bcrypt 検証) のスループットベンチマーク")
+    parser.add_argument("--rounds", type=int, default=auth.BCRYPT_ROUNDS, help="bcrypt のコスト")
+    parser.add_argument("--logins", type=int, default=64, help="1回の計測で行うログインの数")
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 4, 16, 64], help="同時にログインするセッション数")
+    parser.add_argument("--modes", nargs="*", default=["inline", "pool"])
+    args = parser.parse_args(argv)
+
+    cores = os.cpu_count() or 1
+    password_hash = bcrypt.hashpw(BENCH_PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds=args.rounds)).decode('utf-8')
+    verifiers = {
+        'inline': lambda plain, hashed: bcrypt.checkpw(plain.encode('utf-8'), hashed.encode('utf-8')),
+        'pool': auth.verify_password,
+    }
+    print(f"rounds={args.rounds} cores={cores} auth_workers={auth.AUTH_WORKERS} logins={args.logins}")
+    header = (f"{'mode':<8}{'sessions':>9}{'logins/s':>11}{'per core':>10}"
+              f"{'p50':>9}{'p95':>9}{'other p95':>11}  (ms)")
+    print(header)
+    print("-" * len(header))
+    results = []
+    try:
+        for mode in args.modes:
+            for concurrency in args.concurrency:
+                elapsed, latencies, probe = run_burst(verifiers[mode], password_hash, args.logins, concurrency)
+                login_stats = summarize(f"{mode}_{concurrency}", latencies)
+                probe_stats = summarize(f"{mode}_{concurrency}_other", probe)
+                throughput = args.logins / elapsed
+                print(f"{mode:<8}{concurrency:>9}{throughput:>11.1f}{throughput / cores:>10.2f}"
+                      f"{login_stats['p50_ms']:>9.1f}{login_stats['p95_ms']:>9.1f}{probe_stats['p95_ms']:>11.2f}")
+                results.append(dict(login_stats, mode=mode, concurrency=concurrency,
+                                    logins_per_sec=throughput, logins_per_sec_per_core=throughput / cores,
+                                    other_session_p95_ms=probe_stats['p95_ms']))
+    finally:
+        auth.shutdown()
+    print(f"auth: {auth.get_stats()}")
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
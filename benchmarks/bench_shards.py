@@ -0,0 +1,99 @@
+# benchmarks/bench_shards.py
+"""
+書き込みが並行したときのスループット (writes/sec) をシャード数ごとに計測するベンチマーク。
+
+SQLite は1ファイルにつき同時に1つしか書き込めないため、全員が1ファイルに書くと書き込みが順番待ちになる。
+ユーザーを複数のシャード (ファイル) に振り分けると、別のシャードのユーザーは並行して書き込める。
+各ライターは自分のユーザーの日記を db.create_entry_and_emotions で保存し続ける (アプリの保存と同じ処理)。
+別々のアプリのプロセス (レプリカ) を想定し、ライターはプロセスで動かす (--threads でスレッドにもできる)。
+
+実行例 (リポジトリのルートで):
+    python -m benchmarks.bench_shards --writers 8 --writes 300 --shards 0 1 2 4 8
+    (--shards の 0 はシャーディングなし、つまり全員が DB_NAME の1ファイルに書く)
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, timedelta
+
+import db
+import init_db
+from benchmarks.common import summarize
+
+CHAT_LOG = "\n".join(f"あなた: ベンチマーク用の発言 {i}\nAI: なるほど。" for i in range(10))
+EMOTIONS = {'joy': 50, 'anger': 10, 'sadness': 20, 'anxiety': 30, 'relief': 40}
+
+
+def setup_database(db_path, writers, shard_count):
+    """一時DBを初期化し、ライターの数だけユーザーを作る (shard_count 個のシャードに振り分ける)"""
+    db.DB_NAME = db_path
+    db.SHARD_MODE = 'hash' if shard_count else 'none'
+    db.SHARD_COUNT = shard_count or 1
+    init_db.initialize_database()
+    user_ids = []
+    for n in range(writers):
+        db.create_user(f"shard_writer{n}", "x")
+        user_ids.append(db.get_user_by_username(f"shard_writer{n}")['id'])
+    for shard_id in db.list_shards():
+        db.get_shard_pool(shard_id) # シャードのファイルを作っておく
+    db.close_pool()
+    return user_ids
+
+
+def write_entries(db_path, user_id, writes):
+    """1人のユーザーの日記を writes 件保存し、1件ごとの所要時間 (秒) のリストを返す"""
+    db.DB_NAME = db_path
+    durations = []
+    start_date = date(2000, 1, 1)
+    for i in range(writes):
+        started = time.perf_counter()
+        assert db.create_entry_and_emotions(user_id, start_date + timedelta(days=i), CHAT_LOG, "要約", EMOTIONS)
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def run(shard_count, writers, writes, use_threads):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "bench.db")
+        user_ids = setup_database(db_path, writers, shard_count)
+        if use_threads:
+            executor = ThreadPoolExecutor(max_workers=writers)
+        else:
+            executor = ProcessPoolExecutor(max_workers=writers, mp_context=multiprocessing.get_context('spawn'))
+        with executor:
+            started = time.perf_counter()
+            futures = [executor.submit(write_entries, db_path, user_id, writes) for user_id in user_ids]
+            durations = [d for future in futures for d in future.result()]
+            elapsed = time.perf_counter() - started
+        db.close_pool()
+    return elapsed, durations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="シャード数ごとの並行書き込みスループット")
+    parser.add_argument("--writers", type=int, default=8, help="同時に書き込むライター (ユーザー) の数")
+    parser.add_argument("--writes", type=int, default=300, help="ライター1人あたりの保存回数")
+    parser.add_argument("--shards", type=int, nargs="*", default=[0, 1, 2, 4, 8], help="シャード数 (0 はシャーディングなし)")
+    parser.add_argument("--threads", action="store_true", help="ライターをプロセスではなくスレッドで動かす")
+    args = parser.parse_args(argv)
+
+    print(f"writers={args.writers} writes={args.writes} mode={'threads' if args.threads else 'processes'}")
+    header = f"{'shards':>7}{'writes/s':>11}{'p50':>9}{'p95':>9}{'p99':>9}  (ms)"
+    print(header)
+    print("-" * len(header))
+    results = []
+    for shard_count in args.shards:
+        elapsed, durations = run(shard_count, args.writers, args.writes, args.threads)
+        stats = summarize(f"shards={shard_count}", durations)
+        throughput = len(durations) / elapsed
+        print(f"{shard_count:>7}{throughput:>11,.0f}{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}")
+        results.append({**stats, 'shards': shard_count, 'writes_per_sec': throughput})
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
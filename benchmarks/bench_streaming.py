@@ -0,0 +1,65 @@
+# benchmarks/bench_streaming.py
+"""
+チャット応答のブロッキング取得とストリーミング取得で、最初の文字が表示できるまでの時間 (TTFT) と
+全文が揃うまでの時間を比較するベンチマーク。Gemini はローカルのスタブを使う。
+
+実行例 (リポジトリのルートで):
+    python -m benchmarks.bench_streaming --latency-ms 400 --chunk-latency-ms 40
+"""
+import argparse
+import sys
+import time
+
+import gemini_chat
+import gemini_client
+from benchmarks.common import print_results, summarize
+from benchmarks.fake_gemini import FakeGenerativeModel
+
+
+def measure_blocking(chat_history):
+    """get_chat_response は全文が揃うまで何も表示できないため、TTFT = 全体の時間"""
+    started = time.perf_counter()
+    gemini_chat.get_chat_response(chat_history[-1]['parts'][0], chat_history)
+    elapsed = time.perf_counter() - started
+    return elapsed, elapsed
+
+
+def measure_streaming(chat_history):
+    """stream_chat_response の最初の断片までの時間と、最後の断片までの時間を測る"""
+    started = time.perf_counter()
+    first = None
+    for _ in gemini_chat.stream_chat_response(chat_history):
+        if first is None:
+            first = time.perf_counter() - started
+    return first, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ストリーミング応答の TTFT ベンチマーク")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=400.0, help="最初の断片までのスタブ遅延")
+    parser.add_argument("--chunk-latency-ms", type=float, default=40.0, help="断片ごとのスタブ遅延")
+    args = parser.parse_args(argv)
+
+    fake = FakeGenerativeModel(latency=args.latency_ms / 1000, chunk_latency=args.chunk_latency_ms / 1000)
+    previous_model = gemini_chat.set_model(fake)
+    gemini_client.configure(rate_per_minute=0) # スタブ相手なのでレート制限はかけない
+    try:
+        results = []
+        for name, measure in (('blocking', measure_blocking), ('streaming', measure_streaming)):
+            ttft, total = [], []
+            for i in range(args.iterations):
+                history = [{'role': 'user', 'parts': [f"今日は散歩をしました ({i})"]}]
+                first, whole = measure(history)
+                ttft.append(first)
+                total.append(whole)
+            results.append(summarize(f"{name}_ttft", ttft))
+            results.append(summarize(f"{name}_total", total))
+    finally:
+        gemini_chat.set_model(previous_model)
+    print_results(results)
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
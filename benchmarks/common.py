@@ -0,0 +1,57 @@
+# benchmarks/common.py
+import json
+import math
+import time
+
+
+def percentile(sorted_values, pct):
+    """昇順ソート済みのリストから pct パーセンタイル (最近傍法) を返す"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(name, durations):
+    """計測した所要時間 (秒) のリストを、ミリ秒単位の統計に変換する"""
+    values = sorted(d * 1000 for d in durations)
+    return {
+        'scenario': name,
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) if values else 0.0,
+        'p50_ms': percentile(values, 50),
+        'p95_ms': percentile(values, 95),
+        'p99_ms': percentile(values, 99),
+        'max_ms': values[-1] if values else 0.0,
+    }
+
+
+def run_scenario(name, func, iterations, warmup=3):
+    """
+    func を warmup 回空打ちした後 iterations 回実行し、1回ごとの所要時間の統計を返す。
+    func には何回目の呼び出しか (0始まり) が渡される。
+    """
+    for i in range(warmup):
+        func(i)
+    durations = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        func(i)
+        durations.append(time.perf_counter() - started)
+    return summarize(name, durations)
+
+
+def print_results(results):
+    """統計結果を表形式で表示する"""
+    header = f"{'scenario':<20}{'count':>7}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<20}{r['count']:>7}{r['mean_ms']:>10.2f}{r['p50_ms']:>10.2f}"
+              f"{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['max_ms']:>10.2f}")
+
+
+def write_json(path, results, **metadata):
+    """統計結果を JSON ファイルに保存する (回帰比較用)"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'metadata': metadata, 'results': results}, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,182 @@
+# benchmarks/fake_gemini.py
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+
+try:
+    from google.api_core import exceptions as api_exceptions
+except ImportError: # google-generativeai が入っていない環境でもスタブは使えるようにする
+    api_exceptions = None
+
+# analyze_diary_entry のプロンプトに必ず含まれる区切り文字列
+ANALYSIS_MARKER = "--- 分析対象チャットログ ---"
+
+CANNED_CHAT_REPLIES = [
+    "そうだったんですね。そのとき、どんな気持ちになりましたか？",
+    "なるほど。他に印象に残ったことはありますか？",
+    "お疲れ様でした。明日はどんな一日にしたいですか？",
+]
+
+
+class FakeResponse:
+    """genai の GenerateContentResponse のうち、アプリが使う .text だけを持つ応答"""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeAPIError(Exception):
+    """google.api_core の例外の代わり (HTTP ステータスを .code に持つ)"""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def make_api_error(code, message):
+    """実際の SDK と同じ例外 (ResourceExhausted など) を作る"""
+    if api_exceptions is not None:
+        return api_exceptions.from_http_status(code, message)
+    return FakeAPIError(code, message)
+
+
+class FakeGenerativeModel:
+    """
+    genai.GenerativeModel の代わりに使う決定的なスタブ。
+    ネットワークに接続せず、設定した遅延の後に定型の応答を返す。
+    分析プロンプトには入力から決まる (毎回同じ) JSON を返す。
+    error_rate の割合で 429 (クォータ超過) などのエラーを返し、
+    request_options の timeout より遅延が長ければ 504 (期限切れ) にする。
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0, fenced_json=True, chunk_latency=0.0, chunk_size=8,
+                 error_rate=0.0, error_code=429, error_latency=0.0):
+        self.latency = latency # 最初の応答 (断片) が届くまでの秒数
+        self.jitter = jitter # 遅延のばらつき (秒、一様分布)
+        self.chunk_latency = chunk_latency # 断片1つを生成するのにかかる秒数
+        self.chunk_size = chunk_size # ストリーミング時の1断片の文字数
+        self.fenced_json = fenced_json # 実際の Gemini のように ```json で囲んで返す
+        self.error_rate = error_rate # エラーを返す割合 (0〜1)
+        self.error_code = error_code # 返すエラーの HTTP ステータス
+        self.error_latency = error_latency # エラーを返すまでの秒数
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.concurrent = 0 # 処理中の呼び出し数
+        self.max_concurrent = 0 # 同時に処理した呼び出し数の最大
+
+    def _draw(self):
+        """この呼び出しの遅延 (秒) と、エラーを返すかどうかを決める"""
+        with self._lock:
+            self.calls += 1
+            extra = self._rng.uniform(0, self.jitter) if self.jitter else 0.0
+            fail = bool(self.error_rate) and self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        return self.latency + extra, fail
+
+    def _error(self):
+        return make_api_error(self.error_code, "Resource has been exhausted (e.g. check quota). (スタブ)")
+
+    def _delay(self):
+        delay, fail = self._draw()
+        if fail:
+            time.sleep(self.error_latency)
+            raise self._error()
+        return delay
+
+    def _sleep_within(self, delay, timeout):
+        """delay 秒待つ。timeout の方が短ければ timeout 秒で期限切れにする"""
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise make_api_error(504, "Deadline Exceeded (スタブ)")
+        time.sleep(delay)
+
+    @staticmethod
+    def _prompt_text(contents):
+        if isinstance(contents, str):
+            return contents
+        # チャット履歴 ([{'role': ..., 'parts': [...]}, ...]) の場合
+        return "\n".join(str(part) for message in contents for part in message.get('parts', []))
+
+    def _respond(self, contents):
+        text = self._prompt_text(contents)
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        if ANALYSIS_MARKER in text:
+            emotions = {
+                key: digest[i] * 100 // 255
+                for i, key in enumerate(['joy', 'anger', 'sadness', 'anxiety', 'relief'])
+            }
+            body = json.dumps({"summary": "スタブによる要約です。穏やかな一日だった。", "emotions": emotions},
+                              ensure_ascii=False)
+            return f"```json\n{body}\n```" if self.fenced_json else body
+        return CANNED_CHAT_REPLIES[digest[0] % len(CANNED_CHAT_REPLIES)]
+
+    def _chunks(self, text):
+        return [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or [""]
+
+    def _stream(self, chunks, first_delay, timeout):
+        self._sleep_within(first_delay, timeout)
+        for i, chunk in enumerate(chunks):
+            if i > 0:
+                time.sleep(self.chunk_latency)
+            yield FakeResponse(chunk)
+
+    async def _stream_async(self, chunks, first_delay, timeout):
+        if timeout is not None and first_delay > timeout:
+            await asyncio.sleep(timeout)
+            raise make_api_error(504, "Deadline Exceeded (スタブ)")
+        await asyncio.sleep(first_delay)
+        for i, chunk in enumerate(chunks):
+            if i > 0:
+                await asyncio.sleep(self.chunk_latency)
+            yield FakeResponse(chunk)
+
+    def _track(self, delta):
+        with self._lock:
+            self.concurrent += delta
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+
+    def generate_content(self, contents, stream=False, request_options=None, **kwargs):
+        """
+        stream=False の場合は全文の生成が終わるまで待ってから返す。
+        stream=True の場合は断片 (.text を持つ) を順に返すイテレータを返す。
+        """
+        timeout = (request_options or {}).get('timeout')
+        delay = self._delay()
+        text = self._respond(contents)
+        chunks = self._chunks(text)
+        if stream:
+            return self._stream(chunks, delay, timeout)
+        self._track(1)
+        try:
+            self._sleep_within(delay + self.chunk_latency * (len(chunks) - 1), timeout)
+        finally:
+            self._track(-1)
+        return FakeResponse(text)
+
+    async def generate_content_async(self, contents, stream=False, request_options=None, **kwargs):
+        """generate_content の非同期版 (待ち時間中はイベントループを止めない)"""
+        timeout = (request_options or {}).get('timeout')
+        delay, fail = self._draw()
+        if fail:
+            await asyncio.sleep(self.error_latency)
+            raise self._error()
+        text = self._respond(contents)
+        chunks = self._chunks(text)
+        if stream:
+            return self._stream_async(chunks, delay, timeout)
+        total = delay + self.chunk_latency * (len(chunks) - 1)
+        self._track(1)
+        try:
+            if timeout is not None and total > timeout:
+                await asyncio.sleep(timeout)
+                raise make_api_error(504, "Deadline Exceeded (スタブ)")
+            await asyncio.sleep(total)
+        finally:
+            self._track(-1)
+        return FakeResponse(text)
@@ -0,0 +1,269 @@
+# benchmarks/run_benchmarks.py
+"""
+アプリの主要な操作をネットワークなしで計測するベンチマーク。
+
+合成データ (N ユーザー x M 年分の日記) を一時DBに作成し、Gemini はスタブに差し替えて
+ログイン / サイドバーの日記リスト / 日記詳細 / グラフ用データ / 保存 / rerun 全体 の
+所要時間を p50/p95/p99 で表示する。
+
+--backend postgres では --dsn (省略時は DIARY_DATABASE_URL) のサーバーに一時スキーマを作って同じシナリオを計測し、
+終了後にスキーマを削除する。
+
+実行例 (リポジトリのルートで):
+    python -m benchmarks.run_benchmarks --users 5 --years 3 --latency-ms 300
+    python -m benchmarks.run_benchmarks --backend postgres --dsn postgresql://diary@localhost/diary
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import tempfile
+from datetime import date
+import pandas as pd
+
+import add_dummy_data
+import analysis_worker
+import auth
+import db
+import diary_list
+import emotion_chart
+import emotion_index
+import gemini_chat
+import gemini_client
+import init_db
+import response_cache
+import session_store
+import tracing
+from benchmarks.common import print_results, run_scenario, write_json
+from benchmarks.fake_gemini import FakeGenerativeModel
+
+BENCH_PASSWORD = "bench-password"
+
+
+def setup_database(db_path, num_users, years, seed):
+    """一時DBを初期化し、合成ユーザーと日記を作成する。作成したユーザーIDのリストを返す。"""
+    if db.BACKEND == 'sqlite':
+        db.DB_NAME = db_path
+    init_db.initialize_database()
+    password_hash = auth.hash_password(BENCH_PASSWORD)
+    return add_dummy_data.populate_synthetic_users(num_users, years, password_hash, seed=seed,
+                                                   username_prefix="bench_user")
+
+
+def build_scenarios(user_ids, rng):
+    """シナリオ名 -> 1回分の処理 (引数は呼び出し回数) の辞書を作る"""
+    usernames = [f"bench_user{n + 1}" for n in range(len(user_ids))]
+    entry_owners = {entry['id']: user_id for user_id in user_ids for entry in db.get_entry_list_by_user(user_id)}
+    entry_ids = list(entry_owners)
+    chat_log = "\n".join(f"あなた: ベンチマーク用の発言 {i}\nAI: なるほど。" for i in range(10))
+    chat_turn_messages = [{'role': 'user', 'parts': ["ベンチマーク用の発言"]}, {'role': 'model', 'parts': ["なるほど。"]}]
+    chat_messages = chat_turn_messages * 10
+    chat_sessions = {} # chat_turn で追記し続けるユーザーごとのセッション
+    session_tokens = [session_store.create(user_id, username) for user_id, username in zip(user_ids, usernames)]
+
+    def login(i):
+        user = db.get_user_by_username(usernames[i % len(usernames)])
+        assert auth.verify_password(BENCH_PASSWORD, user['password_hash'])
+
+    def session_resume(i):
+        # 再読み込み・別のプロセスでのログイン状態の復元 (bcrypt の検証の代わりにトークンを確認する)
+        assert session_store.resolve(session_tokens[i % len(session_tokens)])
+
+    def sidebar_full(i):
+        # 以前のサイドバー: 全件を取得して1件ずつ日付を整形する
+        for entry in db.get_entry_list_by_user(user_ids[i % len(user_ids)]):
+            date.fromisoformat(entry['entry_date']).strftime('%Y年%m月%d日')
+
+    def sidebar(i):
+        # 現在のサイドバー: 年月一覧 (キャッシュ) と表示中の1ページだけを取得する
+        user_id = user_ids[i % len(user_ids)]
+        unanalyzed_entries = db.get_unanalyzed_entries_by_user(user_id)
+        for month, count in diary_list.get_months(user_id):
+            diary_list.format_month_label(month, count)
+        diary_list.get_page_options(user_id, unanalyzed_entries=unanalyzed_entries)
+
+    def entry_detail(i):
+        db.get_entry_details(rng.choice(entry_ids))
+
+    def chat_log_view(i):
+        # 日記詳細でチャットログを開いたとき (圧縮したログの展開)
+        db.get_chat_log(rng.choice(entry_ids))
+
+    def emotion_stats(i):
+        # グラフの上に表示する集計値 (書き込み時に更新済みの1行を読む)
+        db.get_user_emotion_stats(user_ids[i % len(user_ids)])
+
+    def emotion_stats_pandas(i):
+        # 集計テーブルがない場合: 全履歴を読み込んで pandas で直近7日・30日の平均を計算する
+        df = db.get_emotions_by_user(user_ids[i % len(user_ids)])
+        last = df['entry_date'].max()
+        for days in (7, 14, 30):
+            df[df['entry_date'] > last - pd.Timedelta(days=days)][db.EMOTION_KEYS].mean()
+
+    def similar_entries(i):
+        # 日記詳細の「似た気持ちだった日」 (メモリ上の行列から k 件)
+        entry_id = rng.choice(entry_ids)
+        emotion_index.find_similar_entries(entry_owners[entry_id], entry_id, k=5)
+
+    def similar_entries_scan(i):
+        # 行列を持たない場合: 全履歴を読み込んで距離を計算し、近い順に取り出す
+        df = db.get_emotions_by_user(user_ids[i % len(user_ids)])
+        target = df[db.EMOTION_KEYS].iloc[rng.randrange(len(df))]
+        (((df[db.EMOTION_KEYS] - target) ** 2).sum(axis=1) ** 0.5).nsmallest(6)
+
+    def graph_data(i):
+        db.get_emotions_by_user(user_ids[i % len(user_ids)])
+
+    def graph_render(i):
+        # キャッシュなしでクエリしてグラフを描き直す (全期間、間引きあり)
+        emotion_chart.render_emotion_chart(
+            db.get_emotion_series(user_ids[i % len(user_ids)], max_points=emotion_chart.DEFAULT_MAX_POINTS)
+        )
+
+    def graph_cached(i):
+        # 現在の rerun: データが変わっていなければキャッシュ済みの PNG を返す
+        emotion_chart.get_emotion_chart_png(user_ids[i % len(user_ids)])
+
+    def graph_series_raw(i):
+        # 全期間を LTTB で間引いて取得する
+        db.get_emotion_series(user_ids[i % len(user_ids)], max_points=emotion_chart.DEFAULT_MAX_POINTS)
+
+    def graph_series_month(i):
+        # 全期間を月ごとに集計して取得する
+        db.get_emotion_series(user_ids[i % len(user_ids)], rollup='month')
+
+    def chat_turn(i):
+        # チャットの1ターン分の追記 (発言と応答を chat_turns に保存する)
+        user_id = user_ids[i % len(user_ids)]
+        if user_id not in chat_sessions:
+            chat_sessions[user_id] = db.start_chat_session(user_id)
+        db.append_chat_turns(chat_sessions[user_id], 2 * i, chat_turn_messages)
+
+    def save(i):
+        # アプリの保存ボタン: ターンごとに保存済みの会話からログを作り、分析はバックグラウンドへ
+        user_id = user_ids[i % len(user_ids)]
+        session_id = db.start_chat_session(user_id)
+        db.append_chat_turns(session_id, 0, chat_messages + [{'role': 'user', 'parts': [f"(#{i})"]}])
+        entry_id = db.save_chat_session(session_id, user_id, date.today())
+        analysis_worker.submit(entry_id)
+
+    def analyze_repeat(i):
+        # 同じチャットログの再分析 (リトライ・二重クリック) はキャッシュから返る
+        summary, emotions = gemini_chat.analyze_diary_entry(chat_log)
+        assert summary and emotions
+
+    def save_blocking(i):
+        # 以前の保存処理: 分析が終わるまで待ってから保存する
+        summary, emotions = gemini_chat.analyze_diary_entry(f"{chat_log}\n(blocking #{i})")
+        assert summary and emotions
+        db.create_entry_and_emotions(user_ids[i % len(user_ids)], date.today(), chat_log, summary, emotions)
+
+    def rerun(i):
+        # ログイン後、日記を選択した状態での rerun 1回分の DB アクセスとグラフ表示
+        sidebar(i)
+        entry_detail(i)
+        emotion_stats(i)
+        graph_cached(i)
+
+    return {
+        'login': login,
+        'session_resume': session_resume,
+        'sidebar': sidebar,
+        'sidebar_full': sidebar_full,
+        'entry_detail': entry_detail,
+        'chat_log_view': chat_log_view,
+        'emotion_stats': emotion_stats,
+        'emotion_stats_pandas': emotion_stats_pandas,
+        'similar_entries': similar_entries,
+        'similar_entries_scan': similar_entries_scan,
+        'graph_data': graph_data,
+        'graph_series_raw': graph_series_raw,
+        'graph_series_month': graph_series_month,
+        'graph_render': graph_render,
+        'graph_cached': graph_cached,
+        'rerun': rerun,
+        'chat_turn': chat_turn,
+        'save': save,
+        'analyze_repeat': analyze_repeat,
+        'save_blocking': save_blocking,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="オフラインベンチマーク")
+    parser.add_argument("--users", type=int, default=5, help="合成ユーザー数")
+    parser.add_argument("--years", type=float, default=3, help="ユーザーごとの日記の年数")
+    parser.add_argument("--iterations", type=int, default=200, help="各シナリオの実行回数")
+    parser.add_argument("--login-iterations", type=int, default=10, help="ログインの実行回数 (bcrypt が遅いため別指定)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Gemini スタブの遅延 (ミリ秒)")
+    parser.add_argument("--scenarios", nargs="*", help="実行するシナリオ名 (省略時は全て)")
+    parser.add_argument("--db", help="使用するDBファイル (省略時は一時ファイル)")
+    parser.add_argument("--backend", choices=db.BACKENDS, default=db.BACKEND, help="ストレージのバックエンド")
+    parser.add_argument("--dsn", help="--backend postgres の接続先 (省略時は DIARY_DATABASE_URL)")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    parser.add_argument("--json", help="結果を保存する JSON ファイル")
+    parser.add_argument("--verbose", action="store_true", help="アプリのログ出力を表示する")
+    parser.add_argument("--trace", choices=["json", "prometheus"], help="区間ごとの計測結果 (tracing) を指定の形式で表示する")
+    args = parser.parse_args(argv)
+
+    tmp_dir = None
+    db_path = args.db
+    if not db_path:
+        tmp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(tmp_dir.name, "bench.db")
+
+    with contextlib.ExitStack() as stack:
+        if args.backend == 'postgres':
+            dsn = args.dsn or os.getenv("DIARY_DATABASE_URL")
+            if not dsn:
+                parser.error("--backend postgres には --dsn か DIARY_DATABASE_URL が必要です")
+            import storage_postgres
+            db.use_backend('postgres', stack.enter_context(storage_postgres.temporary_schema(dsn, prefix="diary_bench")))
+            stack.callback(db.use_backend, 'sqlite')
+            db_path = dsn
+        if args.verbose:
+            tracing.setup_logging()
+        else:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        user_ids = setup_database(db_path, args.users, args.years, args.seed)
+        previous_model = gemini_chat.set_model(FakeGenerativeModel(latency=args.latency_ms / 1000, seed=args.seed))
+        gemini_client.configure(rate_per_minute=0) # スタブ相手なのでレート制限はかけない
+        try:
+            scenarios = build_scenarios(user_ids, random.Random(args.seed))
+            results = []
+            for name, func in scenarios.items():
+                if args.scenarios and name not in args.scenarios:
+                    continue
+                iterations = args.login_iterations if name == 'login' else args.iterations
+                results.append(run_scenario(name, func, iterations, warmup=1 if name == 'login' else 3))
+            analysis_worker.wait_idle(timeout=60)
+        finally:
+            analysis_worker.shutdown()
+            gemini_chat.set_model(previous_model)
+            pool_stats = db.get_pool_stats()
+            db.close_pool()
+
+    print(f"users={args.users} years={args.years} gemini_latency={args.latency_ms}ms backend={args.backend} db={db_path}")
+    print_results(results)
+    print(f"connection pool: {pool_stats}")
+    print(f"response cache: {response_cache.get_stats()}")
+    print(f"emotion chart cache: {emotion_chart.get_stats()}")
+    print(f"emotion index: {emotion_index.get_stats()}")
+    print(f"auth: {auth.get_stats()}")
+    print(f"sessions: {session_store.get_stats()}")
+    print(f"gemini client: {gemini_client.get_stats()}")
+    if args.trace == 'json':
+        print(tracing.to_json(indent=2))
+    elif args.trace == 'prometheus':
+        print(tracing.to_prometheus(), end="")
+    if args.json:
+        write_json(args.json, results, users=args.users, years=args.years, latency_ms=args.latency_ms,
+                   backend=args.backend, pool=pool_stats)
+    if tmp_dir:
+        tmp_dir.cleanup()
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,212 @@
+# bulk_io.py
+"""
+日記の一括インポート・エクスポート (JSONL / CSV)。
+
+インポートはファイルを1行ずつ読み、batch_size 件ごとに1トランザクションで保存する (db.bulk_insert_entries)。
+同じユーザー・同じ日付の日記が既にあれば、その行は読み飛ばす (何度実行しても二重には登録されない)。
+エクスポートも ID 順に少しずつ読み込んで書き出すので、日記の件数が多くてもメモリを使い切らない。
+
+1行 (1件) の形式:
+    JSONL: {"username": "testuser", "entry_date": "2024-10-25", "chat_log": "...", "summary": "...",
+            "emotions": {"joy": 50, "anger": 5, "sadness": 15, "anxiety": 10, "relief": 20}}
+    CSV:   username,entry_date,chat_log,summary,joy,anger,sadness,anxiety,relief (ヘッダー行あり)
+ユーザーは user_id か username で指定する (ユーザーは事前に作成しておく)。
+要約がない日記は分析待ちとして保存し、アプリの起動時に analysis_worker が分析する。
+
+実行例:
+    python bulk_io.py import old_diaries.jsonl --batch-size 5000
+    python bulk_io.py export backup.csv --user testuser
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from datetime import date
+
+import db
+import tracing
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = 5000 # 1トランザクションで保存する件数
+EXPORT_BATCH_SIZE = 1000 # エクスポートで一度に読み込む件数
+PROGRESS_INTERVAL = 50000 # この件数ごとに進捗をログに出す
+MAX_INVALID_WARNINGS = 10 # 不正な行はこの件数までログに出す (以降は件数だけ数える)
+CSV_FIELDS = ['username', 'entry_date', 'chat_log', 'summary', *db.EMOTION_KEYS]
+
+
+class InvalidRecord(ValueError):
+    """インポートできない行 (必須項目の欠落、日付の形式違い、存在しないユーザー)"""
+
+
+def detect_format(path):
+    """拡張子から形式 ('jsonl' / 'csv') を決める"""
+    return 'csv' if os.path.splitext(path)[1].lower() == '.csv' else 'jsonl'
+
+
+def read_records(f, fmt):
+    """ファイルオブジェクトから1件ずつ dict を返すジェネレーター"""
+    if fmt == 'csv':
+        for row in csv.DictReader(f):
+            if any(row.get(k) not in (None, '') for k in db.EMOTION_KEYS):
+                row['emotions'] = {k: row.get(k) or 0 for k in db.EMOTION_KEYS}
+            yield row
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class UserResolver:
+    """username をユーザーIDに変換する (同じユーザーは一度だけ問い合わせる)"""
+
+    def __init__(self):
+        self._ids = {}
+
+    def __call__(self, record):
+        if record.get('user_id') not in (None, ''):
+            return int(record['user_id'])
+        username = record.get('username')
+        if not username:
+            raise InvalidRecord("user_id も username もありません。")
+        if username not in self._ids:
+            user = db.get_user_by_username(username)
+            self._ids[username] = user['id'] if user else None
+        if self._ids[username] is None:
+            raise InvalidRecord(f"ユーザー '{username}' が見つかりません。")
+        return self._ids[username]
+
+
+def normalize_record(record, resolve_user):
+    """読み込んだ1件を db.bulk_insert_entries に渡す形にする"""
+    try:
+        entry_date = date.fromisoformat(str(record['entry_date'])[:10]).isoformat()
+        chat_log = record['chat_log']
+    except (KeyError, ValueError) as e:
+        raise InvalidRecord(f"entry_date / chat_log が正しくありません: {e}")
+    emotions = record.get('emotions')
+    if emotions:
+        try:
+            emotions = {k: int(emotions.get(k) or 0) for k in db.EMOTION_KEYS}
+        except (TypeError, ValueError) as e:
+            raise InvalidRecord(f"感情スコアが数値ではありません: {e}")
+    return {
+        'user_id': resolve_user(record),
+        'entry_date': entry_date,
+        'chat_log': chat_log or '',
+        'summary': record.get('summary') or None,
+        'emotions': emotions or None,
+    }
+
+
+def import_entries(records, batch_size=IMPORT_BATCH_SIZE, progress_interval=PROGRESS_INTERVAL):
+    """
+    日記を batch_size 件ずつ保存する。
+    Returns:
+        dict: read (読んだ件数), inserted (保存した件数), skipped (既にあった日付), invalid (不正な行),
+              seconds, rows_per_sec
+    """
+    stats = {'read': 0, 'inserted': 0, 'skipped': 0, 'invalid': 0}
+    resolve_user = UserResolver()
+    started = time.perf_counter()
+    next_report = progress_interval
+    batch = []
+
+    def flush():
+        inserted, _ = db.bulk_insert_entries(batch)
+        stats['inserted'] += inserted
+        stats['skipped'] += len(batch) - inserted
+        batch.clear()
+
+    for record in records:
+        stats['read'] += 1
+        try:
+            batch.append(normalize_record(record, resolve_user))
+        except InvalidRecord as e:
+            stats['invalid'] += 1
+            if stats['invalid'] <= MAX_INVALID_WARNINGS:
+                logger.warning(f"{stats['read']} 件目を読み飛ばしました: {e}")
+        if len(batch) >= batch_size:
+            flush()
+        if stats['read'] >= next_report:
+            next_report += progress_interval
+            elapsed = time.perf_counter() - started
+            logger.info(f"インポート: {stats['read']:,} 件読み込み、{stats['inserted']:,} 件保存 "
+                        f"({stats['read'] / elapsed:,.0f} 件/秒)")
+    if batch:
+        flush()
+    stats['seconds'] = time.perf_counter() - started
+    stats['rows_per_sec'] = stats['read'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+
+def import_file(path, fmt=None, batch_size=IMPORT_BATCH_SIZE):
+    """JSONL / CSV ファイルの日記をインポートする (形式は省略時は拡張子から決める)"""
+    with open(path, encoding='utf-8', newline='') as f:
+        return import_entries(read_records(f, fmt or detect_format(path)), batch_size=batch_size)
+
+
+def export_entries(f, fmt='jsonl', user_id=None, progress_interval=PROGRESS_INTERVAL):
+    """日記を ID 順にファイルオブジェクトへ書き出し、(件数, 秒数) を返す"""
+    started = time.perf_counter()
+    count = 0
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+    for entry in db.iter_entries_for_export(user_id, batch_size=EXPORT_BATCH_SIZE):
+        record = {
+            'username': entry['username'], 'entry_date': entry['entry_date'],
+            'chat_log': entry['chat_log'], 'summary': entry['summary'], 'emotions': entry['emotions'],
+        }
+        if writer:
+            writer.writerow({**record, **(entry['emotions'] or {})})
+        else:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        count += 1
+        if count % progress_interval == 0:
+            logger.info(f"エクスポート: {count:,} 件 ({count / (time.perf_counter() - started):,.0f} 件/秒)")
+    return count, time.perf_counter() - started
+
+
+def export_file(path, fmt=None, username=None):
+    """日記を JSONL / CSV ファイルに書き出す (username を指定するとそのユーザーの日記だけ)"""
+    user_id = None
+    if username:
+        user = db.get_user_by_username(username)
+        if user is None:
+            raise InvalidRecord(f"ユーザー '{username}' が見つかりません。")
+        user_id = user['id']
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        return export_entries(f, fmt or detect_format(path), user_id=user_id)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="日記の一括インポート・エクスポート (JSONL / CSV)")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("path", help="読み込む / 書き出すファイル")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="ファイル形式 (省略時は拡張子から判断)")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="1トランザクションで保存する件数")
+    parser.add_argument("--user", help="エクスポートするユーザー名 (省略時は全ユーザー)")
+    parser.add_argument("--db", help="使用するDBファイル (省略時は diary_app.db)")
+    args = parser.parse_args(argv)
+
+    tracing.setup_logging()
+    if args.db:
+        db.DB_NAME = args.db
+    if args.command == "import":
+        stats = import_file(args.path, args.format, batch_size=args.batch_size)
+        print(f"{stats['read']:,} 件を読み込み、{stats['inserted']:,} 件を保存しました "
+              f"(既存の日付 {stats['skipped']:,} 件、不正な行 {stats['invalid']:,} 件)。"
+              f"({stats['seconds']:.1f} 秒、{stats['rows_per_sec']:,.0f} 件/秒)")
+    else:
+        count, seconds = export_file(args.path, args.format, username=args.user)
+        print(f"{count:,} 件の日記を書き出しました。({seconds:.1f} 秒、{count / seconds if seconds else 0:,.0f} 件/秒)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,163 +1,1920 @@
 # db.py
 import sqlite3
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import functools
+from typing import Protocol, runtime_checkable
 from datetime import date
+import numpy as np
 import pandas as pd
+from downsampling import lttb_multi_indices
+import log_codec
+import tracing
 
-DB_NAME = "diary_app.db"
+logger = logging.getLogger(__name__)
 
-def get_db_connection():
-    """データベース接続を取得する"""
-    conn = sqlite3.connect(DB_NAME)
+DB_NAME = os.getenv("DIARY_DB_PATH", "diary_app.db") # ユーザー (ディレクトリ) と、シャーディングしない場合は全てのデータ
+
+# --- シャーディングの設定 ---
+# 日記・感情スコア・チャットなどユーザーごとのデータを、users.shard_id が指す SQLite ファイルに置く。
+# シャード 0 は DB_NAME 自身 (シャーディング前からのユーザーはここに残る)、1 以降は SHARD_DIR 内の別ファイル。
+# SHARD_MODE は新しく作るユーザーの割り当て方: 'none' (全員シャード 0) / 'hash' (user_id を SHARD_COUNT 個に
+# 振り分ける) / 'user' (ユーザーごとに1ファイル)。既存のユーザーの移動は shard_tool.py で行う。
+SHARD_MODE = os.getenv("DIARY_SHARD_MODE", "none")
+SHARD_COUNT = int(os.getenv("DIARY_SHARD_COUNT", "4"))
+SHARD_DIR = os.getenv("DIARY_SHARD_DIR") # 省略時は DB_NAME の隣の <DB名>_shards/
+# entries / emotions / chat_sessions の ID の上位ビットにシャード番号を入れ、ID だけで置き場所がわかるようにする
+SHARD_ID_BITS = 40
+
+# --- 接続プールの設定 ---
+POOL_SIZE = int(os.getenv("DIARY_DB_POOL_SIZE", "8")) # 同時に開いておく接続の上限
+SHARD_POOL_SIZE = int(os.getenv("DIARY_SHARD_POOL_SIZE", "4")) # シャード1つあたりの接続の上限
+MAX_OPEN_SHARDS = 64 # 接続を開いておくシャードの数 (超えたら最も使われていないシャードの接続を閉じる)
+POOL_TIMEOUT = 30.0 # プールが空くまで待つ最大秒数
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",      # 読み取りが書き込みをブロックしないようにする
+    "PRAGMA synchronous=NORMAL",    # WAL では NORMAL で十分安全
+    "PRAGMA mmap_size=268435456",   # 256MB までメモリマップで読む
+    "PRAGMA cache_size=-16000",     # ページキャッシュ約16MB (負数は KiB 指定)
+)
+
+def get_db_connection(db_name=None):
+    """データベース接続を新しく開き、PRAGMA を設定して返す (プールからの利用が基本)"""
+    # プール経由でスレッド間を受け渡すため check_same_thread=False にする
+    conn = sqlite3.connect(db_name or DB_NAME, timeout=POOL_TIMEOUT, check_same_thread=False)
     conn.row_factory = sqlite3.Row # 列名でアクセスできるようにする
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
-def create_user(username, password_hash):
-    """新しいユーザーをデータベースに登録する"""
-    conn = get_db_connection()
+class ConnectionPool:
+    """
+    SQLite 接続を使い回すスレッドセーフなプール。
+    Streamlit のスクリプトスレッド間で共有し、毎回の open/close とキャッシュの冷えを避ける。
+    """
+
+    def __init__(self, db_name, max_size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.db_name = db_name
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue() # 直近に使った (キャッシュが温かい) 接続から再利用する
+        self._lock = threading.Lock()
+        self._open_count = 0
+        self._waiting = 0 # 返却を待っているスレッドの数
+        self._closed = False
+        self._stats = {'hits': 0, 'misses': 0, 'waits': 0}
+
+    def acquire(self):
+        """接続を1つ借りる。空きがなく上限に達している場合は返却を待つ。"""
+        if self._closed:
+            raise sqlite3.ProgrammingError("接続プールは既にクローズされています。")
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._stats['hits'] += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._open_count < self.max_size
+            if can_open:
+                self._open_count += 1
+                self._stats['misses'] += 1
+            else:
+                self._stats['waits'] += 1
+                self._waiting += 1 # 上限の判定と同じロックの中で数え、_discard が見落とさないようにする
+        if can_open:
+            try:
+                return get_db_connection(self.db_name)
+            except Exception:
+                with self._lock:
+                    self._open_count -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"{self.timeout}秒待っても接続プールに空きができませんでした。")
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def release(self, conn):
+        """借りた接続を返却する。未確定のトランザクションは破棄する。"""
+        if self._closed:
+            self._discard(conn)
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn) # 壊れた接続はプールに戻さない
+            return
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        """接続を閉じる。返却を待っているスレッドがいれば、代わりの接続を開いて渡す"""
+        try:
+            conn.close()
+        finally:
+            with self._lock:
+                replace = self._waiting > 0 and not self._closed
+                if not replace:
+                    self._open_count -= 1
+            if replace:
+                # 待っているスレッドは _idle への返却でしか起きないため、空いた枠の分をここで開く
+                try:
+                    self._idle.put(get_db_connection(self.db_name))
+                except Exception as e:
+                    logger.error(f"破棄した接続の代わりを開けませんでした: {e}")
+                    with self._lock:
+                        self._open_count -= 1
+
+    @contextmanager
+    def connection(self):
+        """with 文で接続を借り、ブロックを抜けたら自動で返却する"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """アイドル中の接続を全て閉じ、以降の貸し出しを止める"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def stats(self):
+        """プールの統計情報 (再利用数、新規接続数、待ち回数、接続数) を返す"""
+        with self._lock:
+            return dict(self._stats, open=self._open_count, idle=self._idle.qsize(), max_size=self.max_size)
+
+_pool = None
+_pool_lock = threading.Lock()
+_shard_pools = OrderedDict() # シャード番号 -> ConnectionPool (LRU、シャード 0 は _pool を使う)
+_shard_init_locks = {} # シャード番号 -> Lock (同じシャードの初期化を1回にする。他のシャードは待たせない)
+
+def get_pool():
+    """プロセス全体で共有する接続プールを返す (DB_NAME が変わったら作り直す)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_name != DB_NAME:
+            if _pool is not None:
+                _pool.close()
+            _close_shard_pools()
+            with _user_shards_lock:
+                _user_shards.clear()
+            _pool = ConnectionPool(DB_NAME)
+        return _pool
+
+def connection():
+    """プールから接続を借りるコンテキストマネージャ (ユーザー・応答キャッシュなど、シャード 0 の DB)"""
+    return get_pool().connection()
+
+def get_shard_dir():
+    return SHARD_DIR or os.path.splitext(DB_NAME)[0] + "_shards"
+
+def get_shard_path(shard_id):
+    """シャードの DB ファイルのパス (シャード 0 は DB_NAME)"""
+    if shard_id == 0:
+        return DB_NAME
+    return os.path.join(get_shard_dir(), f"shard-{shard_id:06d}.db")
+
+def shard_base_id(shard_id):
+    """シャードで採番する ID の始まり (このシャードの ID は全てこれより大きい)"""
+    return shard_id << SHARD_ID_BITS
+
+def shard_of_id(row_id):
+    """entries / chat_sessions の ID からシャード番号を求める"""
+    return int(row_id) >> SHARD_ID_BITS
+
+def _close_shard_pools():
+    while _shard_pools:
+        _shard_pools.popitem(last=False)[1].close()
+
+def get_shard_pool(shard_id):
+    """シャードの接続プールを返す。初めて使うシャードはファイルを作り、スキーマを適用する"""
+    if shard_id == 0:
+        return get_pool()
+    get_pool() # DB_NAME が変わっていればシャードのプールも作り直す
+    with _pool_lock:
+        pool = _shard_pools.get(shard_id)
+        if pool is not None:
+            _shard_pools.move_to_end(shard_id)
+            return pool
+        init_lock = _shard_init_locks.setdefault(shard_id, threading.Lock())
+    # ファイルの作成とスキーマの適用は時間がかかるため、_pool_lock を持たずにシャードごとのロックで行う
+    with init_lock:
+        with _pool_lock:
+            pool = _shard_pools.get(shard_id)
+            if pool is not None: # 同時に初期化した別のスレッドが作った
+                _shard_pools.move_to_end(shard_id)
+                return pool
+        import init_db # init_db は db を読み込むため、ここで読み込む
+        path = get_shard_path(shard_id)
+        init_db.initialize_shard(path, shard_base_id(shard_id))
+        with _pool_lock:
+            pool = _shard_pools[shard_id] = ConnectionPool(path, max_size=SHARD_POOL_SIZE)
+            while len(_shard_pools) > MAX_OPEN_SHARDS:
+                _shard_pools.popitem(last=False)[1].close() # 貸し出し中の接続は返却時に閉じられる
+        return pool
+
+@contextmanager
+def shard_connection(shard_id):
+    """シャードの接続を借りるコンテキストマネージャ"""
+    while True:
+        pool = get_shard_pool(shard_id)
+        try:
+            conn = pool.acquire()
+            break
+        except sqlite3.ProgrammingError:
+            if not pool._closed:
+                raise
+            # 取得した直後に LRU から外れて閉じられた: プールを取り直す
     try:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
-        conn.commit()
-        return True # 成功
-    except sqlite3.IntegrityError:
-        # UNIQUE 制約違反 (ユーザー名が既に存在する)
-        print(f"ユーザー名 '{username}' は既に使用されています。")
-        return False # 失敗
-    except sqlite3.Error as e:
-        print(f"ユーザー作成中にデータベースエラーが発生しました: {e}")
-        return False # 失敗
+        yield conn
     finally:
-        conn.close()
+        pool.release(conn)
+
+# ユーザーID -> シャード番号。ユーザーの移動 (shard_tool.py) はアプリを止めて行う前提で、プロセス内に保持する
+_user_shards = {}
+_user_shards_lock = threading.Lock()
+
+def get_user_shard(user_id):
+    """ユーザーのデータを置いているシャード番号を返す (存在しないユーザーは 0)"""
+    with _user_shards_lock:
+        shard_id = _user_shards.get(user_id)
+    if shard_id is not None:
+        return shard_id
+    with connection() as conn:
+        row = conn.execute("SELECT shard_id FROM users WHERE id = ?", (user_id,)).fetchone()
+    if row is None:
+        return 0
+    with _user_shards_lock:
+        _user_shards[user_id] = row[0]
+    return row[0]
+
+def user_connection(user_id):
+    """ユーザーのデータがあるシャードの接続を借りる"""
+    return shard_connection(get_user_shard(user_id))
+
+def id_connection(row_id):
+    """日記・チャットセッションの ID から、その行があるシャードの接続を借りる"""
+    return shard_connection(shard_of_id(row_id))
+
+def list_shards():
+    """データを置いているシャード番号の一覧 (0 を含む、昇順)"""
+    with connection() as conn:
+        rows = conn.execute("SELECT DISTINCT shard_id FROM users").fetchall()
+    return sorted({0, *(row[0] for row in rows)})
+
+def assign_shard(user_id, mode=None, shard_count=None):
+    """ユーザーを置くシャード番号 (省略時は SHARD_MODE, SHARD_COUNT の設定による)"""
+    mode = mode or SHARD_MODE
+    if mode == 'hash':
+        return 1 + user_id % (shard_count or SHARD_COUNT)
+    if mode == 'user':
+        return user_id
+    return 0
+
+def get_user_shards():
+    """全ユーザーの (ユーザーID, シャード番号) のリスト (ID 順)"""
+    with connection() as conn:
+        return [tuple(row) for row in conn.execute("SELECT id, shard_id FROM users ORDER BY id")]
+
+def get_shard_stats():
+    """シャードごとのユーザー数・日記の数・ファイルサイズ ({シャード番号: dict}) を返す"""
+    user_counts = {}
+    for _, shard_id in get_user_shards():
+        user_counts[shard_id] = user_counts.get(shard_id, 0) + 1
+    stats = {}
+    for shard_id in list_shards():
+        with shard_connection(shard_id) as conn:
+            entry_count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        stats[shard_id] = {
+            'users': user_counts.get(shard_id, 0), 'entries': entry_count,
+            'bytes': os.path.getsize(get_shard_path(shard_id)), 'path': get_shard_path(shard_id),
+        }
+    return stats
+
+def get_pool_stats():
+    """現在の接続プールの統計情報を返す (シャードがあれば shards にシャードごとの統計)"""
+    stats = get_pool().stats()
+    with _pool_lock:
+        shard_pools = list(_shard_pools.items())
+    if shard_pools:
+        stats['shards'] = {shard_id: pool.stats() for shard_id, pool in shard_pools}
+    return stats
+
+def close_pool():
+    """接続プールを閉じる (プロセス終了時に自動で呼ばれる)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        _close_shard_pools()
+    with _user_shards_lock:
+        _user_shards.clear()
+
+atexit.register(close_pool)
+
+# --- ユーザーごとのデータバージョン ---
+# 日記・感情スコアを書き込むたびに増やし、グラフ用データや描画結果のキャッシュの無効化に使う。
+# プロセス内でのみ有効 (別プロセスからの書き込みは検知しない)。
+_data_versions = {}
+_data_versions_lock = threading.Lock()
+
+def get_user_data_version(user_id):
+    """ユーザーのデータバージョンを返す (書き込みがあるたびに変わる)"""
+    with _data_versions_lock:
+        return _data_versions.get(user_id, 0)
+
+def mark_user_data_changed(user_id):
+    """ユーザーの日記・感情スコアが変わったことを記録し、キャッシュを無効にする"""
+    with _data_versions_lock:
+        _data_versions[user_id] = _data_versions.get(user_id, 0) + 1
+
+# 感情スコアを書き込んだときに呼ぶ関数 (emotion_index の類似検索用の行列を差分で更新する)。
+# 引数は (user_id, [(entry_id, entry_date, {感情: スコア}), ...])。コミット後に呼ぶ
+_emotion_listeners = []
+
+def add_emotion_listener(listener):
+    """感情スコアの書き込みを通知する関数を登録する"""
+    if listener not in _emotion_listeners:
+        _emotion_listeners.append(listener)
+
+def _notify_emotions_written(user_id, rows):
+    for listener in _emotion_listeners:
+        try:
+            listener(user_id, rows)
+        except Exception:
+            logger.exception("感情スコアの書き込みの通知中にエラーが発生しました。")
+
+EMOTION_KEYS = ['joy', 'anger', 'sadness', 'anxiety', 'relief']
+
+# --- ホットパスのクエリ ---
+# init_db.check_query_plans() が EXPLAIN QUERY PLAN でインデックス利用を確認するため、定数として定義しておく
+QUERY_USER_BY_USERNAME = "SELECT * FROM users WHERE username = ?"
+
+QUERY_ENTRY_LIST = """
+    SELECT id, entry_date
+    FROM entries
+    WHERE user_id = ?
+    ORDER BY entry_date DESC
+"""
+
+# 分析待ちの日記も表示できるよう、感情スコアは LEFT JOIN する (未分析なら NULL)
+# チャットログは含めない (画面で開いたときだけ get_chat_log で読み込む)
+QUERY_ENTRY_DETAILS = """
+    SELECT
+        e.id, e.user_id, e.entry_date, e.summary,
+        e.analysis_status, e.analysis_error,
+        em.joy, em.anger, em.sadness, em.anxiety, em.relief
+    FROM entries e
+    LEFT JOIN emotions em ON e.id = em.entry_id
+    WHERE e.id = ?
+"""
+
+QUERY_EMOTIONS_BY_USER = """
+    SELECT
+        e.entry_date,
+        em.joy,
+        em.anger,
+        em.sadness,
+        em.anxiety,
+        em.relief
+    FROM emotions em
+    JOIN entries e ON em.entry_id = e.id
+    WHERE e.user_id = ?
+    ORDER BY e.entry_date ASC
+"""
+
+# 期間指定の感情データ (idx_entries_user_date の範囲検索)
+QUERY_EMOTIONS_IN_RANGE = """
+    SELECT
+        e.entry_date,
+        em.joy,
+        em.anger,
+        em.sadness,
+        em.anxiety,
+        em.relief
+    FROM entries e
+    JOIN emotions em ON em.entry_id = e.id
+    WHERE e.user_id = ? AND e.entry_date BETWEEN ? AND ?
+    ORDER BY e.entry_date ASC
+"""
+
+# 集計単位ごとの期間の始まりを表す SQL 式 (週は月曜始まり)
+ROLLUP_BUCKETS = {
+    'day': "e.entry_date",
+    'week': "date(e.entry_date, '-6 days', 'weekday 1')",
+    'month': "strftime('%Y-%m-01', e.entry_date)",
+}
+
+def _rollup_query(rollup):
+    """日・週・月ごとに各感情の平均・最小・最大を計算するクエリを作る"""
+    aggregates = ",\n        ".join(
+        f"AVG(em.{k}) AS {k}, MIN(em.{k}) AS {k}_min, MAX(em.{k}) AS {k}_max" for k in EMOTION_KEYS
+    )
+    return f"""
+    SELECT
+        {ROLLUP_BUCKETS[rollup]} AS entry_date,
+        COUNT(*) AS entry_count,
+        {aggregates}
+    FROM entries e
+    JOIN emotions em ON em.entry_id = e.id
+    WHERE e.user_id = ? AND e.entry_date BETWEEN ? AND ?
+    GROUP BY 1
+    ORDER BY 1 ASC
+"""
+
+QUERY_FIRST_ENTRY_DATE = "SELECT MIN(entry_date) FROM entries WHERE user_id = ?"
+
+# サイドバーの日記リスト1ページ分 (キーセットページング)。
+# 同じ日付の日記が複数あっても漏れないよう、(entry_date, id) の組で前のページの続きから取得する
+QUERY_ENTRY_PAGE = """
+    SELECT id, entry_date
+    FROM entries
+    WHERE user_id = ? AND entry_date BETWEEN ? AND ? AND (entry_date, id) < (?, ?)
+    ORDER BY entry_date DESC, id DESC
+    LIMIT ?
+"""
+
+# 日記のある年月と件数 (月ナビゲーション用)
+QUERY_ENTRY_MONTHS = """
+    SELECT substr(entry_date, 1, 7) AS month, COUNT(*) AS entry_count
+    FROM entries
+    WHERE user_id = ?
+    GROUP BY month
+    ORDER BY month DESC
+"""
+
+# 全文検索 (FTS5 trigram)。rank の重み付けはマイグレーション 6 で設定している (要約の一致を重く評価)
+SEARCH_SNIPPET_TOKENS = 24 # スニペットの長さ (trigram なのでおおよその文字数)
+QUERY_SEARCH_ENTRIES = f"""
+    SELECT e.id, e.entry_date,
+           snippet(entries_fts, -1, '**', '**', '…', {SEARCH_SNIPPET_TOKENS}) AS snippet
+    FROM entries_fts
+    JOIN entries e ON e.id = entries_fts.rowid
+    WHERE entries_fts MATCH ? AND entries_fts.user_id = ?
+    ORDER BY entries_fts.rank
+    LIMIT ?
+"""
+
+def _like_search_query(term_count):
+    """
+    trigram は3文字未満の語を索引から引けないため、短い語はユーザーの日記だけを LIKE で走査する。
+    本文は entries_fts 側を参照する (rowid での1件参照なので索引を使う)。
+    """
+    conditions = " AND ".join(["(f.chat_log LIKE ? ESCAPE '\\' OR f.summary LIKE ? ESCAPE '\\')"] * term_count)
+    return f"""
+    SELECT e.id, e.entry_date, f.chat_log, f.summary
+    FROM entries e
+    JOIN entries_fts f ON f.rowid = e.id
+    WHERE e.user_id = ? AND {conditions}
+    ORDER BY e.entry_date DESC, e.id DESC
+    LIMIT ?
+"""
 
+# 圧縮したログ (entry_logs) がなければ、圧縮前に保存された entries.chat_log を使う
+QUERY_CHAT_LOG = """
+    SELECT l.codec, l.dict_id, l.data, e.chat_log
+    FROM entries e
+    LEFT JOIN entry_logs l ON l.entry_id = e.id
+    WHERE e.id = ?
+"""
+
+# 会話中のセッション (部分インデックス idx_chat_sessions_open を使う)
+QUERY_OPEN_CHAT_SESSION = """
+    SELECT id
+    FROM chat_sessions
+    WHERE user_id = ? AND status = ?
+    ORDER BY updated_at DESC
+    LIMIT 1
+"""
+
+QUERY_CHAT_TURNS = "SELECT seq, role, text FROM chat_turns WHERE session_id = ? ORDER BY seq"
+
+QUERY_ENTRY_BRIEF = "SELECT id, user_id, entry_date, analysis_status FROM entries WHERE id = ?"
+
+# 分析が終わっていない日記 (部分インデックス idx_entries_analysis_pending を使う)
+QUERY_UNANALYZED_BY_USER = """
+    SELECT id, analysis_status
+    FROM entries
+    WHERE user_id = ? AND analysis_status != 'done'
+"""
+
+# 起動時に一度だけ使う (部分インデックスの全走査だが、載っているのは未分析の行だけ)
+QUERY_UNANALYZED_ENTRIES = """
+    SELECT id, analysis_status
+    FROM entries
+    WHERE analysis_status != 'done'
+"""
+
+# 一括インポート: 同じユーザー・同じ日付の日記が既にあれば挿入しない (idx_entries_user_date で確認する)。
+# アプリからは同じ日に複数の日記を保存できるため、一意制約ではなくインポート時の条件にしている
+INSERT_ENTRY_IF_NEW = """
+    INSERT INTO entries (user_id, entry_date, chat_log, summary, analysis_status)
+    SELECT ?, ?, '', ?, ?
+    WHERE NOT EXISTS (SELECT 1 FROM entries WHERE user_id = ? AND entry_date = ?)
+"""
+
+QUERY_EXPORT_ENTRIES = """
+    SELECT
+        e.id, e.user_id, e.entry_date, e.summary, e.analysis_status, e.chat_log AS plain_log,
+        l.codec, l.dict_id, l.data,
+        em.joy, em.anger, em.sadness, em.anxiety, em.relief
+    FROM entries e
+    LEFT JOIN entry_logs l ON l.entry_id = e.id
+    LEFT JOIN emotions em ON em.entry_id = e.id
+    WHERE e.id > ? {user_filter}
+    ORDER BY e.id
+    LIMIT ?
+"""
+
+# 分析用エクスポート (emotion_export.py): 前回の続き (entries.id の範囲) の感情スコアを id 順に読む
+QUERY_EMOTIONS_AFTER_ID = """
+    SELECT e.id, e.user_id, e.entry_date, em.joy, em.anger, em.sadness, em.anxiety, em.relief
+    FROM entries e
+    JOIN emotions em ON em.entry_id = e.id
+    WHERE e.id > ? AND e.id < ?
+    ORDER BY e.id
+    LIMIT ?
+"""
+
+# ユーザーごとの集計値 (user_emotion_stats の1行を主キーで引く)
+QUERY_USER_EMOTION_STATS = "SELECT * FROM user_emotion_stats WHERE user_id = ?"
+QUERY_EMOTION_DATA_VERSION = "SELECT data_version FROM user_emotion_stats WHERE user_id = ?"
+
+# 直近の期間の名前 -> (何日前から, 何日前まで)。
+# user_emotion_stats には last_entry_date を 0 日前とした値を保存し、読み込むときは今日を 0 日前として数え直す
+STATS_WINDOWS = {'7d': (0, 7), 'prev_7d': (7, 14), '30d': (0, 30)}
+
+def _stats_window_query():
+    """user_emotion_daily の最大30行から、各期間の件数と感情ごとの平均を計算するクエリを作る"""
+    columns = []
+    for name, (start, end) in STATS_WINDOWS.items():
+        cond = f"entry_date <= date(:last, '-{start} days') AND entry_date > date(:last, '-{end} days')"
+        columns.append(f"IFNULL(SUM(CASE WHEN {cond} THEN entry_count END), 0) AS count_{name}")
+        columns += [
+            f"1.0 * SUM(CASE WHEN {cond} THEN {k}_sum END) / SUM(CASE WHEN {cond} THEN entry_count END) AS {k}_{name}"
+            for k in EMOTION_KEYS
+        ]
+    select_list = ",\n        ".join(columns)
+    span = max(end for _, end in STATS_WINDOWS.values())
+    return f"""
+    SELECT
+        {select_list}
+    FROM user_emotion_daily
+    WHERE user_id = :user_id AND entry_date <= :last AND entry_date > date(:last, '-{span} days')
+"""
+
+QUERY_STATS_WINDOWS = _stats_window_query()
+
+# 類似検索用の感情ベクトル (emotion_index.py がユーザーごとに一度だけ読み込む)
+QUERY_EMOTION_VECTORS = """
+    SELECT e.id, e.entry_date, em.joy, em.anger, em.sadness, em.anxiety, em.relief
+    FROM entries e
+    JOIN emotions em ON em.entry_id = e.id
+    WHERE e.user_id = ?
+"""
+
+# ログインセッション (毎回の rerun で主キーを1件引く。ほとんどは session_store のメモリ上のキャッシュで済む)
+QUERY_SESSION = "SELECT user_id, username, expires_at FROM sessions WHERE token_hash = ?"
+
+# クエリ名 -> (SQL, EXPLAIN 用のサンプルパラメータ)
+HOT_QUERIES = {
+    'get_user_by_username': (QUERY_USER_BY_USERNAME, ('testuser',)),
+    'get_entry_list_by_user': (QUERY_ENTRY_LIST, (1,)),
+    'get_entry_details': (QUERY_ENTRY_DETAILS, (1,)),
+    'get_emotions_by_user': (QUERY_EMOTIONS_BY_USER, (1,)),
+    'get_emotion_vectors': (QUERY_EMOTION_VECTORS, (1,)),
+    'get_unanalyzed_entries_by_user': (QUERY_UNANALYZED_BY_USER, (1,)),
+    'get_emotion_series (raw)': (QUERY_EMOTIONS_IN_RANGE, (1, '2024-01-01', '2024-12-31')),
+    'get_emotion_series (month)': (_rollup_query('month'), (1, '2024-01-01', '2024-12-31')),
+    'get_first_entry_date': (QUERY_FIRST_ENTRY_DATE, (1,)),
+    'get_entry_page': (QUERY_ENTRY_PAGE, (1, '2024-01-01', '2024-01-31', '2024-01-20', 100, 21)),
+    'get_entry_months': (QUERY_ENTRY_MONTHS, (1,)),
+    'get_entry_brief': (QUERY_ENTRY_BRIEF, (1,)),
+    'get_user_emotion_stats': (QUERY_USER_EMOTION_STATS, (1,)),
+    'get_emotion_data_version': (QUERY_EMOTION_DATA_VERSION, (1,)),
+    'user_emotion_stats (windows)': (QUERY_STATS_WINDOWS, {'user_id': 1, 'last': '2024-01-31'}),
+    'get_chat_log': (QUERY_CHAT_LOG, (1,)),
+    'get_open_chat_session': (QUERY_OPEN_CHAT_SESSION, (1, 'open')),
+    'bulk_insert_entries (dedupe)': (INSERT_ENTRY_IF_NEW, (1, '2024-01-01', None, 'pending', 1, '2024-01-01')),
+    'get_emotion_rows_after': (QUERY_EMOTIONS_AFTER_ID, (0, 2 ** 63 - 1, 50000)),
+    'iter_entries_for_export': (QUERY_EXPORT_ENTRIES.format(user_filter="AND +e.user_id = ?"), (0, 1, 1000)),
+    'iter_chat_turns': (QUERY_CHAT_TURNS, (1,)),
+    'search_entries': (QUERY_SEARCH_ENTRIES, ('"カフェ"', 1, 20)),
+    'search_entries_short': (_like_search_query(1), (1, '%雨%', '%雨%', 20)),
+    'get_session': (QUERY_SESSION, ('0' * 64,)),
+    'evict_expired_sessions': ("DELETE FROM sessions WHERE expires_at < ?", (0.0,)),
+}
+
+# --- チャットログの圧縮保存 ---
+LOG_DICT_REFRESH_SECONDS = 300.0 # 新しい共有辞書 (init_db --compress-chat-logs で作成) を確認する間隔
+# 共有辞書はシャードごとに作るため、(シャード番号, 辞書ID) をキーにする
+_log_dicts = {} # (シャード番号, 辞書ID) -> 辞書 (一度作った辞書は変わらないので、期限なしで保持する)
+_current_log_dicts = {} # シャード番号 -> (辞書ID, 辞書, 確認した時刻)。圧縮に使う最新の辞書
+_log_dicts_lock = threading.Lock()
+
+def _get_log_dict(conn, shard_id, dict_id):
+    with _log_dicts_lock:
+        zdict = _log_dicts.get((shard_id, dict_id))
+    if zdict is None:
+        row = conn.execute("SELECT data FROM log_dicts WHERE id = ?", (dict_id,)).fetchone()
+        if row is None:
+            raise LookupError(f"圧縮用の辞書 (シャード {shard_id}, ID {dict_id}) が見つかりません。")
+        zdict = row[0]
+        with _log_dicts_lock:
+            _log_dicts[(shard_id, dict_id)] = zdict
+    return zdict
+
+def _get_current_log_dict(conn, shard_id):
+    """シャードで圧縮に使う最新の共有辞書の (ID, 辞書) を返す (辞書がなければ (None, None))"""
+    with _log_dicts_lock:
+        dict_id, zdict, checked_at = _current_log_dicts.get(shard_id, (None, None, float('-inf')))
+    if time.monotonic() - checked_at < LOG_DICT_REFRESH_SECONDS:
+        return dict_id, zdict
+    row = conn.execute("SELECT id, data FROM log_dicts ORDER BY id DESC LIMIT 1").fetchone()
+    dict_id, zdict = row if row else (None, None)
+    with _log_dicts_lock:
+        _current_log_dicts[shard_id] = (dict_id, zdict, time.monotonic())
+        if dict_id is not None:
+            _log_dicts[(shard_id, dict_id)] = zdict
+    return dict_id, zdict
+
+def store_chat_log(conn, entry_id, user_id, chat_log, summary=None):
+    """
+    チャットログを圧縮して entry_logs に保存し、全文検索の索引に登録する。
+    entries の行は chat_log を空文字にして挿入しておくこと。commit は呼び出し側で行う。
+    """
+    dict_id, zdict = _get_current_log_dict(conn, shard_of_id(entry_id))
+    conn.execute(log_codec.INSERT_ENTRY_LOG, log_codec.entry_log_row(entry_id, chat_log, dict_id, zdict))
+    conn.execute(
+        "INSERT INTO entries_fts (rowid, chat_log, summary, user_id) VALUES (?, ?, ?, ?)",
+        (entry_id, chat_log, summary or '', user_id)
+    )
+
+def _read_chat_log(conn, entry_id):
+    row = conn.execute(QUERY_CHAT_LOG, (entry_id,)).fetchone()
+    if row is None:
+        return None
+    codec, dict_id, data, plain_log = row
+    if data is None:
+        return plain_log # 圧縮前に保存された日記
+    zdict = _get_log_dict(conn, shard_of_id(entry_id), dict_id) if dict_id is not None else None
+    return log_codec.decompress(data, codec, zdict)
+
+@tracing.traced()
+def get_chat_log(entry_id):
+    """日記のチャットログを展開して返す (見つからなければ None)"""
+    with id_connection(entry_id) as conn:
+        return _read_chat_log(conn, entry_id)
+
+@tracing.traced()
+def create_user(username, password_hash):
+    """新しいユーザーをデータベースに登録する"""
+    with connection() as conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
+            # 日記などを置くシャードを決める (ID が決まってから割り当てる)
+            shard_id = assign_shard(cursor.lastrowid)
+            if shard_id:
+                cursor.execute("UPDATE users SET shard_id = ? WHERE id = ?", (shard_id, cursor.lastrowid))
+            conn.commit()
+            return True # 成功
+        except sqlite3.IntegrityError:
+            # UNIQUE 制約違反 (ユーザー名が既に存在する)
+            logger.warning(f"ユーザー名 '{username}' は既に使用されています。")
+            return False # 失敗
+        except sqlite3.Error as e:
+            logger.error(f"ユーザー作成中にデータベースエラーが発生しました: {e}")
+            return False # 失敗
+
+@tracing.traced()
 def get_user_by_username(username):
     """ユーザー名でユーザー情報を取得する"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(QUERY_USER_BY_USERNAME, (username,))
+        user = cursor.fetchone()
     if user:
         return dict(user) # sqlite3.Row を dict に変換して返す
     else:
         return None # 見つからない場合は None
 
+@tracing.traced()
+def update_password_hash(user_id, old_hash, new_hash):
+    """
+    パスワードハッシュを作り直したものに置き換える (bcrypt のコスト変更時)。
+    同時に別のログインで置き換えられていた場合は何もしない。
+    """
+    with connection() as conn:
+        try:
+            cursor = conn.execute(
+                "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                (new_hash, user_id, old_hash)
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"パスワードハッシュの更新中にデータベースエラーが発生しました: {e}")
+            return False
+
+# --- ユーザーごとの感情スコアの集計 (user_emotion_stats) ---
+# 感情スコアを書き込むトランザクションの中で更新し、画面では1行読むだけにする
+_SUM_COLUMNS = ", ".join(f"{k}_sum" for k in EMOTION_KEYS)
+UPSERT_EMOTION_DAILY = f"""
+    INSERT INTO user_emotion_daily (user_id, entry_date, entry_count, {_SUM_COLUMNS})
+    VALUES (?, ?, ?, {", ".join("?" for _ in EMOTION_KEYS)})
+    ON CONFLICT (user_id, entry_date) DO UPDATE SET
+        entry_count = entry_count + excluded.entry_count,
+        {", ".join(f"{k}_sum = {k}_sum + excluded.{k}_sum" for k in EMOTION_KEYS)}
+"""
+
+def _compute_streak(conn, user_id, last_date):
+    """last_date から遡って、毎日日記を書いた日数を数える (連続が途切れたところで読むのをやめる)"""
+    streak = 0
+    expected = last_date
+    for row in conn.execute(
+        "SELECT entry_date FROM user_emotion_daily WHERE user_id = ? AND entry_date <= ? ORDER BY entry_date DESC",
+        (user_id, last_date.isoformat())
+    ):
+        if row[0] != expected.isoformat():
+            break
+        streak += 1
+        expected = date.fromordinal(expected.toordinal() - 1)
+    return streak
+
+def _write_emotion_stats(conn, user_id, entry_count, first_date, last_date, streak, totals):
+    """直近の期間の平均を user_emotion_daily から計算し、user_emotion_stats の行を書き込む (data_version は 1 増やす)"""
+    windows = dict(conn.execute(QUERY_STATS_WINDOWS, {'user_id': user_id, 'last': last_date.isoformat()}).fetchone())
+    values = {
+        'user_id': user_id, 'entry_count': entry_count, 'first_entry_date': first_date.isoformat(),
+        'last_entry_date': last_date.isoformat(), 'streak_days': streak, **windows,
+        **{f"{k}_total": totals[k] for k in EMOTION_KEYS},
+    }
+    columns = ", ".join(values)
+    placeholders = ", ".join(':' + c for c in values)
+    conn.execute(f"""
+        INSERT OR REPLACE INTO user_emotion_stats ({columns}, data_version)
+        VALUES ({placeholders}, IFNULL((SELECT data_version FROM user_emotion_stats WHERE user_id = :user_id), 0) + 1)
+    """, values)
+
+def _apply_emotion_stats(conn, user_id, changes):
+    """
+    感情スコアの追加・変更を集計に反映する (呼び出し側のトランザクション内で実行する)。
+    changes は (entry_date, 件数の増分, {感情: スコアの増分}) のリスト。
+    通常は今日の日記が1件増えるだけなので、連続日数と合計は前回の値から更新する。
+    """
+    if not changes:
+        return
+    conn.executemany(UPSERT_EMOTION_DAILY, [
+        (user_id, str(entry_date), count, *(deltas.get(k, 0) for k in EMOTION_KEYS))
+        for entry_date, count, deltas in changes
+    ])
+    dates = sorted({date.fromisoformat(str(entry_date)) for entry_date, count, _ in changes if count})
+    old = conn.execute(QUERY_USER_EMOTION_STATS, (user_id,)).fetchone()
+    if old is None:
+        entry_count, totals, first_date, last_date, streak = 0, dict.fromkeys(EMOTION_KEYS, 0), None, None, 0
+    else:
+        entry_count, streak = old['entry_count'], old['streak_days']
+        totals = {k: old[f"{k}_total"] for k in EMOTION_KEYS}
+        first_date = date.fromisoformat(old['first_entry_date'])
+        last_date = date.fromisoformat(old['last_entry_date'])
+    entry_count += sum(count for _, count, _ in changes)
+    for _, _, deltas in changes:
+        for k in EMOTION_KEYS:
+            totals[k] += deltas.get(k, 0)
+    if dates:
+        if last_date is not None and dates[0] >= last_date:
+            # 最後の日記の日以降の日付だけ: 連続日数を前回の値から伸ばす
+            previous = last_date
+            for day in dates:
+                if day == previous:
+                    continue
+                streak = streak + 1 if day.toordinal() == previous.toordinal() + 1 else 1
+                previous = day
+            last_date = dates[-1]
+        elif last_date is None or dates[0] < last_date:
+            # 過去の日付の追加 (インポートなど): 途切れていた連続がつながることがあるので数え直す
+            last_date = max(dates[-1], last_date or dates[-1])
+            streak = _compute_streak(conn, user_id, last_date)
+        first_date = min(dates[0], first_date or dates[0])
+    if last_date is None:
+        return
+    _write_emotion_stats(conn, user_id, entry_count, first_date, last_date, streak, totals)
+
+def _emotion_values(emotions):
+    return {k: emotions.get(k, 0) for k in EMOTION_KEYS}
+
+@tracing.traced()
+def get_user_emotion_stats(user_id, today=None):
+    """
+    ユーザーの感情スコアの集計値を dict で返す (日記がなければ None)。
+    entry_count, first_entry_date, last_entry_date, streak_days, count_7d / count_prev_7d / count_30d,
+    感情ごとの <感情>_7d / <感情>_prev_7d / <感情>_30d (平均、日記がない期間は None) と <感情>_mean (全期間の平均)。
+    直近の期間は today (省略時は今日) までの日数で数える。
+    """
+    today = (today or date.today()).isoformat()
+    with user_connection(user_id) as conn:
+        row = conn.execute(QUERY_USER_EMOTION_STATS, (user_id,)).fetchone()
+        if row is None or not row['entry_count']:
+            return None
+        stats = dict(row)
+        if stats['last_entry_date'] != today:
+            # 保存してある期間の値は最後に記録した日が基準なので、今日を基準に数え直す (最大30行を読む)
+            stats.update(dict(conn.execute(QUERY_STATS_WINDOWS, {'user_id': user_id, 'last': today}).fetchone()))
+    for k in EMOTION_KEYS:
+        stats[f"{k}_mean"] = stats.pop(f"{k}_total") / stats['entry_count']
+    return stats
+
+@tracing.traced()
+def get_emotion_data_version(user_id):
+    """
+    ユーザーの感情スコアのデータバージョン (集計を書き込むたびに増える。日記がなければ 0) を返す。
+    DB の値なので、別のプロセスでの書き込みでも変わる (emotion_chart のキャッシュキーに使う)。
+    """
+    with user_connection(user_id) as conn:
+        row = conn.execute(QUERY_EMOTION_DATA_VERSION, (user_id,)).fetchone()
+    return row[0] if row else 0
+
+@tracing.traced()
+def rebuild_emotion_stats(user_ids=None, batch_size=100):
+    """
+    entries と emotions から集計テーブルを作り直し、集計したユーザー数を返す。
+    user_ids を省略すると全ユーザー。シャードごとに、batch_size 人ずつコミットする。
+    """
+    if user_ids is None:
+        shard_users = {}
+        for shard_id in list_shards():
+            with shard_connection(shard_id) as conn:
+                shard_users[shard_id] = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM entries")]
+    else:
+        shard_users = _group_by_shard(user_ids)
+    for shard_id, shard_user_ids in shard_users.items():
+        with shard_connection(shard_id) as conn:
+            for i in range(0, len(shard_user_ids), batch_size):
+                for user_id in shard_user_ids[i:i + batch_size]:
+                    _rebuild_user_emotion_stats(conn, user_id)
+                conn.commit()
+    rebuilt = [user_id for shard_user_ids in shard_users.values() for user_id in shard_user_ids]
+    for user_id in rebuilt:
+        mark_user_data_changed(user_id)
+    return len(rebuilt)
+
+def _rebuild_user_emotion_stats(conn, user_id):
+    # user_emotion_stats の行は上書きする (data_version を続きから数えるため、先に削除しない)
+    conn.execute("DELETE FROM user_emotion_daily WHERE user_id = ?", (user_id,))
+    conn.execute(f"""
+        INSERT INTO user_emotion_daily (user_id, entry_date, entry_count, {_SUM_COLUMNS})
+        SELECT e.user_id, e.entry_date, COUNT(*), {", ".join(f"SUM(em.{k})" for k in EMOTION_KEYS)}
+        FROM entries e
+        JOIN emotions em ON em.entry_id = e.id
+        WHERE e.user_id = ?
+        GROUP BY e.entry_date
+    """, (user_id,))
+    row = conn.execute(f"""
+        SELECT SUM(entry_count), MIN(entry_date), MAX(entry_date),
+            {", ".join(f"SUM({k}_sum)" for k in EMOTION_KEYS)}
+        FROM user_emotion_daily
+        WHERE user_id = ?
+    """, (user_id,)).fetchone()
+    if not row[0]:
+        conn.execute("DELETE FROM user_emotion_stats WHERE user_id = ?", (user_id,))
+        return # 分析済みの日記がない
+    last_date = date.fromisoformat(row[2])
+    _write_emotion_stats(
+        conn, user_id, row[0], date.fromisoformat(row[1]), last_date,
+        _compute_streak(conn, user_id, last_date), dict(zip(EMOTION_KEYS, row[3:]))
+    )
+
+def _group_by_shard(user_ids):
+    """ユーザーIDをシャードごとに分ける ({シャード番号: [ユーザーID, ...]})"""
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(get_user_shard(user_id), []).append(user_id)
+    return groups
+
+@tracing.traced()
 def create_entry_and_emotions(user_id, entry_date, chat_log, summary, emotions):
     """
     日記エントリーと感情スコアをデータベースに保存する。
     トランザクション内で実行し、どちらかの保存に失敗したら両方ロールバックする。
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        # 1. entries テーブルに挿入
-        cursor.execute("""
-            INSERT INTO entries (user_id, entry_date, chat_log, summary)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, entry_date, chat_log, summary))
-
-        # 挿入されたエントリーのIDを取得
-        entry_id = cursor.lastrowid
-
-        # 2. emotions テーブルに挿入
-        cursor.execute("""
-            INSERT INTO emotions (entry_id, joy, anger, sadness, anxiety, relief)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (entry_id,
-              emotions.get('joy', 0),
-              emotions.get('anger', 0),
-              emotions.get('sadness', 0),
-              emotions.get('anxiety', 0),
-              emotions.get('relief', 0)))
+    with user_connection(user_id) as conn:
+        cursor = conn.cursor()
+        try:
+            # 1. entries テーブルに挿入 (チャットログは圧縮して entry_logs へ)
+            cursor.execute("""
+                INSERT INTO entries (user_id, entry_date, chat_log, summary)
+                VALUES (?, ?, '', ?)
+            """, (user_id, entry_date, summary))
+
+            # 挿入されたエントリーのIDを取得
+            entry_id = cursor.lastrowid
+            store_chat_log(conn, entry_id, user_id, chat_log, summary)
+
+            # 2. emotions テーブルに挿入
+            cursor.execute("""
+                INSERT INTO emotions (entry_id, joy, anger, sadness, anxiety, relief)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (entry_id,
+                  emotions.get('joy', 0),
+                  emotions.get('anger', 0),
+                  emotions.get('sadness', 0),
+                  emotions.get('anxiety', 0),
+                  emotions.get('relief', 0)))
+
+            # 3. 集計テーブルを更新
+            _apply_emotion_stats(conn, user_id, [(entry_date, 1, _emotion_values(emotions))])
 
+            conn.commit()
+            mark_user_data_changed(user_id)
+            _notify_emotions_written(user_id, [(entry_id, str(entry_date), _emotion_values(emotions))])
+            logger.debug(f"日記エントリー (ID: {entry_id}) と感情スコアが正常に保存されました。")
+            return entry_id
+
+        except sqlite3.Error as e:
+            logger.error(f"データベースへの保存中にエラーが発生しました: {e}")
+            conn.rollback() # エラーが発生したら変更を元に戻す
+            return None
+
+# --- 一括インポート・エクスポート (bulk_io.py から使う) ---
+@tracing.traced()
+def bulk_insert_entries(records):
+    """
+    日記をまとめて保存し、(挿入した件数, 日記が増えたユーザーIDの集合) を返す。
+    シャードごとに1トランザクションで保存する。
+    records は user_id, entry_date ('YYYY-MM-DD'), chat_log, summary, emotions (dict または None) を持つ dict。
+    要約がない日記は分析待ち (analysis_worker が再起動時に分析する) にする。
+    """
+    shard_records = {}
+    for r in records:
+        shard_records.setdefault(get_user_shard(r['user_id']), []).append(r)
+    inserted_count = 0
+    user_ids = set()
+    for shard_id, shard_batch in shard_records.items():
+        with shard_connection(shard_id) as conn:
+            fts_rows, written = _bulk_insert_shard(conn, shard_id, shard_batch)
+        inserted_count += len(fts_rows)
+        shard_user_ids = {row[3] for row in fts_rows}
+        for user_id in shard_user_ids:
+            mark_user_data_changed(user_id)
+        for user_id, rows in written.items():
+            _notify_emotions_written(user_id, rows)
+        user_ids |= shard_user_ids
+    return inserted_count, user_ids
+
+def _bulk_insert_shard(conn, shard_id, records):
+    """1つのシャードに日記をまとめて保存し、(全文検索の索引に登録した行, ユーザーごとの感情スコア) を返す"""
+    try:
+        # 挿入した行を id で見分けるため、最初に書き込みロックを取っておく
+        conn.execute("BEGIN IMMEDIATE")
+        last_id = conn.execute("SELECT IFNULL(MAX(id), 0) FROM entries").fetchone()[0]
+        conn.executemany(INSERT_ENTRY_IF_NEW, [
+            (r['user_id'], r['entry_date'], r['summary'],
+             ANALYSIS_DONE if r['summary'] else ANALYSIS_PENDING, r['user_id'], r['entry_date'])
+            for r in records
+        ])
+        inserted = {
+            (row['user_id'], row['entry_date']): row['id']
+            for row in conn.execute("SELECT id, user_id, entry_date FROM entries WHERE id > ?", (last_id,))
+        }
+        dict_id, zdict = _get_current_log_dict(conn, shard_id)
+        log_rows, fts_rows, emotion_rows = [], [], []
+        stats_changes = {} # ユーザーID -> 集計テーブルへの変更
+        written = {} # ユーザーID -> 書き込んだ感情スコア (コミット後に通知する)
+        for r in records:
+            entry_id = inserted.pop((r['user_id'], r['entry_date']), None)
+            if entry_id is None:
+                continue # 既にあった日付 (バッチ内の重複を含む)
+            log_rows.append(log_codec.entry_log_row(entry_id, r['chat_log'], dict_id, zdict))
+            fts_rows.append((entry_id, r['chat_log'], r['summary'] or '', r['user_id']))
+            if r['emotions']:
+                values = _emotion_values(r['emotions'])
+                emotion_rows.append((entry_id, *values.values()))
+                stats_changes.setdefault(r['user_id'], []).append((r['entry_date'], 1, values))
+                written.setdefault(r['user_id'], []).append((entry_id, r['entry_date'], values))
+        conn.executemany(log_codec.INSERT_ENTRY_LOG, log_rows)
+        conn.executemany(
+            "INSERT INTO entries_fts (rowid, chat_log, summary, user_id) VALUES (?, ?, ?, ?)", fts_rows
+        )
+        conn.executemany(
+            "INSERT INTO emotions (entry_id, joy, anger, sadness, anxiety, relief) VALUES (?, ?, ?, ?, ?, ?)",
+            emotion_rows
+        )
+        for user_id, changes in stats_changes.items():
+            _apply_emotion_stats(conn, user_id, changes)
         conn.commit()
-        print(f"日記エントリー (ID: {entry_id}) と感情スコアが正常に保存されました。")
-        return entry_id
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return fts_rows, written
 
-    except sqlite3.Error as e:
-        print(f"データベースへの保存中にエラーが発生しました: {e}")
-        conn.rollback() # エラーが発生したら変更を元に戻す
-        return None
-    finally:
-        conn.close()
+def iter_entries_for_export(user_id=None, batch_size=1000):
+    """
+    日記を ID 順に1件ずつ dict で返すジェネレーター (チャットログは展開済み、感情スコアは未分析なら None)。
+    シャードごとに batch_size 件ずつ読み込み、読み込みの合間は接続をプールに返す。
+    """
+    # ユーザーで絞るときも id 順に読む (+ で idx_entries_user_date を使わせず、並べ替えを避ける)
+    sql = QUERY_EXPORT_ENTRIES.format(user_filter="AND +e.user_id = ?" if user_id is not None else "")
+    usernames = {} # ユーザー名はシャード 0 の users から引く
+    for shard_id in [get_user_shard(user_id)] if user_id is not None else list_shards():
+        last_id = shard_base_id(shard_id)
+        while True:
+            params = (last_id, user_id, batch_size) if user_id is not None else (last_id, batch_size)
+            entries = []
+            with shard_connection(shard_id) as conn:
+                for row in conn.execute(sql, params).fetchall():
+                    if row['data'] is None:
+                        chat_log = row['plain_log'] # 圧縮前に保存された日記
+                    else:
+                        zdict = _get_log_dict(conn, shard_id, row['dict_id']) if row['dict_id'] is not None else None
+                        chat_log = log_codec.decompress(row['data'], row['codec'], zdict)
+                    emotions = None if row['joy'] is None else {k: row[k] for k in EMOTION_KEYS}
+                    entries.append({
+                        'id': row['id'], 'user_id': row['user_id'],
+                        'entry_date': row['entry_date'], 'summary': row['summary'],
+                        'analysis_status': row['analysis_status'], 'chat_log': chat_log, 'emotions': emotions,
+                    })
+            if not entries:
+                break
+            missing = {entry['user_id'] for entry in entries} - usernames.keys()
+            if missing:
+                with connection() as conn:
+                    usernames.update(conn.execute(
+                        f"SELECT id, username FROM users WHERE id IN ({', '.join('?' for _ in missing)})", list(missing)
+                    ).fetchall())
+            for entry in entries:
+                entry['username'] = usernames.get(entry['user_id'])
+                yield entry
+            last_id = entries[-1]['id']
 
+@tracing.traced()
 def get_emotions_by_user(user_id):
     """
     指定されたユーザーIDの全ての日記エントリーに対応する感情データを取得し、
     日付順にソートされた Pandas DataFrame として返す。
     """
-    conn = get_db_connection()
-    query = """
-        SELECT
-            e.entry_date,
-            em.joy,
-            em.anger,
-            em.sadness,
-            em.anxiety,
-            em.relief
-        FROM emotions em
-        JOIN entries e ON em.entry_id = e.id
-        WHERE e.user_id = ?
-        ORDER BY e.entry_date ASC
-    """
     try:
-        df = pd.read_sql_query(query, conn, params=(user_id,))
+        with user_connection(user_id) as conn:
+            df = pd.read_sql_query(QUERY_EMOTIONS_BY_USER, conn, params=(user_id,))
         if not df.empty:
             df['entry_date'] = pd.to_datetime(df['entry_date'])
-        print(f"ユーザーID {user_id} の感情データを {len(df)} 件取得しました。")
+        logger.debug(f"ユーザーID {user_id} の感情データを {len(df)} 件取得しました。")
         return df
     except Exception as e:
-        print(f"感情データの取得中にエラーが発生しました: {e}")
+        logger.error(f"感情データの取得中にエラーが発生しました: {e}")
         return pd.DataFrame(columns=['entry_date', 'joy', 'anger', 'sadness', 'anxiety', 'relief'])
-    finally:
-        if conn:
-            conn.close()
 
+@tracing.traced()
+def get_emotion_vectors(user_id):
+    """
+    ユーザーの感情スコアを (エントリーIDの配列, 日付のリスト, 感情スコアの行列 (件数 x 5, float32)) で返す。
+    行列の列の順は EMOTION_KEYS と同じ。
+    """
+    with user_connection(user_id) as conn:
+        rows = conn.execute(QUERY_EMOTION_VECTORS, (user_id,)).fetchall()
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    dates = [row[1] for row in rows]
+    vectors = np.array([tuple(row)[2:] for row in rows], dtype=np.float32).reshape(len(rows), len(EMOTION_KEYS))
+    return ids, dates, vectors
+
+@tracing.traced()
+def get_emotion_rows_after(after_id, limit, before_id=None):
+    """
+    entries.id が after_id より大きく before_id より小さい日記の感情スコアを id 順に最大 limit 件返す。
+    読むのは after_id が属するシャードだけ (シャードごとに shard_base_id から順に読む)。
+    各行は (id, user_id, entry_date, joy, anger, sadness, anxiety, relief) のタプル。
+    """
+    with id_connection(after_id) as conn:
+        rows = conn.execute(QUERY_EMOTIONS_AFTER_ID,
+                            (after_id, before_id if before_id is not None else 2 ** 63 - 1, limit)).fetchall()
+    return [tuple(row) for row in rows]
+
+@tracing.traced()
+def get_first_pending_entry_id(after_id=0):
+    """after_id より後で分析待ちの日記のうち、after_id と同じシャードで最小のIDを返す (なければ None)"""
+    with id_connection(after_id) as conn:
+        # 部分インデックス idx_entries_analysis_pending に載っている行だけを見る
+        row = conn.execute(
+            "SELECT MIN(id) FROM entries WHERE analysis_status != 'done' AND analysis_status = ? AND id > ?",
+            (ANALYSIS_PENDING, after_id)
+        ).fetchone()
+    return row[0]
+
+@tracing.traced()
+def get_emotion_series(user_id, start=None, end=None, max_points=None, rollup='raw'):
+    """
+    指定期間の感情データをグラフ表示用に取得し、Pandas DataFrame で返す。
+    Args:
+        user_id (int): ユーザーID。
+        start, end (date or str): 期間 (両端を含む)。省略時は制限なし。
+        max_points (int): rollup='raw' のとき、これを超える点数は LTTB 法で間引く。
+        rollup (str): 'raw' (日記ごと) / 'day' / 'week' / 'month'。
+            集計時は各感情の平均 (joy など) に加えて最小・最大 (joy_min, joy_max) と件数 (entry_count) を返す。
+    """
+    start = str(start) if start else '0000-01-01'
+    end = str(end) if end else '9999-12-31'
+    query = QUERY_EMOTIONS_IN_RANGE if rollup == 'raw' else _rollup_query(rollup)
+    try:
+        with user_connection(user_id) as conn:
+            df = pd.read_sql_query(query, conn, params=(user_id, start, end))
+        if not df.empty:
+            df['entry_date'] = pd.to_datetime(df['entry_date'])
+            if rollup == 'raw' and max_points and len(df) > max_points:
+                x = df['entry_date'].to_numpy(dtype='datetime64[D]').astype(np.int64)
+                series = [df[k].to_numpy(dtype=float) for k in EMOTION_KEYS]
+                df = df.iloc[lttb_multi_indices(x, series, max_points)].reset_index(drop=True)
+        logger.debug(f"ユーザーID {user_id} の感情データ ({rollup}, {start}〜{end}) を {len(df)} 件取得しました。")
+        return df
+    except Exception as e:
+        logger.error(f"感情データの取得中にエラーが発生しました: {e}")
+        return pd.DataFrame(columns=['entry_date'] + EMOTION_KEYS)
+
+@tracing.traced()
+def get_first_entry_date(user_id):
+    """ユーザーの最初の日記の日付を返す (日記がなければ None)"""
+    with user_connection(user_id) as conn:
+        row = conn.execute(QUERY_FIRST_ENTRY_DATE, (user_id,)).fetchone()
+    return date.fromisoformat(row[0]) if row and row[0] else None
+
+@tracing.traced()
 def get_entry_list_by_user(user_id):
     """
     指定されたユーザーIDの日記エントリーのリスト（IDと日付）を日付の降順で取得する。
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
     entries = []
+    with user_connection(user_id) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(QUERY_ENTRY_LIST, (user_id,))
+            entries = [{'id': row['id'], 'entry_date': row['entry_date']} for row in cursor.fetchall()]
+            logger.debug(f"ユーザーID {user_id} の日記リストを {len(entries)} 件取得しました。")
+        except sqlite3.Error as e:
+            logger.error(f"日記リストの取得中にエラーが発生しました: {e}")
+    return entries
+
+ENTRY_PAGE_SIZE = 20 # サイドバーに一度に表示する日記の数
+
+@tracing.traced()
+def get_entry_page(user_id, month=None, before=None, limit=ENTRY_PAGE_SIZE):
+    """
+    日記リストを新しい順に1ページ分だけ取得する (キーセットページング)。
+    Args:
+        user_id (int): ユーザーID。
+        month (str): 'YYYY-MM' を指定するとその月の日記だけを対象にする。
+        before (tuple): 前のページの next_cursor。このカーソルより古い日記を返す。
+        limit (int): 1ページの件数。
+    Returns:
+        list: [{'id', 'entry_date'}, ...] (日付の降順)。
+        tuple: 次のページのカーソル (続きがなければ None)。
+    """
+    start, end = (f"{month}-01", f"{month}-31") if month else ('0000-01-01', '9999-12-31')
+    before_date, before_id = before or ('9999-12-31', 2 ** 63 - 1)
+    with user_connection(user_id) as conn:
+        # 1件多く取得して、次のページがあるかを判定する
+        rows = conn.execute(QUERY_ENTRY_PAGE, (user_id, start, end, before_date, before_id, limit + 1)).fetchall()
+    entries = [{'id': row['id'], 'entry_date': row['entry_date']} for row in rows[:limit]]
+    next_cursor = (entries[-1]['entry_date'], entries[-1]['id']) if len(rows) > limit else None
+    return entries, next_cursor
+
+@tracing.traced()
+def get_entry_months(user_id):
+    """日記のある年月 ('YYYY-MM') と件数のリストを新しい順に返す"""
+    with user_connection(user_id) as conn:
+        rows = conn.execute(QUERY_ENTRY_MONTHS, (user_id,)).fetchall()
+    return [(row['month'], row['entry_count']) for row in rows]
+
+@tracing.traced()
+def get_entry_brief(entry_id):
+    """エントリーの日付と分析状態だけを取得する (チャットログなどは読まない)"""
+    with id_connection(entry_id) as conn:
+        row = conn.execute(QUERY_ENTRY_BRIEF, (entry_id,)).fetchone()
+    return dict(row) if row else None
+
+SEARCH_MIN_TERM_LENGTH = 3 # trigram で索引を引ける最短の語の長さ
+
+def _split_search_terms(query):
+    """検索語を空白 (全角含む) で区切る"""
+    return [term for term in query.replace('\u3000', ' ').split(' ') if term]
+
+def _make_snippet(text, terms, width=SEARCH_SNIPPET_TOKENS):
+    """LIKE 検索の結果から、最初に一致した語の前後を切り出して強調する"""
+    text = text or ''
+    positions = [(text.find(term), term) for term in terms if term in text]
+    if not positions:
+        return None
+    position, term = min(positions)
+    start = max(0, position - width // 2)
+    end = min(len(text), position + len(term) + width // 2)
+    snippet = text[start:end].replace(term, f"**{term}**")
+    return ('…' if start > 0 else '') + snippet + ('…' if end < len(text) else '')
+
+@tracing.traced()
+def search_entries(user_id, query, limit=20):
+    """
+    ユーザーの日記 (チャットログと要約) を全文検索する。
+    空白で区切った語は全てを含む日記 (AND) に一致する。
+    Args:
+        user_id (int): ユーザーID。
+        query (str): 検索語。
+        limit (int): 返す件数の上限。
+    Returns:
+        list: [{'id', 'entry_date', 'snippet'}, ...]。
+              3文字以上の語だけなら関連度順、それ以外は新しい順。snippet は一致箇所を ** で囲む。
+    """
+    terms = _split_search_terms(query or '')
+    if not terms:
+        return []
     try:
-        cursor.execute("""
-            SELECT id, entry_date
-            FROM entries
-            WHERE user_id = ?
-            ORDER BY entry_date DESC
-        """, (user_id,))
-        entries = [{'id': row['id'], 'entry_date': row['entry_date']} for row in cursor.fetchall()]
-        print(f"ユーザーID {user_id} の日記リストを {len(entries)} 件取得しました。")
+        with user_connection(user_id) as conn:
+            if all(len(term) >= SEARCH_MIN_TERM_LENGTH for term in terms):
+                # 各語をフレーズとして引用し、FTS5 の演算子として解釈されないようにする
+                match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+                rows = conn.execute(QUERY_SEARCH_ENTRIES, (match, user_id, limit)).fetchall()
+                return [{'id': row['id'], 'entry_date': row['entry_date'], 'snippet': row['snippet']} for row in rows]
+
+            params = [user_id]
+            for term in terms:
+                pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                params += [pattern, pattern]
+            rows = conn.execute(_like_search_query(len(terms)), (*params, limit)).fetchall()
     except sqlite3.Error as e:
-        print(f"日記リストの取得中にエラーが発生しました: {e}")
-    finally:
-        conn.close()
-    return entries
+        logger.error(f"日記の検索中にエラーが発生しました: {e}")
+        return []
+    return [
+        {
+            'id': row['id'],
+            'entry_date': row['entry_date'],
+            'snippet': _make_snippet(row['summary'], terms) or _make_snippet(row['chat_log'], terms),
+        }
+        for row in rows
+    ]
 
+@tracing.traced()
 def get_entry_details(entry_id):
     """
     指定されたエントリーIDの日記詳細情報（エントリー内容と感情スコア）を取得する。
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
     details = None
-    try:
-        cursor.execute("""
-            SELECT
-                e.id, e.user_id, e.entry_date, e.chat_log, e.summary,
-                em.joy, em.anger, em.sadness, em.anxiety, em.relief
-            FROM entries e
-            JOIN emotions em ON e.id = em.entry_id
-            WHERE e.id = ?
-        """, (entry_id,))
-        row = cursor.fetchone()
-        if row:
-            details = dict(row)
-            print(f"エントリーID {entry_id} の詳細を取得しました。")
+    with id_connection(entry_id) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(QUERY_ENTRY_DETAILS, (entry_id,))
+            row = cursor.fetchone()
+            if row:
+                details = dict(row)
+                logger.debug(f"エントリーID {entry_id} の詳細を取得しました。")
+            else:
+                logger.debug(f"エントリーID {entry_id} の詳細が見つかりませんでした。")
+        except sqlite3.Error as e:
+            logger.error(f"日記詳細の取得中にエラーが発生しました: {e}")
+    return details
+
+# --- バックグラウンド分析用 ---
+ANALYSIS_PENDING = 'pending'
+ANALYSIS_DONE = 'done'
+ANALYSIS_FAILED = 'failed'
+
+@tracing.traced()
+def create_pending_entry(user_id, entry_date, chat_log):
+    """
+    分析前の日記エントリーをチャットログだけで保存し、エントリーIDを返す。
+    要約と感情スコアは analysis_worker が後から complete_entry_analysis で書き込む。
+    """
+    with user_connection(user_id) as conn:
+        try:
+            cursor = conn.execute("""
+                INSERT INTO entries (user_id, entry_date, chat_log, summary, analysis_status)
+                VALUES (?, ?, '', NULL, ?)
+            """, (user_id, entry_date, ANALYSIS_PENDING))
+            store_chat_log(conn, cursor.lastrowid, user_id, chat_log)
+            conn.commit()
+            mark_user_data_changed(user_id)
+            logger.debug(f"日記エントリー (ID: {cursor.lastrowid}) を分析待ちとして保存しました。")
+            return cursor.lastrowid
+        except sqlite3.Error as e:
+            logger.error(f"データベースへの保存中にエラーが発生しました: {e}")
+            conn.rollback()
+            return None
+
+# --- 進行中のチャット (ターンごとに追記し、日記の保存時に entry_logs へ移す) ---
+CHAT_SESSION_OPEN = 'open'
+CHAT_SESSION_SAVED = 'saved'
+CHAT_SESSION_DISCARDED = 'discarded'
+CHAT_TURN_FETCH_SIZE = 100 # iter_chat_turns で一度に読み込むターン数
+
+@tracing.traced()
+def start_chat_session(user_id):
+    """新しいチャットセッションを作り、セッションIDを返す"""
+    with user_connection(user_id) as conn:
+        cursor = conn.execute("INSERT INTO chat_sessions (user_id, status) VALUES (?, ?)",
+                              (user_id, CHAT_SESSION_OPEN))
+        conn.commit()
+        return cursor.lastrowid
+
+@tracing.traced()
+def append_chat_turns(session_id, start_seq, messages):
+    """
+    chat_history 形式のメッセージ ({'role', 'parts'}) を seq = start_seq から順に追記する。
+    同じ seq のターンがあれば置き換える (再送しても重複しない)。
+    """
+    rows = [(session_id, start_seq + i, m['role'], m['parts'][0]) for i, m in enumerate(messages)]
+    if not rows:
+        return
+    with id_connection(session_id) as conn:
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO chat_turns (session_id, seq, role, text) VALUES (?, ?, ?, ?)", rows
+            )
+            conn.execute("UPDATE chat_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (session_id,))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"チャットのターンの保存中にエラーが発生しました: {e}")
+            conn.rollback()
+
+@tracing.traced()
+def truncate_chat_turns(session_id, seq):
+    """seq 以降のターンを削除する (応答を得られなかった発言の取り消し用)"""
+    with id_connection(session_id) as conn:
+        conn.execute("DELETE FROM chat_turns WHERE session_id = ? AND seq >= ?", (session_id, seq))
+        conn.commit()
+
+@tracing.traced()
+def get_open_chat_session(user_id):
+    """ユーザーの会話中のセッション (最後に更新したもの) のIDを返す (なければ None)"""
+    with user_connection(user_id) as conn:
+        row = conn.execute(QUERY_OPEN_CHAT_SESSION, (user_id, CHAT_SESSION_OPEN)).fetchone()
+    return row[0] if row else None
+
+def _iter_turn_rows(conn, session_id):
+    cursor = conn.execute(QUERY_CHAT_TURNS, (session_id,))
+    while True:
+        rows = cursor.fetchmany(CHAT_TURN_FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+def iter_chat_turns(session_id):
+    """セッションのターンを seq 順に (role, text) で返すジェネレーター"""
+    with id_connection(session_id) as conn:
+        for _, role, text in _iter_turn_rows(conn, session_id):
+            yield role, text
+
+@tracing.traced()
+def get_chat_history(session_id):
+    """セッションのターンを app.py の chat_history 形式のリストで返す (会話の再開用)"""
+    return [{'role': role, 'parts': [text]} for role, text in iter_chat_turns(session_id)]
+
+@tracing.traced()
+def save_chat_session(session_id, user_id, entry_date):
+    """
+    セッションのターンから分析前の日記エントリーを作り、エントリーIDを返す (create_pending_entry と同じ扱い)。
+    ターンは1件ずつ圧縮しながら entry_logs に書き込み、保存したセッションのターンは削除する。
+    """
+    with id_connection(session_id) as conn:
+        try:
+            session = conn.execute("SELECT user_id, status, entry_id FROM chat_sessions WHERE id = ?",
+                                   (session_id,)).fetchone()
+            if session is None or session['user_id'] != user_id:
+                logger.error(f"チャットセッション (ID: {session_id}) が見つかりません。")
+                return None
+            if session['status'] == CHAT_SESSION_SAVED:
+                return session['entry_id'] # 保存ボタンの連打など
+            cursor = conn.execute("""
+                INSERT INTO entries (user_id, entry_date, chat_log, summary, analysis_status)
+                VALUES (?, ?, '', NULL, ?)
+            """, (user_id, entry_date, ANALYSIS_PENDING))
+            entry_id = cursor.lastrowid
+            lines = [] # 全文検索の索引用
+            def turn_lines():
+                for _, role, text in _iter_turn_rows(conn, session_id):
+                    line = log_codec.format_turn(role, text)
+                    lines.append(line)
+                    yield line
+            dict_id, zdict = _get_current_log_dict(conn, shard_of_id(session_id))
+            raw_size, data = log_codec.compress_lines(turn_lines(), zdict)
+            conn.execute(log_codec.INSERT_ENTRY_LOG, (entry_id, log_codec.CODEC_ZLIB, dict_id, raw_size, data))
+            conn.execute(
+                "INSERT INTO entries_fts (rowid, chat_log, summary, user_id) VALUES (?, ?, '', ?)",
+                (entry_id, "\n".join(lines), user_id)
+            )
+            conn.execute("""
+                UPDATE chat_sessions SET status = ?, entry_id = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+            """, (CHAT_SESSION_SAVED, entry_id, session_id))
+            conn.execute("DELETE FROM chat_turns WHERE session_id = ?", (session_id,))
+            conn.commit()
+            mark_user_data_changed(user_id)
+            logger.debug(f"チャットセッション (ID: {session_id}) を日記エントリー (ID: {entry_id}) として保存しました。")
+            return entry_id
+        except sqlite3.Error as e:
+            logger.error(f"データベースへの保存中にエラーが発生しました: {e}")
+            conn.rollback()
+            return None
+
+@tracing.traced()
+def discard_chat_session(session_id):
+    """会話中のセッションを破棄し、ターンを削除する"""
+    with id_connection(session_id) as conn:
+        conn.execute("UPDATE chat_sessions SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = ?",
+                     (CHAT_SESSION_DISCARDED, session_id, CHAT_SESSION_OPEN))
+        conn.execute("DELETE FROM chat_turns WHERE session_id = ?", (session_id,))
+        conn.commit()
+
+@tracing.traced()
+def get_entry_for_analysis(entry_id):
+    """分析に必要な情報 (チャットログ、分析状態、試行回数) を取得する"""
+    with id_connection(entry_id) as conn:
+        row = conn.execute("""
+            SELECT id, user_id, analysis_status, analysis_attempts
+            FROM entries
+            WHERE id = ?
+        """, (entry_id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry['chat_log'] = _read_chat_log(conn, entry_id)
+    return entry
+
+@tracing.traced()
+def complete_entry_analysis(entry_id, summary, emotions):
+    """
+    分析結果 (要約と感情スコア) を書き込み、エントリーを分析済みにする。
+    entries の更新と emotions の挿入は1つのトランザクションで行う。
+    """
+    with id_connection(entry_id) as conn:
+        try:
+            row = conn.execute("""
+                UPDATE entries
+                SET summary = ?, analysis_status = ?, analysis_error = NULL
+                WHERE id = ?
+                RETURNING user_id, entry_date
+            """, (summary, ANALYSIS_DONE, entry_id)).fetchone()
+            if row is None:
+                conn.rollback()
+                logger.warning(f"エントリーID {entry_id} が見つからないため、分析結果を保存できませんでした。")
+                return False
+            # 再分析で感情スコアを置き換える場合は、集計には前のスコアとの差だけを足す
+            previous = conn.execute(
+                f"SELECT {', '.join(EMOTION_KEYS)} FROM emotions WHERE entry_id = ?", (entry_id,)
+            ).fetchone()
+            conn.execute("""
+                INSERT INTO emotions (entry_id, joy, anger, sadness, anxiety, relief)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (entry_id) DO UPDATE SET
+                    joy = excluded.joy, anger = excluded.anger, sadness = excluded.sadness,
+                    anxiety = excluded.anxiety, relief = excluded.relief
+            """, (entry_id,
+                  emotions.get('joy', 0),
+                  emotions.get('anger', 0),
+                  emotions.get('sadness', 0),
+                  emotions.get('anxiety', 0),
+                  emotions.get('relief', 0)))
+            new_values = _emotion_values(emotions)
+            if previous is None:
+                _apply_emotion_stats(conn, row['user_id'], [(row['entry_date'], 1, new_values)])
+            else:
+                _apply_emotion_stats(conn, row['user_id'],
+                                     [(row['entry_date'], 0, {k: new_values[k] - previous[k] for k in EMOTION_KEYS})])
+            conn.commit()
+            mark_user_data_changed(row['user_id'])
+            _notify_emotions_written(row['user_id'], [(entry_id, row['entry_date'], new_values)])
+            logger.debug(f"日記エントリー (ID: {entry_id}) の分析結果を保存しました。")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"分析結果の保存中にエラーが発生しました: {e}")
+            conn.rollback()
+            return False
+
+@tracing.traced()
+def record_analysis_failure(entry_id, error_message, give_up=False):
+    """
+    分析の失敗を記録して試行回数を1増やす。give_up=True なら 'failed' にして再試行を止める。
+    Returns:
+        int: 更新後の試行回数 (エントリーが見つからなければ None)。
+    """
+    with id_connection(entry_id) as conn:
+        try:
+            row = conn.execute("""
+                UPDATE entries
+                SET analysis_attempts = analysis_attempts + 1,
+                    analysis_error = ?,
+                    analysis_status = ?
+                WHERE id = ?
+                RETURNING analysis_attempts
+            """, (error_message, ANALYSIS_FAILED if give_up else ANALYSIS_PENDING, entry_id)).fetchone()
+            conn.commit()
+            return row['analysis_attempts'] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"分析失敗の記録中にエラーが発生しました: {e}")
+            conn.rollback()
+            return None
+
+@tracing.traced()
+def requeue_entry_analysis(entry_id):
+    """'failed' になったエントリーを試行回数0から分析待ちに戻す"""
+    with id_connection(entry_id) as conn:
+        conn.execute("""
+            UPDATE entries
+            SET analysis_status = ?, analysis_attempts = 0, analysis_error = NULL
+            WHERE id = ? AND analysis_status != ?
+        """, (ANALYSIS_PENDING, entry_id, ANALYSIS_DONE))
+        conn.commit()
+
+@tracing.traced()
+def get_unanalyzed_entries_by_user(user_id):
+    """ユーザーの分析が終わっていない日記の {エントリーID: 分析状態} を返す (サイドバー表示用)"""
+    with user_connection(user_id) as conn:
+        rows = conn.execute(QUERY_UNANALYZED_BY_USER, (user_id,)).fetchall()
+    return {row['id']: row['analysis_status'] for row in rows}
+
+@tracing.traced()
+def get_pending_entry_ids():
+    """分析待ち ('pending') の全エントリーIDを返す (アプリ再起動時の再開用)"""
+    entry_ids = []
+    for shard_id in list_shards():
+        with shard_connection(shard_id) as conn:
+            rows = conn.execute(QUERY_UNANALYZED_ENTRIES).fetchall()
+        entry_ids += [row['id'] for row in rows if row['analysis_status'] == ANALYSIS_PENDING]
+    return entry_ids
+
+# --- Gemini 応答キャッシュ ---
+@tracing.traced()
+def get_cached_response(cache_key, max_age_seconds, touch_interval=60.0):
+    """
+    キャッシュ済みの応答 (JSON 文字列) を返す。無い・期限切れなら None。
+    LRU 用の最終利用時刻は touch_interval 秒以上経っている場合だけ更新し、書き込みを減らす。
+    """
+    now = time.time()
+    with connection() as conn:
+        try:
+            row = conn.execute(
+                "SELECT payload, created_at, last_used_at FROM response_cache WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+            if not row or now - row['created_at'] > max_age_seconds:
+                return None
+            if now - row['last_used_at'] > touch_interval:
+                conn.execute("UPDATE response_cache SET last_used_at = ? WHERE cache_key = ?", (now, cache_key))
+                conn.commit()
+            return row['payload']
+        except sqlite3.Error as e:
+            logger.error(f"応答キャッシュの取得中にエラーが発生しました: {e}")
+            return None
+
+@tracing.traced()
+def put_cached_response(cache_key, kind, payload):
+    """応答 (JSON 文字列) をキャッシュに保存する (同じキーがあれば上書き)"""
+    now = time.time()
+    with connection() as conn:
+        try:
+            conn.execute("""
+                INSERT INTO response_cache (cache_key, kind, payload, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    payload = excluded.payload, created_at = excluded.created_at, last_used_at = excluded.last_used_at
+            """, (cache_key, kind, payload, now, now))
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"応答キャッシュの保存中にエラーが発生しました: {e}")
+            conn.rollback()
+            return False
+
+@tracing.traced()
+def evict_cached_responses(max_entries, ttl_by_kind):
+    """
+    期限切れのキャッシュを削除し、件数が max_entries を超えていれば最終利用が古いものから削除する。
+    Args:
+        max_entries (int): キャッシュ全体の最大件数。
+        ttl_by_kind (dict): 種類 ('analysis' など) -> 有効期限 (秒)。
+    Returns:
+        int: 削除した件数。
+    """
+    now = time.time()
+    with connection() as conn:
+        try:
+            deleted = 0
+            for kind, ttl in ttl_by_kind.items():
+                deleted += conn.execute(
+                    "DELETE FROM response_cache WHERE kind = ? AND created_at < ?", (kind, now - ttl)
+                ).rowcount
+            overflow = conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0] - max_entries
+            if overflow > 0:
+                deleted += conn.execute("""
+                    DELETE FROM response_cache WHERE cache_key IN (
+                        SELECT cache_key FROM response_cache ORDER BY last_used_at ASC LIMIT ?
+                    )
+                """, (overflow,)).rowcount
+            conn.commit()
+            return deleted
+        except sqlite3.Error as e:
+            logger.error(f"応答キャッシュの削除中にエラーが発生しました: {e}")
+            conn.rollback()
+            return 0
+
+# --- ログインセッション (session_store.py から使う。users と同じくシャード 0 に置く) ---
+@tracing.traced()
+def create_session(token_hash, user_id, username, expires_at):
+    """ログインセッションを保存する"""
+    now = time.time()
+    with connection() as conn:
+        try:
+            conn.execute("""
+                INSERT INTO sessions (token_hash, user_id, username, created_at, last_seen_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (token_hash, user_id, username, now, now, expires_at))
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"セッションの保存中にエラーが発生しました: {e}")
+            conn.rollback()
+            return False
+
+@tracing.traced()
+def get_session(token_hash):
+    """セッションの {'user_id', 'username', 'expires_at'} を返す (なければ None。期限切れの判定は呼び出し側)"""
+    with connection() as conn:
+        row = conn.execute(QUERY_SESSION, (token_hash,)).fetchone()
+    return dict(row) if row else None
+
+@tracing.traced()
+def touch_session(token_hash, expires_at):
+    """セッションの有効期限を延ばす。削除済み (ログアウト・期限切れで削除) なら False"""
+    now = time.time()
+    with connection() as conn:
+        try:
+            cursor = conn.execute(
+                "UPDATE sessions SET last_seen_at = ?, expires_at = ? WHERE token_hash = ? AND expires_at >= ?",
+                (now, expires_at, token_hash, now)
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            logger.error(f"セッションの更新中にエラーが発生しました: {e}")
+            conn.rollback()
+            return True # 書き込めなくてもログイン状態は保つ (期限は次回の更新で延ばす)
+
+@tracing.traced()
+def delete_session(token_hash):
+    """セッションを削除する (ログアウト)"""
+    with connection() as conn:
+        conn.execute("DELETE FROM sessions WHERE token_hash = ?", (token_hash,))
+        conn.commit()
+
+@tracing.traced()
+def evict_expired_sessions(now=None):
+    """期限切れのセッションをまとめて削除し、削除件数を返す"""
+    with connection() as conn:
+        try:
+            deleted = conn.execute(
+                "DELETE FROM sessions WHERE expires_at < ?", (now if now is not None else time.time(),)
+            ).rowcount
+            conn.commit()
+            return deleted
+        except sqlite3.Error as e:
+            logger.error(f"期限切れセッションの削除中にエラーが発生しました: {e}")
+            conn.rollback()
+            return 0
+
+@tracing.traced()
+def get_or_create_secret(name, value):
+    """
+    名前の鍵を返す。まだなければ value を保存して返す (全てのプロセスが同じ鍵を使う)。
+    複数のプロセスが同時に作った場合は、先に保存された方を返す。
+    """
+    with connection() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO app_secrets (name, value, created_at) VALUES (?, ?, ?)", (name, value, time.time())
+        )
+        conn.commit()
+        return conn.execute("SELECT value FROM app_secrets WHERE name = ?", (name,)).fetchone()[0]
+
+# --- シャード間のユーザーの移動 (shard_tool.py から使う) ---
+MOVE_BATCH_SIZE = 500 # 移動で一度に読み込む日記の数
+
+def _delete_user_rows(conn, user_id):
+    """ユーザーの日記・感情スコア・集計・チャットをシャードから削除する (commit は呼び出し側)"""
+    conn.execute("DELETE FROM emotions WHERE entry_id IN (SELECT id FROM entries WHERE user_id = ?)", (user_id,))
+    conn.execute("DELETE FROM entries WHERE user_id = ?", (user_id,)) # entry_logs と索引はトリガーで消える
+    conn.execute("DELETE FROM user_emotion_daily WHERE user_id = ?", (user_id,))
+    conn.execute("DELETE FROM user_emotion_stats WHERE user_id = ?", (user_id,))
+    conn.execute("DELETE FROM chat_turns WHERE session_id IN (SELECT id FROM chat_sessions WHERE user_id = ?)",
+                 (user_id,))
+    conn.execute("DELETE FROM chat_sessions WHERE user_id = ?", (user_id,))
+
+def _copy_rows(target, table, rows, skip=('id',)):
+    """行 (sqlite3.Row) を同じ列名で target の table に挿入する (skip の列は除く)"""
+    if not rows:
+        return
+    columns = [c for c in rows[0].keys() if c not in skip]
+    target.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+        [tuple(row[c] for c in columns) for row in rows]
+    )
+
+@tracing.traced()
+def move_user_to_shard(user_id, target_shard):
+    """
+    ユーザーのデータを別のシャードに移し、移した日記の数を返す (既にそのシャードなら 0)。
+    移動先では新しい ID で採番し直す (ID の上位ビットがシャード番号のため)。チャットログは移動先の辞書で圧縮し直す。
+    移動先へのコピー → users.shard_id の更新 → 移動元からの削除 の順に行うので、途中で止まっても
+    ユーザーのデータはどちらかのシャードに全て残っている (もう一度実行すれば続きから移せる)。
+    アプリのプロセスはユーザーとシャードの対応や日記IDをキャッシュしているため、アプリを止めて実行すること。
+    """
+    source_shard = get_user_shard(user_id)
+    if source_shard == target_shard:
+        return 0
+    moved = 0
+    with shard_connection(source_shard) as source, shard_connection(target_shard) as target:
+        try:
+            target.execute("BEGIN IMMEDIATE")
+            _delete_user_rows(target, user_id) # 前回の移動が途中で止まっていた場合の残り
+            last_id = 0
+            while True:
+                entries = source.execute(
+                    "SELECT * FROM entries WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+                    (user_id, last_id, MOVE_BATCH_SIZE)
+                ).fetchall()
+                if not entries:
+                    break
+                for entry in entries:
+                    columns = [c for c in entry.keys() if c not in ('id', 'chat_log')]
+                    new_id = target.execute(
+                        f"INSERT INTO entries ({', '.join(columns)}, chat_log) VALUES ({', '.join('?' for _ in columns)}, '')",
+                        [entry[c] for c in columns]
+                    ).lastrowid
+                    store_chat_log(target, new_id, user_id, _read_chat_log(source, entry['id']), entry['summary'])
+                    emotion = source.execute(
+                        f"SELECT {', '.join(EMOTION_KEYS)}, created_at FROM emotions WHERE entry_id = ?", (entry['id'],)
+                    ).fetchall()
+                    _copy_rows(target, "emotions", [{'entry_id': new_id, **dict(row)} for row in emotion])
+                moved += len(entries)
+                last_id = entries[-1]['id']
+            for table in ("user_emotion_daily", "user_emotion_stats"):
+                _copy_rows(target, table, source.execute(f"SELECT * FROM {table} WHERE user_id = ?", (user_id,)).fetchall(),
+                           skip=())
+            # 会話中のセッションだけ移す (保存・破棄済みのセッションはターンを持たない)
+            for session in source.execute("SELECT * FROM chat_sessions WHERE user_id = ? AND status = ?",
+                                          (user_id, CHAT_SESSION_OPEN)).fetchall():
+                columns = [c for c in session.keys() if c != 'id']
+                new_session_id = target.execute(
+                    f"INSERT INTO chat_sessions ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                    [session[c] for c in columns]
+                ).lastrowid
+                turns = source.execute("SELECT * FROM chat_turns WHERE session_id = ?", (session['id'],)).fetchall()
+                _copy_rows(target, "chat_turns", [{**dict(row), 'session_id': new_session_id} for row in turns], skip=())
+            target.commit()
+        except sqlite3.Error:
+            target.rollback()
+            raise
+        with connection() as conn:
+            conn.execute("UPDATE users SET shard_id = ? WHERE id = ?", (target_shard, user_id))
+            conn.commit()
+        with _user_shards_lock:
+            _user_shards[user_id] = target_shard
+        try:
+            _delete_user_rows(source, user_id)
+            source.commit()
+        except sqlite3.Error:
+            source.rollback()
+            raise
+    mark_user_data_changed(user_id)
+    logger.info(f"ユーザーID {user_id} の日記 {moved} 件をシャード {source_shard} から {target_shard} に移しました。")
+    return moved
+
+# --- ストレージのバックエンド ---
+# db.<関数名> (STORAGE_API の関数) は、選択中のバックエンド (StorageBackend を実装したオブジェクト) の
+# 同名のメソッドを呼ぶ。上で定義した関数は SQLite のバックエンド (SQLiteStorage) の実装になる。
+# DIARY_DB_BACKEND=postgres (または use_backend('postgres')) にすると storage_postgres.PostgresStorage を使い、
+# 複数のアプリのプロセスで1つのサーバーを共有できる。呼び出し側は db.<関数名> のまま変わらず、
+# `from db import get_entry_details` のように取り出した関数も切り替え後のバックエンドを呼ぶ。
+# データバージョン・感情スコアの通知 (mark_user_data_changed など) はプロセス内の仕組みなのでバックエンドに含めない。
+# シャーディング (SHARD_MODE) と shard_tool.py は SQLite のときだけ使う。
+BACKEND = os.getenv("DIARY_DB_BACKEND", "sqlite")
+BACKENDS = ('sqlite', 'postgres')
+
+@runtime_checkable
+class StorageBackend(Protocol):
+    """ストレージのバックエンドが実装するメソッド (引数・戻り値は db.py の同名の関数と同じ)"""
+    def create_user(self, username, password_hash): ...
+    def get_user_by_username(self, username): ...
+    def update_password_hash(self, user_id, old_hash, new_hash): ...
+    def get_chat_log(self, entry_id): ...
+    def get_user_emotion_stats(self, user_id, today=None): ...
+    def get_emotion_data_version(self, user_id): ...
+    def rebuild_emotion_stats(self, user_ids=None, batch_size=100): ...
+    def create_entry_and_emotions(self, user_id, entry_date, chat_log, summary, emotions): ...
+    def create_pending_entry(self, user_id, entry_date, chat_log): ...
+    def bulk_insert_entries(self, records): ...
+    def iter_entries_for_export(self, user_id=None, batch_size=1000): ...
+    def get_emotions_by_user(self, user_id): ...
+    def get_emotion_vectors(self, user_id): ...
+    def get_emotion_rows_after(self, after_id, limit, before_id=None): ...
+    def get_first_pending_entry_id(self, after_id=0): ...
+    def get_emotion_series(self, user_id, start=None, end=None, max_points=None, rollup='raw'): ...
+    def get_first_entry_date(self, user_id): ...
+    def get_entry_list_by_user(self, user_id): ...
+    def get_entry_page(self, user_id, month=None, before=None, limit=ENTRY_PAGE_SIZE): ...
+    def get_entry_months(self, user_id): ...
+    def get_entry_brief(self, entry_id): ...
+    def search_entries(self, user_id, query, limit=20): ...
+    def get_entry_details(self, entry_id): ...
+    def start_chat_session(self, user_id): ...
+    def append_chat_turns(self, session_id, start_seq, messages): ...
+    def truncate_chat_turns(self, session_id, seq): ...
+    def get_open_chat_session(self, user_id): ...
+    def iter_chat_turns(self, session_id): ...
+    def get_chat_history(self, session_id): ...
+    def save_chat_session(self, session_id, user_id, entry_date): ...
+    def discard_chat_session(self, session_id): ...
+    def get_entry_for_analysis(self, entry_id): ...
+    def complete_entry_analysis(self, entry_id, summary, emotions): ...
+    def record_analysis_failure(self, entry_id, error_message, give_up=False): ...
+    def requeue_entry_analysis(self, entry_id): ...
+    def get_unanalyzed_entries_by_user(self, user_id): ...
+    def get_pending_entry_ids(self): ...
+    def get_cached_response(self, cache_key, max_age_seconds, touch_interval=60.0): ...
+    def put_cached_response(self, cache_key, kind, payload): ...
+    def evict_cached_responses(self, max_entries, ttl_by_kind): ...
+    def create_session(self, token_hash, user_id, username, expires_at): ...
+    def get_session(self, token_hash): ...
+    def touch_session(self, token_hash, expires_at): ...
+    def delete_session(self, token_hash): ...
+    def evict_expired_sessions(self, now=None): ...
+    def get_or_create_secret(self, name, value): ...
+    def list_shards(self): ...
+    def get_pool_stats(self): ...
+    def close_pool(self): ...
+
+STORAGE_API = tuple(name for name in StorageBackend.__dict__ if not name.startswith('_'))
+
+class SQLiteStorage:
+    """db.py の SQLite の実装 (シャーディングを含む) をメソッドとして持つバックエンド"""
+    name = 'sqlite'
+
+for _name in STORAGE_API:
+    setattr(SQLiteStorage, _name, staticmethod(globals()[_name]))
+
+_backend = SQLiteStorage()
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """選択中のバックエンドを返す"""
+    return _backend
+
+def _delegate(name, implementation):
+    @functools.wraps(implementation)
+    def call(*args, **kwargs):
+        return getattr(_backend, name)(*args, **kwargs)
+    return call
+
+# db.<関数名> を、選択中のバックエンドに委譲する関数にする (モジュールの読み込み時に一度だけ)
+for _name in STORAGE_API:
+    globals()[_name] = _delegate(_name, getattr(SQLiteStorage, _name))
+del _name
+
+def use_backend(backend, dsn=None):
+    """
+    ストレージのバックエンドを切り替える ('sqlite' / 'postgres'、または StorageBackend を実装したオブジェクト)。
+    dsn は PostgreSQL の接続先 (省略時は DIARY_DATABASE_URL)。今のバックエンドの接続プールは閉じる。
+    """
+    global BACKEND, _backend
+    if isinstance(backend, str):
+        if backend not in BACKENDS:
+            raise ValueError(f"不明なバックエンド '{backend}' です ({' / '.join(BACKENDS)} のいずれか)。")
+        if backend == 'postgres':
+            import storage_postgres # psycopg は PostgreSQL を使うときだけ必要
+            instance = storage_postgres.PostgresStorage(dsn)
         else:
-            print(f"エントリーID {entry_id} の詳細が見つかりませんでした。")
-    except sqlite3.Error as e:
-        print(f"日記詳細の取得中にエラーが発生しました: {e}")
-    finally:
-        conn.close()
-    return details
\ No newline at end of file
+            instance = SQLiteStorage()
+    else:
+        instance = backend
+    name = getattr(instance, 'name', type(instance).__name__)
+    if not isinstance(instance, StorageBackend):
+        missing = [n for n in STORAGE_API if not hasattr(instance, n)]
+        raise TypeError(f"{type(instance).__name__} に次のメソッドがありません: {', '.join(missing)}")
+    with _backend_lock:
+        previous, _backend = _backend, instance
+        BACKEND = name
+    previous.close_pool()
+    logger.info(f"ストレージのバックエンド: {name}")
+
+if BACKEND != 'sqlite':
+    use_backend(BACKEND)
@@ -0,0 +1,79 @@
+# diary_list.py
+import threading
+from collections import OrderedDict
+from datetime import date
+from functools import lru_cache
+
+import db
+
+MONTHS_CACHE_SIZE = 256 # 年月一覧をキャッシュするユーザー数
+
+_lock = threading.Lock()
+_months_cache = OrderedDict() # ユーザーID -> ((DB のデータバージョン, プロセス内のデータバージョン), [(年月, 件数), ...]) (LRU)
+
+
+@lru_cache(maxsize=8192)
+def format_entry_date(entry_date_str):
+    """'2023-10-27' を '2023年10月27日' に変換する (同じ日付は一度だけ変換する)"""
+    try:
+        return date.fromisoformat(entry_date_str).strftime('%Y年%m月%d日')
+    except ValueError:
+        return entry_date_str # パース失敗時は元の文字列を使う
+
+
+@lru_cache(maxsize=8192)
+def format_entry_label(entry_date_str, status=None):
+    """サイドバーに表示する日記のラベル (分析状態に応じて絵文字を変える)"""
+    entry_date_str = format_entry_date(entry_date_str)
+    if status == db.ANALYSIS_PENDING:
+        return f"⏳ {entry_date_str} (分析中)"
+    if status == db.ANALYSIS_FAILED:
+        return f"⚠️ {entry_date_str} (分析失敗)"
+    return f"📖 {entry_date_str}"
+
+
+@lru_cache(maxsize=1024)
+def format_month_label(month, entry_count):
+    """'2023-10' と件数から '2023年10月 (12件)' を作る"""
+    year, month_number = month.split('-')
+    return f"{year}年{int(month_number)}月 ({entry_count}件)"
+
+
+def get_months(user_id):
+    """
+    日記のある年月と件数の一覧を返す。
+    データバージョンが変わるまで (日記の保存・分析完了まで) はDBに問い合わせずキャッシュを返す。
+    DB に保存したデータバージョン (感情スコアの書き込みごとに増える) も見るので、別のプロセスや
+    一括インポートで保存された日記も反映する。分析待ちの日記の保存はプロセス内のデータバージョンで検知する。
+    """
+    version = (db.get_emotion_data_version(user_id), db.get_user_data_version(user_id))
+    with _lock:
+        cached = _months_cache.get(user_id)
+        if cached and cached[0] == version:
+            _months_cache.move_to_end(user_id)
+            return cached[1]
+    months = db.get_entry_months(user_id)
+    with _lock:
+        _months_cache[user_id] = (version, months)
+        _months_cache.move_to_end(user_id)
+        while len(_months_cache) > MONTHS_CACHE_SIZE:
+            _months_cache.popitem(last=False)
+    return months
+
+
+def get_page_options(user_id, month=None, before=None, unanalyzed_entries=None, limit=db.ENTRY_PAGE_SIZE):
+    """
+    サイドバーのセレクトボックス用に、1ページ分の {エントリーID: ラベル} を返す。
+    Args:
+        unanalyzed_entries (dict): db.get_unanalyzed_entries_by_user の結果 {ID: 状態}。
+    Returns:
+        dict: {エントリーID: ラベル} (新しい順)。
+        tuple: 次のページのカーソル (続きがなければ None)。
+    """
+    unanalyzed_entries = unanalyzed_entries or {}
+    entries, next_cursor = db.get_entry_page(user_id, month=month, before=before, limit=limit)
+    options = {
+        entry['id']: format_entry_label(entry['entry_date'], unanalyzed_entries.get(entry['id']))
+        for entry in entries
+    }
+    return options, next_cursor
@@ -0,0 +1,58 @@
+# downsampling.py
+import numpy as np
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets 法で、折れ線の形 (山や谷) を保ったまま
+    threshold 点に間引くための添字を返す。
+    Args:
+        x (np.ndarray): 昇順に並んだ x 座標 (数値)。
+        y (np.ndarray): x に対応する値。
+        threshold (int): 残す点の数 (3 以上)。
+    Returns:
+        np.ndarray: 残す点の添字 (昇順)。先頭と末尾の点は必ず含む。
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    # 先頭・末尾を除いた点を threshold - 2 個のバケツに分ける
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+        # 次のバケツの平均点 (最後のバケツの次は末尾の点)
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], max(edges[i + 2], edges[i + 1] + 1)
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        # 直前に選んだ点・次のバケツの平均点と作る三角形の面積が最大の点を選ぶ (バケツ内はベクトル演算)
+        areas = np.abs(
+            (x[previous] - avg_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (avg_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+def lttb_multi_indices(x, series, max_points):
+    """
+    複数の系列 (感情ごとのスコアなど) を同じ x 軸で間引く。
+    系列ごとに LTTB で点を選び、その和集合を返すので、どの系列の山・谷も残る。
+    合計がおおよそ max_points 点に収まるよう、系列ごとの点数を配分する。
+    """
+    n = len(x)
+    if max_points is None or n <= max_points:
+        return np.arange(n)
+    per_series = max(3, max_points // max(1, len(series)))
+    chosen = np.unique(np.concatenate([lttb_indices(x, y, per_series) for y in series]))
+    return chosen
@@ -0,0 +1,122 @@
+# emotion_chart.py
+import io
+import threading
+from collections import OrderedDict
+
+import matplotlib
+matplotlib.use("Agg") # 画面を持たないサーバー上で描画する
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+
+import db
+import tracing
+
+EMOTION_KEYS = db.EMOTION_KEYS
+DEFAULT_MAX_POINTS = 400 # rollup='raw' で描画する最大点数 (それ以上は LTTB で間引く)
+MARKER_MAX_POINTS = 60 # これ以下の点数のときだけマーカーを描く
+SERIES_CACHE_SIZE = 128 # 保持する感情データ (DataFrame) の数
+CHART_CACHE_SIZE = 64 # 保持する描画結果 (PNG) の数
+
+_lock = threading.Lock()
+# データバージョンは DB の user_emotion_stats.data_version (別のプロセスで書き込まれても変わる)
+_series_cache = OrderedDict() # (ユーザーID, 表示条件) -> (データバージョン, DataFrame) (LRU)
+_chart_cache = OrderedDict() # (ユーザーID, データバージョン, 表示条件) -> PNG バイト列 (LRU)
+_stats = {'series_hits': 0, 'series_misses': 0, 'chart_hits': 0, 'chart_misses': 0}
+
+
+def _put_lru(cache, key, value, max_size):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def get_emotion_series(user_id, start=None, end=None, rollup='raw', max_points=DEFAULT_MAX_POINTS):
+    """
+    ユーザーの感情データ (DataFrame) を返す。引数の意味は db.get_emotion_series と同じ。
+    データバージョンが変わっていなければ、感情データを読まずにキャッシュを返す。
+    """
+    # 書き込みと競合しても古いバージョンで保存されるだけなので、先にバージョンを読む
+    return _get_emotion_series(user_id, db.get_emotion_data_version(user_id), start, end, rollup, max_points)
+
+
+def _get_emotion_series(user_id, version, start, end, rollup, max_points):
+    key = (user_id, str(start), str(end), rollup, max_points)
+    with _lock:
+        cached = _series_cache.get(key)
+        if cached and cached[0] == version:
+            _series_cache.move_to_end(key)
+            _stats['series_hits'] += 1
+            return cached[1]
+        _stats['series_misses'] += 1
+    df = db.get_emotion_series(user_id, start=start, end=end, max_points=max_points, rollup=rollup)
+    with _lock:
+        _put_lru(_series_cache, key, (version, df), SERIES_CACHE_SIZE)
+    return df
+
+
+@tracing.traced()
+def render_emotion_chart(emotion_df):
+    """
+    感情スコアの推移を折れ線グラフにして PNG のバイト列で返す。
+    集計済みのデータ (joy_min, joy_max などの列がある) の場合は、最小〜最大の幅を帯で表示する。
+    """
+    # pyplot はスレッドセーフでないため、Figure を直接作る
+    fig = Figure(figsize=(10, 5))
+    ax = fig.subplots()
+    marker = 'o' if len(emotion_df) <= MARKER_MAX_POINTS else None
+    for emotion in EMOTION_KEYS:
+        if emotion in emotion_df.columns: # 念のためカラム存在確認
+            line, = ax.plot(emotion_df['entry_date'], emotion_df[emotion], marker=marker, linestyle='-', label=emotion.capitalize())
+            if f"{emotion}_min" in emotion_df.columns:
+                ax.fill_between(emotion_df['entry_date'], emotion_df[f"{emotion}_min"], emotion_df[f"{emotion}_max"],
+                                color=line.get_color(), alpha=0.12, linewidth=0)
+
+    ax.set_title('感情スコアの推移')
+    ax.set_xlabel('日付'); ax.set_ylabel('スコア (0-100)')
+    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+    ax.grid(axis='y', linestyle='--') # Y軸のみグリッド
+    span_days = (emotion_df['entry_date'].max() - emotion_df['entry_date'].min()).days if len(emotion_df) else 0
+    # 1年を超える期間では年も表示する
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y/%m' if span_days > 366 else '%m/%d'))
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator(minticks=3, maxticks=10)) # 目盛り数を自動調整
+    fig.autofmt_xdate()
+    ax.set_ylim(0, 105)
+    fig.tight_layout() # レイアウト調整
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def get_emotion_chart_png(user_id, start=None, end=None, rollup='raw', max_points=DEFAULT_MAX_POINTS):
+    """
+    ユーザーの感情グラフを PNG で返す。データがなければ None。
+    データバージョンと表示条件が同じなら、感情データの読み込みも描画も行わずにキャッシュを返す。
+    """
+    version = db.get_emotion_data_version(user_id) # 主キーで1行を引くだけ
+    view = (str(start), str(end), rollup, max_points)
+    key = (user_id, version, view)
+    with _lock:
+        png = _chart_cache.get(key)
+        if png is not None:
+            _chart_cache.move_to_end(key)
+            _stats['chart_hits'] += 1
+            return png
+        _stats['chart_misses'] += 1
+
+    emotion_df = _get_emotion_series(user_id, version, start, end, rollup, max_points)
+    if emotion_df.empty:
+        return None
+    png = render_emotion_chart(emotion_df)
+    with _lock:
+        for old_key in [k for k in _chart_cache if k[0] == user_id and k[1] != version]:
+            del _chart_cache[old_key] # 古いバージョンのグラフは二度と使われない
+        _put_lru(_chart_cache, key, png, CHART_CACHE_SIZE)
+    return png
+
+
+def get_stats():
+    """キャッシュのヒット・ミス回数を返す"""
+    with _lock:
+        return dict(_stats, cached_series=len(_series_cache), cached_charts=len(_chart_cache))
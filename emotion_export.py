@@ -0,0 +1,179 @@
+# emotion_export.py
+"""
+感情スコアの分析用エクスポート (Parquet / Arrow IPC)。
+
+全ユーザーの entries + emotions を、ユーザー・年月ごとに分けたファイル
+(EXPORT_DIR/user_id=1/month=2024-10/part-....parquet) に書き出す。
+前回どこまで書き出したか (シャードごとの entries.id の最大値) を EXPORT_DIR/_state.json に記録しておき、
+次回はそれより後の日記だけを追記する。分析待ちの日記があれば、その手前までで止める (分析後に書き出す)。
+
+分析ジョブは load_dataset / aggregate_emotions でこのファイルを読み (メモリマップ)、
+アプリが使っている SQLite には問い合わせない。
+
+実行例:
+    python emotion_export.py                   # 前回の続きを Parquet で追記
+    python emotion_export.py --format ipc --out analytics_ipc
+    python emotion_export.py --full            # 書き出し済みのファイルを消して作り直す
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from pyarrow import fs
+
+import db
+import tracing
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.getenv("DIARY_ANALYTICS_DIR", "analytics")
+EXPORT_FORMATS = {'parquet': 'parquet', 'ipc': 'arrow'} # 形式 -> 拡張子
+BATCH_SIZE = 50000 # SQLite から一度に読む件数
+STATE_FILE = "_state.json"
+PARTITIONING = ds.partitioning(pa.schema([('user_id', pa.int64()), ('month', pa.string())]), flavor='hive')
+
+SCHEMA = pa.schema([
+    ('entry_id', pa.int64()),
+    ('user_id', pa.int64()),
+    ('entry_date', pa.date32()),
+    ('month', pa.string()), # 'YYYY-MM'
+    *((key, pa.int16()) for key in db.EMOTION_KEYS),
+])
+
+
+def _state_path(out_dir):
+    return os.path.join(out_dir, STATE_FILE)
+
+
+def read_state(out_dir=None):
+    """
+    書き出し済みの範囲 ({'last_entry_ids', 'format', 'rows'}) を返す。
+    last_entry_ids はシャード番号 (文字列) -> 書き出した最大ID (未実行のシャードは含まない)。
+    """
+    try:
+        with open(_state_path(out_dir or EXPORT_DIR), encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {'last_entry_ids': {}, 'format': None, 'rows': 0}
+    if 'last_entry_id' in state: # シャーディング前の形式 (全てシャード 0)
+        state['last_entry_ids'] = {'0': state.pop('last_entry_id')}
+    return state
+
+
+def _write_state(out_dir, state):
+    # 書きかけのファイルを読まれないよう、別名で書いてから置き換える
+    tmp_path = _state_path(out_dir) + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, _state_path(out_dir))
+
+
+def _rows_to_table(rows):
+    """get_emotion_rows_after の行 (タプル) を列ごとの Arrow テーブルにする"""
+    columns = list(zip(*rows))
+    entry_dates = pa.array(columns[2], pa.string())
+    return pa.table([
+        pa.array(columns[0], pa.int64()),
+        pa.array(columns[1], pa.int64()),
+        entry_dates.cast(pa.date32()),
+        pc.utf8_slice_codeunits(entry_dates, 0, 7),
+        *(pa.array(values, pa.int16()) for values in columns[3:]),
+    ], schema=SCHEMA)
+
+
+@tracing.traced()
+def export_emotions(out_dir=None, fmt='parquet', full=False, batch_size=BATCH_SIZE):
+    """
+    シャードごとに前回の続きから感情スコアを書き出す。
+    Returns:
+        dict: rows (今回書き出した件数), last_entry_ids (シャードごとの書き出し済みの最大ID), seconds
+    """
+    out_dir = out_dir or EXPORT_DIR
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"未対応の形式です: {fmt}")
+    state = read_state(out_dir)
+    if full and os.path.exists(_state_path(out_dir)):
+        shutil.rmtree(out_dir) # _state.json がある = このモジュールが作ったディレクトリ
+        state = read_state(out_dir)
+    if state['format'] not in (None, fmt):
+        raise ValueError(f"{out_dir} は {state['format']} 形式で書き出されています (--full で作り直してください)。")
+    os.makedirs(out_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    exported = 0
+    for shard_id in db.list_shards():
+        # ID はシャードごとに増えていくため、書き出し済みの位置もシャードごとに持つ
+        last_id = state['last_entry_ids'].get(str(shard_id), db.shard_base_id(shard_id))
+        # 分析待ちの日記より後ろは、分析が終わってから書き出す (ID 順に追記するため、飛ばすと取りこぼす)
+        stop_id = db.get_first_pending_entry_id(last_id)
+        while True:
+            rows = db.get_emotion_rows_after(last_id, batch_size, before_id=stop_id)
+            if not rows:
+                break
+            table = _rows_to_table(rows)
+            # バッチごとに別名のファイルを追加する。名前はバッチ先頭のID (全シャードで一意) なので、
+            # 状態を記録する前に中断して同じ範囲を書き直しても、同じファイルが上書きされるだけになる
+            ds.write_dataset(
+                table, out_dir, format=fmt, partitioning=PARTITIONING,
+                basename_template=f"part-{rows[0][0]}-{{i}}.{EXPORT_FORMATS[fmt]}",
+                existing_data_behavior='overwrite_or_ignore',
+                max_partitions=max(len(rows), 1024), # 1バッチに多数のユーザー・年月が混ざる
+            )
+            last_id = rows[-1][0]
+            exported += len(rows)
+            state = {'last_entry_ids': {**state['last_entry_ids'], str(shard_id): last_id}, 'format': fmt,
+                     'rows': state['rows'] + len(rows)}
+            _write_state(out_dir, state)
+            logger.info(f"感情スコアのエクスポート: シャード {shard_id} の ID {last_id} まで ({exported:,} 件)")
+    return {'rows': exported, 'last_entry_ids': state['last_entry_ids'], 'seconds': time.perf_counter() - started}
+
+
+def load_dataset(out_dir=None):
+    """書き出したファイルを Arrow のデータセットとして開く (ファイルはメモリマップで読む)"""
+    out_dir = out_dir or EXPORT_DIR
+    fmt = read_state(out_dir)['format'] or 'parquet'
+    return ds.dataset(out_dir, format=fmt, partitioning=PARTITIONING,
+                      filesystem=fs.LocalFileSystem(use_mmap=True)) # _state.json は先頭の _ で除外される
+
+
+def aggregate_emotions(group_by=('month',), filter=None, out_dir=None):
+    """
+    全ユーザーの感情スコアを group_by の列ごとに集計し、件数と各感情の平均を DataFrame で返す。
+    filter は pyarrow.dataset の式 (例: ds.field('month') >= '2024-01')。
+    """
+    group_by = list(group_by)
+    table = load_dataset(out_dir).to_table(columns=[*group_by, *db.EMOTION_KEYS], filter=filter)
+    result = table.group_by(group_by).aggregate(
+        [(db.EMOTION_KEYS[0], 'count')] + [(key, 'mean') for key in db.EMOTION_KEYS]
+    )
+    df = result.to_pandas().rename(columns={f"{key}_mean": key for key in db.EMOTION_KEYS})
+    df = df.rename(columns={f"{db.EMOTION_KEYS[0]}_count": 'entry_count'})
+    return df.sort_values(group_by).reset_index(drop=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="感情スコアの分析用エクスポート (Parquet / Arrow IPC)")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="parquet")
+    parser.add_argument("--out", default=EXPORT_DIR, help="書き出し先のディレクトリ")
+    parser.add_argument("--full", action="store_true", help="書き出し済みのファイルを消して最初から書き出す")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--db", help="使用するDBファイル (省略時は diary_app.db)")
+    args = parser.parse_args(argv)
+
+    tracing.setup_logging()
+    if args.db:
+        db.DB_NAME = args.db
+    stats = export_emotions(args.out, fmt=args.format, full=args.full, batch_size=args.batch_size)
+    print(f"{stats['rows']:,} 件を {args.out} に書き出しました。({stats['seconds']:.1f} 秒)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,142 @@
+# emotion_index.py
+"""
+感情スコアの類似検索 (「今日と似た気持ちだった日」)。
+
+ユーザーごとに感情スコアの行列 (日記の数 x 5) をメモリに持ち、5次元のユークリッド距離を
+NumPy でまとめて計算して近い日記を探す。行列は最初の検索時に一度だけ DB から読み込み、
+その後は db の書き込み通知 (add_emotion_listener) で差分だけ追加・更新する。
+通知はこのプロセス内の書き込みにしか届かないため、検索のたびに DB のデータバージョン
+(user_emotion_stats.data_version) と比べ、別のプロセスで書き込まれていたら読み直す。
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import db
+import tracing
+
+DEFAULT_K = 5
+INDEX_CACHE_SIZE = 64 # メモリに持つユーザーの数 (LRU)
+INITIAL_CAPACITY = 64
+
+_lock = threading.Lock()
+_indexes = OrderedDict() # ユーザーID -> EmotionIndex (LRU)
+_stats = {'hits': 0, 'loads': 0, 'updates': 0}
+
+
+class EmotionIndex:
+    """1ユーザー分の感情スコアの行列。追加に備えて容量を倍々で確保しておく"""
+
+    def __init__(self, ids, dates, vectors, version=0):
+        self.version = version # 読み込んだ時点の DB のデータバージョン (通知を反映するたびに 1 増やす)
+        self.size = len(ids)
+        capacity = max(INITIAL_CAPACITY, self.size)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.vectors = np.zeros((capacity, len(db.EMOTION_KEYS)), dtype=np.float32)
+        self.ids[:self.size] = ids
+        self.vectors[:self.size] = vectors
+        self.dates = list(dates)
+        self.rows = {int(entry_id): i for i, entry_id in enumerate(ids)} # エントリーID -> 行番号
+
+    def upsert(self, entry_id, entry_date, values):
+        """日記の感情スコアを追加する (既にあれば置き換える)"""
+        vector = [values.get(k, 0) for k in db.EMOTION_KEYS]
+        row = self.rows.get(entry_id)
+        if row is not None:
+            self.vectors[row] = vector
+            self.dates[row] = entry_date
+            return
+        if self.size == len(self.ids):
+            self.ids = np.resize(self.ids, self.size * 2)
+            self.vectors = np.resize(self.vectors, (self.size * 2, self.vectors.shape[1]))
+        self.ids[self.size] = entry_id
+        self.vectors[self.size] = vector
+        self.dates.append(entry_date)
+        self.rows[entry_id] = self.size
+        self.size += 1
+
+    def vector_of(self, entry_id):
+        row = self.rows.get(entry_id)
+        return None if row is None else self.vectors[row].copy()
+
+    def nearest(self, vector, k, exclude_id=None):
+        """vector に近い順に最大 k 件の (エントリーID, 日付, 距離) を返す"""
+        vectors = self.vectors[:self.size]
+        distances = np.sqrt(np.square(vectors - np.asarray(vector, dtype=np.float32)).sum(axis=1))
+        if exclude_id is not None and exclude_id in self.rows:
+            distances[self.rows[exclude_id]] = np.inf
+        k = min(k, self.size - (exclude_id in self.rows))
+        if k <= 0:
+            return []
+        # 全件を並べ替えず、近い k 件だけを取り出してから並べる
+        candidates = np.argpartition(distances, k - 1)[:k]
+        candidates = candidates[np.argsort(distances[candidates], kind='stable')]
+        return [(int(self.ids[i]), self.dates[i], float(distances[i])) for i in candidates]
+
+
+def _on_emotions_written(user_id, rows):
+    # 読み込み済みのユーザーだけ差分を反映する (未読み込みなら次の検索時に DB から読む)
+    with _lock:
+        index = _indexes.get(user_id)
+        if index is None:
+            return
+        for entry_id, entry_date, values in rows:
+            index.upsert(entry_id, entry_date, values)
+        # 通知1回ごとに DB のデータバージョンも 1 増えている。別のプロセスの書き込みが挟まっていれば
+        # DB の値と合わなくなるので、次の検索で読み直す
+        index.version += 1
+        _stats['updates'] += len(rows)
+
+db.add_emotion_listener(_on_emotions_written)
+
+
+def _get_index(user_id):
+    version = db.get_emotion_data_version(user_id) # 主キーで1行を引くだけ
+    with _lock:
+        index = _indexes.get(user_id)
+        if index is not None and index.version == version:
+            _indexes.move_to_end(user_id)
+            _stats['hits'] += 1
+            return index
+    # バージョンを先に読むので、読み込み中に書き込みがあっても次の検索で読み直す
+    index = EmotionIndex(*db.get_emotion_vectors(user_id), version=version)
+    with _lock:
+        _stats['loads'] += 1
+        _indexes[user_id] = index
+        _indexes.move_to_end(user_id)
+        while len(_indexes) > INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
+    return index
+
+
+@tracing.traced()
+def find_similar_entries(user_id, entry_id, k=DEFAULT_K):
+    """
+    日記 entry_id と感情スコアが近い、同じユーザーの日記を最大 k 件返す (その日記自身は除く)。
+    Returns:
+        list: {'id', 'entry_date', 'distance'} の dict のリスト (近い順)。感情スコアがなければ空。
+    """
+    index = _get_index(user_id)
+    with _lock:
+        vector = index.vector_of(entry_id)
+        if vector is None:
+            return []
+        results = index.nearest(vector, k, exclude_id=entry_id)
+    return [{'id': i, 'entry_date': d, 'distance': dist} for i, d, dist in results]
+
+
+@tracing.traced()
+def find_entries_like(user_id, emotions, k=DEFAULT_K):
+    """感情スコア ({感情: スコア}) に近い日記を最大 k 件返す (形式は find_similar_entries と同じ)"""
+    index = _get_index(user_id)
+    with _lock:
+        results = index.nearest([emotions.get(key, 0) for key in db.EMOTION_KEYS], k)
+    return [{'id': i, 'entry_date': d, 'distance': dist} for i, d, dist in results]
+
+
+def get_stats():
+    """類似検索の統計情報 (キャッシュのヒット数、読み込み回数、差分の更新数、読み込み済みのユーザー数) を返す"""
+    with _lock:
+        return dict(_stats, cached_users=len(_indexes))
+
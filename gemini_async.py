@@ -0,0 +1,438 @@
+# gemini_async.py
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import gemini_chat
+import gemini_client
+import response_cache
+import tracing
+from gemini_client import CircuitOpenError, DeadlineExceededError, GeminiUnavailableError, is_retryable, status_code
+
+logger = logging.getLogger(__name__)
+
+# --- 設定 ---
+# 非同期版では待ち時間中にスレッドを占有しないため、同期版より多くのリクエストを同時に待たせられる
+ASYNC_MAX_CONCURRENT = int(os.getenv("GEMINI_ASYNC_MAX_CONCURRENT", "32"))
+
+
+class LoopRunner:
+    """
+    バックグラウンドのスレッド1つでイベントループを回し続け、
+    どのスレッド (Streamlit の各セッション) からでもコルーチンを投入できるようにする。
+    """
+
+    def __init__(self, name="gemini-async"):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name=self.name, daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def submit(self, coro):
+        """コルーチンをイベントループに投入し、concurrent.futures.Future を返す"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """コルーチンをイベントループで実行し、結果が出るまで呼び出したスレッドで待つ"""
+        return self.submit(coro).result(timeout=timeout)
+
+    def stop(self, timeout=5.0):
+        """イベントループを停止する (終了処理・ベンチマーク用)"""
+        with self._lock:
+            loop, thread, self._loop, self._thread = self._loop, self._thread, None, None
+        if loop is None:
+            return
+
+        async def cancel_pending():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(cancel_pending(), loop).result(timeout)
+        except Exception as e:
+            logger.error(f"イベントループの停止中にエラーが発生しました: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+        if not thread.is_alive():
+            loop.close()
+
+
+class AsyncGeminiClient:
+    """
+    gemini_client.GeminiClient の非同期版。model.generate_content_async を呼ぶ。
+    同時実行数は asyncio.Semaphore で制限し、レート制限 (トークンバケット) と
+    サーキットブレーカーは同期版の共有クライアントのものを使う (両方から呼んでもクォータを超えないように)。
+    """
+
+    def __init__(self, max_concurrent=ASYNC_MAX_CONCURRENT, max_attempts=gemini_client.MAX_ATTEMPTS,
+                 default_deadline=gemini_client.DEFAULT_DEADLINE, shared=None):
+        self.max_concurrent = max_concurrent
+        self.max_attempts = max_attempts
+        self.default_deadline = default_deadline
+        self._shared = shared # None なら呼び出しのたびに gemini_client.get_client() を使う
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._in_flight = {} # 合流用のキー -> asyncio.Future (イベントループのスレッドだけが触る)
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0, 'attempts': 0, 'retries': 0, 'successes': 0, 'failures': 0,
+            'rate_limited': 0, 'deadline_exceeded': 0, 'circuit_rejections': 0, 'coalesced': 0,
+            'queue_wait_seconds': 0.0, 'max_queue_wait_seconds': 0.0, 'max_in_flight': 0,
+        }
+        self._active = 0
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _shared_client(self):
+        return self._shared or gemini_client.get_client()
+
+    async def _acquire_slot(self, shared, deadline):
+        started = time.monotonic()
+        acquired = True
+        if shared.bucket is not None:
+            while (wait := shared.bucket.try_acquire()) > 0:
+                if time.monotonic() + wait >= deadline:
+                    acquired = False
+                    break
+                await asyncio.sleep(wait)
+        if acquired:
+            if not self._semaphore.locked():
+                await self._semaphore.acquire()
+            else:
+                try:
+                    await asyncio.wait_for(self._semaphore.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    acquired = False
+        waited = time.monotonic() - started
+        with self._lock:
+            self._stats['queue_wait_seconds'] += waited
+            self._stats['max_queue_wait_seconds'] = max(self._stats['max_queue_wait_seconds'], waited)
+            if acquired:
+                self._active += 1
+                self._stats['max_in_flight'] = max(self._stats['max_in_flight'], self._active)
+        if not acquired:
+            self._count('deadline_exceeded')
+            raise DeadlineExceededError("Gemini API の順番待ちが期限を超えました。")
+
+    def _release_slot(self):
+        with self._lock:
+            self._active -= 1
+        self._semaphore.release()
+
+    async def _call_with_retry(self, call, deadline, hold_slot=False):
+        """gemini_client.GeminiClient._call_with_retry と同じ手順を、待ち時間中にループを止めずに行う"""
+        shared = self._shared_client()
+        attempt = 0
+        while True:
+            if not shared.breaker.allow():
+                self._count('circuit_rejections')
+                self._count('failures')
+                raise CircuitOpenError("Gemini API への接続を一時的に停止しています。しばらくしてからお試しください。")
+            try:
+                await self._acquire_slot(shared, deadline)
+            except DeadlineExceededError:
+                shared.breaker.release_trial()
+                self._count('failures')
+                raise
+            attempt += 1
+            self._count('attempts')
+            timeout = max(0.1, deadline - time.monotonic())
+            try:
+                result = await asyncio.wait_for(call(timeout), timeout=timeout)
+            except Exception as e:
+                self._release_slot()
+                if isinstance(e, asyncio.TimeoutError):
+                    e = TimeoutError("Gemini API の応答が期限内に届きませんでした。")
+                if not is_retryable(e):
+                    shared.breaker.release_trial()
+                    self._count('failures')
+                    raise e
+                shared.breaker.record_failure()
+                if status_code(e) == 429:
+                    self._count('rate_limited')
+                delay = shared.backoff_delay(attempt)
+                if attempt >= self.max_attempts or time.monotonic() + delay >= deadline:
+                    self._count('failures')
+                    if time.monotonic() + delay >= deadline:
+                        self._count('deadline_exceeded')
+                    raise GeminiUnavailableError(f"Gemini API の呼び出しに {attempt} 回失敗しました: {e}") from e
+                self._count('retries')
+                logger.warning(f"Gemini API (非同期) の呼び出しに失敗しました ({e})。{delay:.1f}秒後に再試行します ({attempt}/{self.max_attempts})。")
+                await asyncio.sleep(delay)
+                continue
+            if not hold_slot:
+                self._release_slot()
+            shared.breaker.record_success()
+            return result
+
+    async def generate(self, model, contents, deadline=None, coalesce_key=None, **kwargs):
+        """GeminiClient.generate の非同期版"""
+        self._count('requests')
+        deadline_at = time.monotonic() + (deadline or self.default_deadline)
+        future = None
+        if coalesce_key is not None:
+            leader = self._in_flight.get(coalesce_key)
+            if leader is not None:
+                self._count('coalesced')
+                try:
+                    return await asyncio.wait_for(asyncio.shield(leader), timeout=max(0.0, deadline_at - time.monotonic()))
+                except asyncio.TimeoutError:
+                    self._count('deadline_exceeded')
+                    raise DeadlineExceededError("Gemini API の応答 (実行中の同じリクエスト) を待つ間に期限を超えました。")
+            future = self._in_flight[coalesce_key] = asyncio.get_running_loop().create_future()
+
+        sent = tracing.payload_bytes(contents)
+
+        async def call(timeout):
+            with tracing.span('gemini.async.generate') as span:
+                span.add_bytes(sent=sent)
+                response = await model.generate_content_async(contents, request_options={'timeout': timeout}, **kwargs)
+                # 応答本文に問題があればここで例外になる
+                span.add_bytes(received=len(response.text.encode('utf-8')))
+            return response
+
+        try:
+            response = await self._call_with_retry(call, deadline_at)
+        except BaseException as e:
+            if future is not None:
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+                    future.exception() # 待っている呼び出しがなくても「取り出されなかった例外」の警告を出さない
+            raise
+        else:
+            self._count('successes')
+            if future is not None:
+                future.set_result(response)
+            return response
+        finally:
+            if future is not None:
+                self._in_flight.pop(coalesce_key, None)
+
+    async def stream(self, model, contents, deadline=None, **kwargs):
+        """GeminiClient.stream の非同期版 (非同期ジェネレータ)"""
+        self._count('requests')
+        deadline_at = time.monotonic() + (deadline or self.default_deadline)
+
+        sent = tracing.payload_bytes(contents)
+
+        async def call(timeout):
+            with tracing.span('gemini.async.stream.first_chunk') as span:
+                span.add_bytes(sent=sent)
+                response = await model.generate_content_async(
+                    contents, stream=True, request_options={'timeout': timeout}, **kwargs
+                )
+                chunks = response.__aiter__()
+                try:
+                    return chunks, await chunks.__anext__()
+                except StopAsyncIteration:
+                    return chunks, None
+
+        with tracing.span('gemini.async.stream') as span:
+            chunks, first = await self._call_with_retry(call, deadline_at, hold_slot=True)
+            # 枠はストリームを最後まで受け取るまで保持する
+            try:
+                if first is not None:
+                    span.add_bytes(received=len(first.text.encode('utf-8')))
+                    yield first
+                async for chunk in chunks:
+                    span.add_bytes(received=len(chunk.text.encode('utf-8')))
+                    yield chunk
+                self._count('successes')
+            finally:
+                self._release_slot()
+
+    def get_stats(self):
+        """GeminiClient.get_stats と同じ項目に、同時に待っていたリクエスト数の最大を加えて返す"""
+        with self._lock:
+            stats = dict(self._stats)
+        waited = stats.pop('queue_wait_seconds')
+        stats['avg_queue_wait_ms'] = waited / stats['attempts'] * 1000 if stats['attempts'] else 0.0
+        stats['max_queue_wait_ms'] = stats.pop('max_queue_wait_seconds') * 1000
+        stats['breaker'] = self._shared_client().breaker.state
+        return stats
+
+
+_runner = LoopRunner()
+_client = None
+_client_lock = threading.Lock()
+atexit.register(_runner.stop)
+
+
+def get_runner():
+    """全セッションで共有するイベントループのランナーを返す"""
+    return _runner
+
+
+def get_client():
+    """全セッションで共有する非同期クライアントを返す (イベントループのスレッドからのみ使う)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = AsyncGeminiClient()
+        return _client
+
+
+def configure(**kwargs):
+    """共有の非同期クライアントを指定した設定で作り直す (ベンチマークや検証用)。差し替え前のクライアントを返す。"""
+    global _client
+    with _client_lock:
+        previous, _client = _client, AsyncGeminiClient(**kwargs)
+    return previous
+
+
+def get_stats():
+    return get_client().get_stats()
+
+
+# --- 非同期 API (イベントループ上で実行する) ---
+# DB (応答キャッシュ) へのアクセスと会話の要約は同期処理のため、ループを止めないよう別スレッドで実行する
+
+async def get_chat_response_async(chat_history, context_manager=None, user_id=None):
+    """
+    gemini_chat.get_chat_response の非同期版。AIの応答テキストを返す (user_id を指定したときだけキャッシュする)。
+    Raises:
+        GeminiUnavailableError: 混雑 (429) などでリトライしても応答が得られなかった。
+        gemini_chat.ChatResponseError: それ以外の理由で応答が得られなかった。
+    """
+    model = gemini_chat.model
+    if not model:
+        raise gemini_chat.ChatResponseError("Gemini APIが設定されていません。")
+    try:
+        contents = await asyncio.to_thread(gemini_chat._prepare_contents, chat_history, context_manager)
+        cache_key = gemini_chat.chat_cache_key(contents, user_id)
+        cached_response = await asyncio.to_thread(response_cache.get, 'chat', cache_key)
+        if cached_response is not None:
+            return cached_response
+        response = await get_client().generate(model, contents, deadline=gemini_chat.CHAT_DEADLINE)
+        ai_response = response.text
+        await asyncio.to_thread(response_cache.put, 'chat', cache_key, ai_response)
+        return ai_response
+    except GeminiUnavailableError:
+        raise
+    except Exception as e:
+        logger.error(f"Gemini API チャット (非同期) 呼び出し中にエラーが発生しました: {e}")
+        raise gemini_chat.ChatResponseError(f"AI応答の取得中にエラーが発生しました: {e}") from e
+
+
+async def stream_chat_response_async(chat_history, context_manager=None, user_id=None):
+    """
+    gemini_chat.stream_chat_response の非同期版 (応答テキストの断片を返す非同期ジェネレータ)。
+    user_id を指定したときだけ、そのユーザーの応答としてキャッシュする。
+    最初の断片の前に失敗したら gemini_chat.ChatResponseError (混雑なら GeminiUnavailableError) を、
+    断片を返した後に失敗したら gemini_chat.ChatStreamInterruptedError を送出する。
+    """
+    model = gemini_chat.model
+    if not model:
+        raise gemini_chat.ChatResponseError("Gemini APIが設定されていません。")
+    chunks = [] # 返した断片 (途中で失敗したかの判定と、キャッシュ用)
+    try:
+        contents = await asyncio.to_thread(gemini_chat._prepare_contents, chat_history, context_manager)
+        cache_key = gemini_chat.chat_cache_key(contents, user_id)
+        cached_response = await asyncio.to_thread(response_cache.get, 'chat', cache_key)
+        if cached_response is not None:
+            yield cached_response
+            return
+        async for chunk in get_client().stream(model, contents, deadline=gemini_chat.CHAT_DEADLINE):
+            text = chunk.text
+            if text:
+                chunks.append(text)
+                yield text
+    except (GeminiUnavailableError, gemini_chat.ChatResponseError):
+        raise
+    except Exception as e:
+        logger.error(f"Gemini API チャット (非同期ストリーミング) 呼び出し中にエラーが発生しました: {e}")
+        if chunks:
+            # 途中までの応答にエラー文を続けると、1つの応答として保存されてしまう
+            raise gemini_chat.ChatStreamInterruptedError(
+                f"AI応答の途中でエラーが発生しました: {e}", "".join(chunks)
+            ) from e
+        raise gemini_chat.ChatResponseError(f"AI応答の取得中にエラーが発生しました: {e}") from e
+    if not chunks:
+        raise gemini_chat.ChatResponseError("AIから空の応答が返されました。")
+    # 最後まで受け取れた応答だけをキャッシュする
+    await asyncio.to_thread(response_cache.put, 'chat', cache_key, "".join(chunks))
+
+
+async def analyze_diary_entry_async(full_chat_log_text):
+    """gemini_chat.analyze_diary_entry の非同期版。(要約, 感情スコア) を返し、失敗したら (None, None)。"""
+    model = gemini_chat.model
+    if not model:
+        logger.error("Gemini APIが設定されていません。分析を実行できません。")
+        return None, None
+    cache_key = gemini_chat.analysis_cache_key(full_chat_log_text)
+    cached_result = await asyncio.to_thread(response_cache.get, 'analysis', cache_key)
+    if cached_result is not None:
+        return cached_result['summary'], cached_result['emotions']
+    try:
+        prompt = gemini_chat.build_analysis_prompt(full_chat_log_text)
+        response = await get_client().generate(model, prompt, coalesce_key=cache_key)
+        summary, emotions = gemini_chat.parse_analysis_response(response.text)
+        if summary is None:
+            return None, None
+        await asyncio.to_thread(response_cache.put, 'analysis', cache_key, {'summary': summary, 'emotions': emotions})
+        return summary, emotions
+    except Exception as e:
+        logger.error(f"Gemini APIの分析 (非同期) 呼び出し中にエラーが発生しました: {e}")
+        return None, None
+
+
+# --- 同期の呼び出し口 (Streamlit のスクリプトスレッドから使う) ---
+# 実際の通信は共有のイベントループで行い、呼び出したスレッドは結果を待つだけにする
+
+def get_chat_response(chat_history, context_manager=None, timeout=None, user_id=None):
+    return _runner.run(get_chat_response_async(chat_history, context_manager, user_id), timeout=timeout)
+
+
+def analyze_diary_entry(full_chat_log_text, timeout=None):
+    return _runner.run(analyze_diary_entry_async(full_chat_log_text), timeout=timeout)
+
+
+_STREAM_END = object()
+
+
+def stream_chat_response(chat_history, context_manager=None, user_id=None):
+    """
+    stream_chat_response_async を共有のイベントループで実行し、届いた断片を順に返す (同期ジェネレータ)。
+    st.write_stream にそのまま渡せる。途中で読むのをやめた場合はループ側の処理も取り消す。
+    """
+    chunks = queue.Queue()
+
+    async def pump():
+        try:
+            async for text in stream_chat_response_async(chat_history, context_manager, user_id):
+                chunks.put(text)
+        except BaseException as e:
+            chunks.put(e)
+            raise
+        finally:
+            chunks.put(_STREAM_END)
+
+    future = _runner.submit(pump())
+    try:
+        while True:
+            item = chunks.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        future.cancel()
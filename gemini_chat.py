@@ -2,15 +2,27 @@
 import google.generativeai as genai
 import os
 import json
+import logging
 from dotenv import load_dotenv
+import response_cache
+import gemini_client
+import tracing
+from gemini_client import GeminiUnavailableError
+
+logger = logging.getLogger(__name__)
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
 API_KEY = os.getenv("GEMINI_API_KEY")
+MODEL_NAME = 'gemini-1.5-flash'
+# プロンプトを変更したら上げる (キャッシュ済みの古い応答を使わないようにするため)
+CHAT_PROMPT_VERSION = 1
+ANALYSIS_PROMPT_VERSION = 1
+CHAT_DEADLINE = float(os.getenv("GEMINI_CHAT_DEADLINE", "30")) # チャット応答の期限 (秒、順番待ち・リトライ込み)
 
 if not API_KEY:
     # アプリケーション実行時にエラーを出すよりは、ログ等で通知する方が良いかも
-    print("警告: 環境変数 'GEMINI_API_KEY' が設定されていません。API連携は失敗します。")
+    logger.warning("環境変数 'GEMINI_API_KEY' が設定されていません。API連携は失敗します。")
     # raise ValueError("環境変数 'GEMINI_API_KEY' が設定されていません。") # 起動時に落とす場合
 
 # Gemini API の設定
@@ -23,53 +35,255 @@ try:
         {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
         {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
     ]
-    model = genai.GenerativeModel('gemini-1.5-flash', safety_settings=safety_settings)
+    model = genai.GenerativeModel(MODEL_NAME, safety_settings=safety_settings)
 except Exception as e:
-    print(f"Gemini APIの設定中にエラーが発生しました: {e}")
+    logger.error(f"Gemini APIの設定中にエラーが発生しました: {e}")
     # エラー発生時も model オブジェクトがない状態になるため、以降の呼び出しでエラーになる
     model = None # model が None であることで以降の処理で API 不可を判定できる
 
 
-def get_chat_response(prompt, chat_history):
+def set_model(new_model):
+    """
+    使用するモデルを差し替える (ベンチマークやオフライン検証でスタブを使うため)。
+    new_model は generate_content(contents) を持ち、.text を返すオブジェクトであればよい。
+    Returns:
+        差し替え前のモデル (元に戻す場合に使う)。
+    """
+    global model
+    previous_model = model
+    model = new_model
+    return previous_model
+
+
+# --- 会話コンテキストの管理 ---
+CONTEXT_KEEP_MESSAGES = int(os.getenv("CHAT_CONTEXT_KEEP_MESSAGES", "8")) # そのまま送る直近のメッセージ数
+CONTEXT_MAX_CHARS = int(os.getenv("CHAT_CONTEXT_MAX_CHARS", "8000")) # 1回に送るコンテキストの文字数の上限
+SUMMARY_MAX_CHARS = 800 # 要約メッセージの文字数の上限
+
+
+def _message_text(message):
+    return "".join(str(part) for part in message.get('parts', []))
+
+
+def summarize_history(previous_summary, messages):
+    """
+    これまでの要約に新しいメッセージを取り込み、更新した要約を返す。
+    API が使えない・失敗した場合は、末尾を切り詰めた単純な連結で代用する。
+    """
+    new_lines = "\n".join(
+        f"{'ユーザー' if m.get('role') == 'user' else 'AI'}: {_message_text(m)}" for m in messages
+    )
+    if model:
+        prompt = f"""
+以下は日記を書くためのユーザーとAIの会話です。「これまでの要約」に「新しい会話」の内容を取り込み、
+ユーザーが話した出来事・気持ちを落とさないように、{SUMMARY_MAX_CHARS}文字以内の要約を作り直してください。
+要約の文章のみを出力してください。
+
+--- これまでの要約 ---
+{previous_summary or "(なし)"}
+--- 新しい会話 ---
+{new_lines}
+--- ここまで ---
+"""
+        try:
+            summary = gemini_client.get_client().generate(model, prompt, deadline=CHAT_DEADLINE).text.strip()
+            if summary:
+                return summary[:SUMMARY_MAX_CHARS]
+        except Exception as e:
+            logger.warning(f"会話の要約中にエラーが発生しました (切り詰めで代用します): {e}")
+    combined = f"{previous_summary}\n{new_lines}".strip()
+    return combined[-SUMMARY_MAX_CHARS:]
+
+
+class ChatContextManager:
+    """
+    Gemini に送る会話コンテキストの大きさを一定に保つ。
+    直近 keep_messages 件のメッセージはそのまま送り、それより古いメッセージは
+    要約 (summary) に少しずつ取り込んでいく。要約は1つのセッションの中で使い回す。
+    """
+
+    def __init__(self, keep_messages=CONTEXT_KEEP_MESSAGES, max_chars=CONTEXT_MAX_CHARS,
+                 summarize_fn=None, fold_batch=4):
+        self.keep_messages = keep_messages
+        self.max_chars = max_chars
+        self.fold_batch = fold_batch # 要約の更新は数メッセージ分まとめて行い、API 呼び出しを減らす
+        self.summary = ""
+        self.summarized_count = 0 # 要約に取り込み済みのメッセージ数 (履歴の先頭から)
+        self.metrics = [] # ターンごとのプロンプトサイズ
+        self._summarize = summarize_fn or summarize_history
+
+    def _fold(self, chat_history, cutoff):
+        """chat_history[summarized_count:cutoff] を要約に取り込む"""
+        if cutoff > self.summarized_count:
+            self.summary = self._summarize(self.summary, chat_history[self.summarized_count:cutoff])
+            self.summarized_count = cutoff
+
+    def _next_user_index(self, chat_history, index):
+        """index 以降で最初のユーザーメッセージの位置を返す (送る履歴がユーザーの発言から始まるように揃える)"""
+        while index < len(chat_history) - 1 and chat_history[index].get('role') != 'user':
+            index += 1
+        return index
+
+    def _context_chars(self, chat_history, start):
+        return len(self.summary) + sum(len(_message_text(m)) for m in chat_history[start:])
+
+    def build_context(self, chat_history):
+        """
+        chat_history から、実際に Gemini に送るメッセージのリストを作る。
+        古いメッセージは要約に置き換え、要約は送る最初のユーザーメッセージの先頭に付け加える。
+        """
+        cutoff = max(0, len(chat_history) - self.keep_messages)
+        if cutoff - self.summarized_count >= self.fold_batch:
+            self._fold(chat_history, self._next_user_index(chat_history, cutoff))
+
+        # 文字数の上限を超える場合は、さらに古いものから要約に回す (最新のメッセージは必ず残す)
+        start = self.summarized_count
+        while start < len(chat_history) - 1 and self._context_chars(chat_history, start) > self.max_chars:
+            start = self._next_user_index(chat_history, start + 1)
+        self._fold(chat_history, start)
+
+        context = [dict(m) for m in chat_history[self.summarized_count:]]
+        if self.summary and context:
+            first = context[0]
+            first['parts'] = [f"(これまでの会話の要約: {self.summary})\n"] + list(first.get('parts', []))
+
+        prompt_chars = sum(len(_message_text(m)) for m in context)
+        self.metrics.append({
+            'turn': len(self.metrics) + 1,
+            'history_messages': len(chat_history),
+            'sent_messages': len(context),
+            'summarized_messages': self.summarized_count,
+            'summary_chars': len(self.summary),
+            'prompt_chars': prompt_chars,
+        })
+        return context
+
+    @property
+    def last_metrics(self):
+        """直近のターンのプロンプトサイズ (まだ送っていなければ None)"""
+        return self.metrics[-1] if self.metrics else None
+
+
+def _prepare_contents(chat_history, context_manager):
+    contents = context_manager.build_context(chat_history) if context_manager else chat_history
+    prompt_chars = sum(len(_message_text(m)) for m in contents)
+    logger.debug(f"Sending {len(contents)}/{len(chat_history)} messages ({prompt_chars} chars) to Gemini")
+    return contents
+
+
+def get_chat_response(prompt, chat_history, context_manager=None, user_id=None):
     """
     ユーザーのプロンプトと会話履歴を受け取り、AIの応答を返す。
     Args:
         prompt (str): ユーザーからの最新の入力 (実際には履歴の最後)。
         chat_history (list): これまでの会話履歴のリスト。
+        context_manager (ChatContextManager): 指定すると、古い履歴を要約に置き換えて送る。
+        user_id (int): 会話しているユーザー。指定したときだけ、そのユーザーの応答としてキャッシュする。
     Returns:
         str: AIからの応答テキスト。
         list: 更新された会話履歴。
+    Raises:
+        GeminiUnavailableError: 混雑 (429) などでリトライしても応答が得られなかった。
+        ChatResponseError: それ以外の理由で応答が得られなかった (エラー文を応答として履歴に残さないため)。
     """
     if not model:
-        return "エラー: Gemini APIが設定されていません。", chat_history
+        raise ChatResponseError("Gemini APIが設定されていません。")
 
     try:
         # 履歴全体をコンテキストとして応答を生成 (履歴は app.py で管理・更新)
         # chat_history は get する時点での完全な履歴のはず
-        print(f"DEBUG: Sending history to Gemini: {chat_history}") # デバッグ用
-        response = model.generate_content(chat_history) # 履歴全体を渡す
+        contents = _prepare_contents(chat_history, context_manager)
+        # 二重送信やリトライで同じ内容を送った場合は、直前の応答を使い回す
+        cache_key = chat_cache_key(contents, user_id)
+        cached_response = response_cache.get('chat', cache_key)
+        if cached_response is not None:
+            tracing.incr('gemini.chat.cache_hits')
+            logger.debug("Using cached chat response")
+            return cached_response, chat_history
+
+        response = gemini_client.get_client().generate(model, contents, deadline=CHAT_DEADLINE)
 
         ai_response = response.text
+        response_cache.put('chat', cache_key, ai_response)
         # AIの応答を履歴に追加 (これは呼び出し元の app.py で行うべき)
         # chat_history.append({'role':'model', 'parts': [ai_response]}) # ここでは変更しない
 
-        print(f"DEBUG: Received response from Gemini: {ai_response}") # デバッグ用
+        logger.debug(f"Received response from Gemini ({len(ai_response)} chars)")
         return ai_response, chat_history # 応答テキストと、変更前の履歴を返す
 
+    except GeminiUnavailableError:
+        raise
     except Exception as e:
-        print(f"Gemini API チャット呼び出し中にエラーが発生しました: {e}")
-        if hasattr(e, 'response'): print("エラーレスポンス詳細:", e.response)
-        return f"AI応答の取得中にエラーが発生しました: {e}", chat_history
+        logger.error(f"Gemini API チャット呼び出し中にエラーが発生しました: {e}")
+        raise ChatResponseError(f"AI応答の取得中にエラーが発生しました: {e}") from e
 
-def analyze_diary_entry(full_chat_log_text):
+class ChatResponseError(Exception):
     """
-    チャットログ全体を受け取り、要約と感情分析を行い、結果を辞書で返す。
+    応答を1文字も受け取らないうちに失敗した (400、安全性フィルタでのブロック、通信エラー、API 未設定など)。
+    エラー文を応答として返すと履歴に保存されて Gemini にも送り返されるため、例外にする。
+    """
+
+class ChatStreamInterruptedError(Exception):
+    """
+    応答のストリーミングが途中で失敗した (一部の断片は表示済み)。
+    途中までの応答は partial_text に入れる。本物の応答として履歴に残さないこと。
+    """
+    def __init__(self, message, partial_text=""):
+        super().__init__(message)
+        self.partial_text = partial_text
+
+def stream_chat_response(chat_history, context_manager=None, user_id=None):
+    """
+    会話履歴を受け取り、AIの応答を生成されたそばから断片ごとに返すジェネレータ。
+    get_chat_response のストリーミング版で、最初の断片が届いた時点で表示を始められる。
+    Args:
+        chat_history (list): これまでの会話履歴のリスト (最新のユーザー入力を含む)。
+        context_manager (ChatContextManager): 指定すると、古い履歴を要約に置き換えて送る。
+        user_id (int): 会話しているユーザー。指定したときだけ、そのユーザーの応答としてキャッシュする。
+    Yields:
+        str: AIからの応答テキストの断片。
+    Raises:
+        GeminiUnavailableError: 混雑 (429) などでリトライしても応答が得られなかった。
+            何も表示していない段階で起きるので、呼び出し側で入力をやり直してもらう。
+        ChatResponseError: それ以外の理由で最初の断片の前に失敗した (空の応答を含む)。
+            GeminiUnavailableError と同じく、呼び出し側で入力をやり直してもらう。
+        ChatStreamInterruptedError: 断片を返した後に失敗した。途中までの応答にエラー文を続けて
+            返すと1つの応答として保存されてしまうため、例外にして呼び出し側で破棄してもらう。
     """
     if not model:
-        print("エラー: Gemini APIが設定されていません。分析を実行できません。")
-        return None, None
+        raise ChatResponseError("Gemini APIが設定されていません。")
+
+    chunks = [] # 返した断片 (途中で失敗したかの判定と、キャッシュ用)
+    try:
+        contents = _prepare_contents(chat_history, context_manager)
+        cache_key = chat_cache_key(contents, user_id)
+        cached_response = response_cache.get('chat', cache_key)
+        if cached_response is not None:
+            tracing.incr('gemini.chat.cache_hits')
+            yield cached_response
+            return
+
+        response = gemini_client.get_client().stream(model, contents, deadline=CHAT_DEADLINE)
+        for chunk in response:
+            text = chunk.text
+            if text:
+                chunks.append(text)
+                yield text
+    except (GeminiUnavailableError, ChatResponseError):
+        raise
+    except Exception as e:
+        logger.error(f"Gemini API チャット (ストリーミング) 呼び出し中にエラーが発生しました: {e}")
+        if chunks:
+            raise ChatStreamInterruptedError(f"AI応答の途中でエラーが発生しました: {e}", "".join(chunks)) from e
+        raise ChatResponseError(f"AI応答の取得中にエラーが発生しました: {e}") from e
+    if not chunks:
+        raise ChatResponseError("AIから空の応答が返されました。")
+    # 最後まで受け取れた応答だけをキャッシュする
+    response_cache.put('chat', cache_key, "".join(chunks))
 
-    prompt = f"""
+def build_analysis_prompt(full_chat_log_text):
+    """要約と感情分析を依頼するプロンプトを作る"""
+    return f"""
 以下のチャットログを分析し、以下の2つの要素を含むJSON形式で結果を返してください。
 
 1.  **summary**: チャットログの内容を簡潔に要約した日記風の文章。ユーザーの発言を中心にまとめてください。
@@ -98,43 +312,84 @@ def analyze_diary_entry(full_chat_log_text):
 
 JSON形式の出力のみを生成してください。他の説明文は不要です。
 """
-    print("Gemini APIに分析リクエストを送信中...")
+
+def parse_analysis_response(response_text):
+    """
+    分析の応答 (JSON、```json で囲まれていてもよい) を検証して取り出す。
+    Returns:
+        str: 要約 (不正な応答なら None)。
+        dict: 5つの感情スコア (不正な応答なら None)。
+    """
+    response_text = response_text.strip()
+    if response_text.startswith("```json"):
+        response_text = response_text[7:].strip()
+    if response_text.endswith("```"):
+        response_text = response_text[:-3].strip()
+
+    try:
+        result_data = json.loads(response_text)
+    except json.JSONDecodeError as json_e:
+        # 応答全体は日記の内容を含むため、ログには長さと先頭だけを出す
+        logger.error(f"Geminiからの応答が期待したJSON形式ではありませんでした ({len(response_text)} chars): {json_e}")
+        logger.debug(f"受け取ったテキストの先頭: {response_text[:200]!r}")
+        return None, None
+    summary = result_data.get("summary")
+    emotions = result_data.get("emotions")
+
+    # より厳密なバリデーション
+    required_emotions = {'joy', 'anger', 'sadness', 'anxiety', 'relief'}
+    if isinstance(summary, str) and summary.strip() and \
+       isinstance(emotions, dict) and required_emotions.issubset(emotions.keys()) and \
+       all(isinstance(emotions[key], int) and 0 <= emotions[key] <= 100 for key in required_emotions):
+        # 不要なキーが含まれていても許容するが、必要な5つは必須とする
+        valid_emotions = {key: emotions[key] for key in required_emotions}
+        logger.debug(f"分析成功 (要約 {len(summary)} chars): {valid_emotions}")
+        return summary, valid_emotions
+    logger.error(f"取得したJSONの形式または内容が不正です (キー: {sorted(result_data) if isinstance(result_data, dict) else type(result_data).__name__})")
+    return None, None
+
+def analysis_cache_key(full_chat_log_text):
+    return response_cache.make_key('analysis', full_chat_log_text, ANALYSIS_PROMPT_VERSION, MODEL_NAME)
+
+def chat_cache_key(contents, user_id):
+    """
+    チャット応答のキャッシュキー。同じ会話でも別のユーザーの応答は返さないよう、user_id をキーに含める。
+    user_id が None (ユーザーが分からない) ならキャッシュしない (None を返す)。
+    """
+    if user_id is None:
+        return None
+    return response_cache.make_key('chat', {'user_id': user_id, 'contents': contents}, CHAT_PROMPT_VERSION, MODEL_NAME)
+
+def analyze_diary_entry(full_chat_log_text):
+    """
+    チャットログ全体を受け取り、要約と感情分析を行い、結果を辞書で返す。
+    """
+    if not model:
+        logger.error("Gemini APIが設定されていません。分析を実行できません。")
+        return None, None
+
+    prompt = build_analysis_prompt(full_chat_log_text)
+    # 同じチャットログ (リトライ、二重クリック、DB保存の失敗後など) は API を呼ばずに前回の結果を返す
+    cache_key = analysis_cache_key(full_chat_log_text)
+    cached_result = response_cache.get('analysis', cache_key)
+    if cached_result is not None:
+        tracing.incr('gemini.analysis.cache_hits')
+        logger.debug("分析結果をキャッシュから取得しました。")
+        return cached_result['summary'], cached_result['emotions']
+
+    logger.debug("Gemini APIに分析リクエストを送信中...")
     try:
         # JSONモードを試す場合:
         # response = model.generate_content(prompt, generation_config=genai.types.GenerationConfig(response_mime_type="application/json"))
-        response = model.generate_content(prompt)
+        # 同じチャットログの分析が実行中なら (保存の連打など)、API を呼ばずにその結果を待つ
+        response = gemini_client.get_client().generate(model, prompt, coalesce_key=cache_key)
 
-        response_text = response.text.strip()
-        if response_text.startswith("```json"):
-            response_text = response_text[7:].strip()
-        if response_text.endswith("```"):
-            response_text = response_text[:-3].strip()
-
-        result_data = json.loads(response_text)
-        summary = result_data.get("summary")
-        emotions = result_data.get("emotions")
-
-        # より厳密なバリデーション
-        required_emotions = {'joy', 'anger', 'sadness', 'anxiety', 'relief'}
-        if isinstance(summary, str) and summary.strip() and \
-           isinstance(emotions, dict) and required_emotions.issubset(emotions.keys()) and \
-           all(isinstance(emotions[key], int) and 0 <= emotions[key] <= 100 for key in required_emotions):
-            # 不要なキーが含まれていても許容するが、必要な5つは必須とする
-            valid_emotions = {key: emotions[key] for key in required_emotions}
-            print("分析成功:", summary, valid_emotions)
-            return summary, valid_emotions
-        else:
-            print("エラー: 取得したJSONの形式または内容が不正です。")
-            print("受け取ったデータ:", result_data)
+        summary, valid_emotions = parse_analysis_response(response.text)
+        if summary is None:
             return None, None
+        response_cache.put('analysis', cache_key, {'summary': summary, 'emotions': valid_emotions})
+        return summary, valid_emotions
 
-    except json.JSONDecodeError as json_e:
-        print(f"エラー: Geminiからの応答が期待したJSON形式ではありませんでした。")
-        print(f"エラー詳細: {json_e}")
-        print("--- 受け取ったテキスト ---")
-        print(response.text)
-        return None, None
     except Exception as e:
-        print(f"Gemini APIの分析呼び出し中にエラーが発生しました: {e}")
-        if hasattr(e, 'response'): print("エラーレスポンス詳細:", e.response)
+        logger.error(f"Gemini APIの分析呼び出し中にエラーが発生しました: {e}")
         return None, None
\ No newline at end of file
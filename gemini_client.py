@@ -0,0 +1,366 @@
+# gemini_client.py
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# --- 設定 ---
+MAX_CONCURRENT = int(os.getenv("GEMINI_MAX_CONCURRENT", "4")) # 同時に送るリクエスト数の上限
+RATE_PER_MINUTE = float(os.getenv("GEMINI_RATE_PER_MINUTE", "60")) # 1分あたりのリクエスト数の上限 (0 で無制限)
+MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "4")) # 1回の呼び出しで試行する回数 (リトライ含む)
+BACKOFF_BASE = 1.0 # リトライ間隔の基準 (秒)。1, 2, 4, ... と倍々に伸ばす
+BACKOFF_MAX = 20.0 # リトライ間隔の上限 (秒)
+DEFAULT_DEADLINE = float(os.getenv("GEMINI_DEADLINE", "60")) # 順番待ち・リトライを含めた1回の呼び出しの期限 (秒)
+BREAKER_WINDOW = 20 # サーキットブレーカーが見る直近の呼び出し数
+BREAKER_FAILURE_RATIO = 0.6 # 直近の呼び出しのうちこの割合以上が失敗したら、しばらく API を呼ばずに即座に失敗させる
+BREAKER_MIN_CALLS = 10 # 直近の呼び出しがこれより少ないうちは判定しない
+BREAKER_RESET_SECONDS = 30.0 # 遮断してから試しに1回だけ呼んでみるまでの秒数
+
+# 時間をおけば成功する可能性があるエラー (HTTP ステータス)
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class GeminiUnavailableError(Exception):
+    """リトライしても応答を得られなかった (混雑・障害・期限切れ)"""
+
+
+class CircuitOpenError(GeminiUnavailableError):
+    """連続して失敗しているため、API を呼ばずに失敗させた"""
+
+
+class DeadlineExceededError(GeminiUnavailableError):
+    """期限内に応答を得られなかった"""
+
+
+def status_code(error):
+    """google.api_core の例外 (ResourceExhausted など) の HTTP ステータスを返す (不明なら None)"""
+    code = getattr(error, 'code', None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(error):
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return status_code(error) in RETRYABLE_STATUS
+
+
+class TokenBucket:
+    """1秒あたり rate 個のトークンを補充し、最大 capacity 個まで貯めるレート制限"""
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """トークンが取れれば1つ取って 0 を、取れなければ次のトークンが貯まるまでの秒数を返す (待たない)"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """トークンを1つ取る。timeout 秒以内に取れなければ False。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    直近 window 回の呼び出しのうち failure_ratio 以上が失敗したら「遮断」し、
+    reset_seconds の間は呼び出しを即座に失敗させる。
+    時間が経ったら1回だけ試し、成功すれば元に戻し、失敗すればまた遮断する。
+    (連続失敗回数で判定すると、同時に多数の呼び出しがあるときに成功の記録が間に合わず遮断しやすいため、割合で判定する)
+    """
+
+    def __init__(self, window=BREAKER_WINDOW, failure_ratio=BREAKER_FAILURE_RATIO,
+                 min_calls=BREAKER_MIN_CALLS, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.reset_seconds = reset_seconds
+        self._outcomes = deque(maxlen=window) # True = 失敗
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            return 'half_open' if time.monotonic() - self._opened_at >= self.reset_seconds else 'open'
+
+    def allow(self):
+        """呼び出してよければ True"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_running:
+                return False
+            self._trial_running = True # 試しの1回だけ通す
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._outcomes.append(False)
+            if self._trial_running:
+                self._outcomes.clear() # 回復したので、遮断前の失敗は数えない
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(True)
+            failures = sum(self._outcomes)
+            if self._trial_running or (
+                len(self._outcomes) >= self.min_calls and failures >= self.failure_ratio * len(self._outcomes)
+            ):
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release_trial(self):
+        """試しの呼び出しが API の障害とは関係のない理由で終わったとき、次の呼び出しで試せるようにする"""
+        with self._lock:
+            self._trial_running = False
+
+
+class GeminiClient:
+    """
+    model.generate_content の呼び出しを包み、次のことを行う。
+    - 同時実行数 (セマフォ) と1分あたりのリクエスト数 (トークンバケット) の制限
+    - 429 や 5xx のときの揺らぎ付き指数バックオフでのリトライ (呼び出しごとの期限内)
+    - 失敗が続いたときのサーキットブレーカー
+    - 同じキーの呼び出しが実行中なら、API を呼ばずにその結果を待って共有する
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT, rate_per_minute=RATE_PER_MINUTE,
+                 max_attempts=MAX_ATTEMPTS, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 default_deadline=DEFAULT_DEADLINE, breaker=None):
+        self.max_concurrent = max_concurrent
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.default_deadline = default_deadline
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        # 非同期版 (gemini_async) もこのバケットとブレーカーを共有し、クォータを合わせて守る
+        self.bucket = TokenBucket(rate_per_minute / 60, max_concurrent) if rate_per_minute > 0 else None
+        self._in_flight = {} # 合流用のキー -> Future
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0, 'attempts': 0, 'retries': 0, 'successes': 0, 'failures': 0,
+            'rate_limited': 0, 'deadline_exceeded': 0, 'circuit_rejections': 0, 'coalesced': 0,
+            'queue_wait_seconds': 0.0, 'max_queue_wait_seconds': 0.0,
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def backoff_delay(self, attempt):
+        """attempt 回目の失敗後の待ち時間 (秒)。同時に失敗した呼び出しが揃って再試行しないよう揺らぎを入れる。"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** max(0, attempt - 1)))
+        return random.uniform(delay / 2, delay)
+
+    def _acquire_slot(self, deadline):
+        """レート制限と同時実行数の枠を取る。待った時間を記録し、期限までに取れなければ例外。"""
+        started = time.monotonic()
+        acquired = (self.bucket is None or self.bucket.acquire(timeout=max(0.0, deadline - started)))
+        acquired = acquired and self._slots.acquire(timeout=max(0.0, deadline - time.monotonic()))
+        waited = time.monotonic() - started
+        with self._lock:
+            self._stats['queue_wait_seconds'] += waited
+            self._stats['max_queue_wait_seconds'] = max(self._stats['max_queue_wait_seconds'], waited)
+        if not acquired:
+            self._count('deadline_exceeded')
+            raise DeadlineExceededError("Gemini API の順番待ちが期限を超えました。")
+
+    def _call_with_retry(self, call, deadline, hold_slot=False):
+        """
+        call(timeout) を期限までリトライしながら実行する。
+        call は枠を取った状態で呼ばれ、戻り値を返すか例外を投げる。
+        hold_slot=True の場合は成功しても枠を返さない (呼び出し側がストリームを読み終えてから返す)。
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self._count('circuit_rejections')
+                self._count('failures')
+                raise CircuitOpenError("Gemini API への接続を一時的に停止しています。しばらくしてからお試しください。")
+            try:
+                self._acquire_slot(deadline)
+            except DeadlineExceededError:
+                self.breaker.release_trial()
+                self._count('failures')
+                raise
+            attempt += 1
+            self._count('attempts')
+            try:
+                result = call(max(0.1, deadline - time.monotonic()))
+            except Exception as e:
+                self._slots.release()
+                if not is_retryable(e):
+                    self.breaker.release_trial()
+                    self._count('failures')
+                    raise
+                self.breaker.record_failure()
+                if status_code(e) == 429:
+                    self._count('rate_limited')
+                delay = self.backoff_delay(attempt)
+                if attempt >= self.max_attempts or time.monotonic() + delay >= deadline:
+                    self._count('failures')
+                    if time.monotonic() + delay >= deadline:
+                        self._count('deadline_exceeded')
+                    raise GeminiUnavailableError(f"Gemini API の呼び出しに {attempt} 回失敗しました: {e}") from e
+                self._count('retries')
+                logger.warning(f"Gemini API の呼び出しに失敗しました ({e})。{delay:.1f}秒後に再試行します ({attempt}/{self.max_attempts})。")
+                time.sleep(delay)
+                continue
+            if not hold_slot:
+                self._slots.release()
+            self.breaker.record_success()
+            return result
+
+    def generate(self, model, contents, deadline=None, coalesce_key=None, **kwargs):
+        """
+        model.generate_content(contents) を制限・リトライ付きで呼び、応答を返す。
+        Args:
+            deadline (float): 順番待ち・リトライを含めた期限 (秒)。省略時は default_deadline。
+            coalesce_key (str): 同じキーの呼び出しが実行中なら、その結果を共有する。
+        Raises:
+            GeminiUnavailableError: 混雑・障害・期限切れで応答を得られなかった。
+        """
+        self._count('requests')
+        deadline_at = time.monotonic() + (deadline or self.default_deadline)
+        future = None
+        if coalesce_key is not None:
+            with self._lock:
+                leader = self._in_flight.get(coalesce_key)
+                if leader is None:
+                    future = self._in_flight[coalesce_key] = Future()
+            if leader is not None:
+                self._count('coalesced')
+                try:
+                    return leader.result(timeout=max(0.0, deadline_at - time.monotonic()))
+                except FutureTimeoutError:
+                    self._count('deadline_exceeded')
+                    raise DeadlineExceededError("Gemini API の応答 (実行中の同じリクエスト) を待つ間に期限を超えました。")
+
+        sent = tracing.payload_bytes(contents)
+
+        def call(timeout):
+            # 試行ごとに計測する (リトライの待ち時間は含めない)
+            with tracing.span('gemini.generate') as span:
+                span.add_bytes(sent=sent)
+                response = model.generate_content(contents, request_options={'timeout': timeout}, **kwargs)
+                # 応答本文に問題があればここで例外になる
+                span.add_bytes(received=len(response.text.encode('utf-8')))
+            return response
+
+        try:
+            response = self._call_with_retry(call, deadline_at)
+        except Exception as e:
+            if future is not None:
+                future.set_exception(e)
+            raise
+        else:
+            self._count('successes')
+            if future is not None:
+                future.set_result(response)
+            return response
+        finally:
+            if future is not None:
+                with self._lock:
+                    self._in_flight.pop(coalesce_key, None)
+
+    def stream(self, model, contents, deadline=None, **kwargs):
+        """
+        model.generate_content(contents, stream=True) を制限・リトライ付きで呼び、断片を順に返すジェネレータ。
+        最初の断片が届くまでに失敗した場合だけリトライする (途中まで表示した応答は重複させない)。
+        """
+        self._count('requests')
+        deadline_at = time.monotonic() + (deadline or self.default_deadline)
+
+        sent = tracing.payload_bytes(contents)
+
+        def call(timeout):
+            # 試行ごとに、最初の断片が届くまでを計測する
+            with tracing.span('gemini.stream.first_chunk') as span:
+                span.add_bytes(sent=sent)
+                chunks = iter(model.generate_content(contents, stream=True, request_options={'timeout': timeout}, **kwargs))
+                return chunks, next(chunks, None)
+
+        with tracing.span('gemini.stream') as span:
+            chunks, first = self._call_with_retry(call, deadline_at, hold_slot=True)
+            # 枠はストリームを最後まで受け取るまで保持する
+            try:
+                if first is not None:
+                    span.add_bytes(received=len(first.text.encode('utf-8')))
+                    yield first
+                for chunk in chunks:
+                    span.add_bytes(received=len(chunk.text.encode('utf-8')))
+                    yield chunk
+                self._count('successes')
+            finally:
+                self._slots.release()
+
+    def get_stats(self):
+        """呼び出し・リトライ・失敗などの回数と、順番待ちの平均・最大 (ms)、ブレーカーの状態を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+        waited = stats.pop('queue_wait_seconds')
+        stats['avg_queue_wait_ms'] = waited / stats['attempts'] * 1000 if stats['attempts'] else 0.0
+        stats['max_queue_wait_ms'] = stats.pop('max_queue_wait_seconds') * 1000
+        stats['breaker'] = self.breaker.state
+        return stats
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """プロセス全体で共有するクライアントを返す (全セッションで同じ枠を使うため)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GeminiClient()
+        return _client
+
+
+def configure(**kwargs):
+    """
+    共有クライアントを指定した設定で作り直す (ベンチマークや検証用)。
+    Returns:
+        差し替え前のクライアント。
+    """
+    global _client
+    with _client_lock:
+        previous, _client = _client, GeminiClient(**kwargs)
+    return previous
+
+
+def get_stats():
+    return get_client().get_stats()
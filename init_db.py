@@ -1,36 +1,31 @@
 # init_db.py
+import logging
 import sqlite3
 from auth import hash_password # auth.py からインポート
 import os # osモジュールを追加
+import sys
+import time
+import db
+import log_codec
+import tracing
 
-DB_NAME = "diary_app.db"
+logger = logging.getLogger(__name__)
 
-def initialize_database():
-    """データベースファイルを初期化し、必要なテーブルを作成し、テストユーザーを追加する"""
-    print("[init_db] initialize_database() 開始") # 開始ログ
-    conn = None # 接続オブジェクトを初期化
-    cursor = None # カーソルオブジェクトも初期化
-    try:
-        print(f"[init_db] データベース '{DB_NAME}' に接続試行...")
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        print("[init_db] データベース接続成功。")
-
-        # users テーブルの作成
-        print("[init_db] users テーブル作成試行...")
-        cursor.execute("""
+# --- スキーママイグレーション ---
+# (バージョン番号, 説明, 実行するSQLのリスト) の順に並べる。
+# 適用済みのバージョンは PRAGMA user_version に記録され、未適用のものだけが順番に実行される。
+# 既存のマイグレーションは書き換えず、変更は必ず新しい番号で追加すること。
+MIGRATIONS = [
+    (1, "基本テーブル (users, entries, emotions) の作成", [
+        """
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
-        """)
-        print("[init_db] users テーブル作成/確認完了。")
-
-        # entries テーブルの作成
-        print("[init_db] entries テーブル作成試行...")
-        cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS entries (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -40,12 +35,8 @@ def initialize_database():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
-        """)
-        print("[init_db] entries テーブル作成/確認完了。")
-
-        # emotions テーブルの作成
-        print("[init_db] emotions テーブル作成試行...")
-        cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS emotions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             entry_id INTEGER NOT NULL,
@@ -57,47 +48,519 @@ def initialize_database():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (entry_id) REFERENCES entries (id)
         )
-        """)
-        print("[init_db] emotions テーブル作成/確認完了。")
+        """,
+    ]),
+    (2, "entries(user_id, entry_date) のインデックス (日記リスト・感情データ取得用)", [
+        # id は rowid なので、この索引だけで一覧クエリ (id, entry_date) が完結する (カバリングインデックス)
+        "CREATE INDEX IF NOT EXISTS idx_entries_user_date ON entries (user_id, entry_date)",
+    ]),
+    (3, "emotions(entry_id) のユニークインデックス (entries との JOIN 用)", [
+        # 1エントリーにつき感情スコアは1件。万一重複があれば最初の1件だけ残す
+        "DELETE FROM emotions WHERE id NOT IN (SELECT MIN(id) FROM emotions GROUP BY entry_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_emotions_entry_id ON emotions (entry_id)",
+    ]),
+    (4, "entries に分析状態の列を追加 (バックグラウンド分析用)", [
+        # 'pending' (分析待ち) / 'done' (分析済み) / 'failed' (リトライ上限に達した)。既存の日記は分析済み
+        "ALTER TABLE entries ADD COLUMN analysis_status TEXT NOT NULL DEFAULT 'done'",
+        "ALTER TABLE entries ADD COLUMN analysis_attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE entries ADD COLUMN analysis_error TEXT",
+        # 分析が終わっていない日記だけを載せる部分インデックス (再開時・サイドバー表示用)
+        "CREATE INDEX IF NOT EXISTS idx_entries_analysis_pending ON entries (user_id) WHERE analysis_status != 'done'",
+    ]),
+    (5, "Gemini 応答のキャッシュテーブル (同じ入力の再送を避ける)", [
+        """
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,   -- 入力・プロンプト版・モデル名のハッシュ
+            kind TEXT NOT NULL,           -- 'analysis' / 'chat'
+            payload TEXT NOT NULL,        -- 応答 (JSON)
+            created_at REAL NOT NULL,     -- UNIX 時刻
+            last_used_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used_at)",
+    ]),
+    (6, "日記の全文検索用 FTS5 テーブルと同期トリガー (既存の日記は --backfill-search-index で登録)", [
+        # 日本語は単語の区切りがないため trigram (3文字ずつ) で索引する。rowid は entries.id と同じ
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+            chat_log, summary, user_id UNINDEXED, tokenize = 'trigram'
+        )
+        """,
+        # ORDER BY rank の順位付け: 要約の一致をチャットログより重く評価する (bm25 の重みは列の順)
+        "INSERT INTO entries_fts (entries_fts, rank) VALUES ('rank', 'bm25(1.0, 2.0, 0.0)')",
+        """
+        CREATE TRIGGER IF NOT EXISTS entries_fts_after_insert AFTER INSERT ON entries BEGIN
+            INSERT INTO entries_fts (rowid, chat_log, summary, user_id)
+            VALUES (new.id, new.chat_log, IFNULL(new.summary, ''), new.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS entries_fts_after_update AFTER UPDATE OF chat_log, summary ON entries BEGIN
+            DELETE FROM entries_fts WHERE rowid = old.id;
+            INSERT INTO entries_fts (rowid, chat_log, summary, user_id)
+            VALUES (new.id, new.chat_log, IFNULL(new.summary, ''), new.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS entries_fts_after_delete AFTER DELETE ON entries BEGIN
+            DELETE FROM entries_fts WHERE rowid = old.id;
+        END
+        """,
+    ]),
+    (7, "チャットログの圧縮保存 (entry_logs, log_dicts。既存の日記は --compress-chat-logs で移行)", [
+        # 圧縮用の共有辞書。一度作った辞書は、それを使って圧縮したログを展開するために消さない
+        """
+        CREATE TABLE IF NOT EXISTS log_dicts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data BLOB NOT NULL,
+            sample_count INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # 圧縮したチャットログ。保存後は entries.chat_log を空文字にする (一覧・詳細の読み込みで大きな列を運ばない)
+        """
+        CREATE TABLE IF NOT EXISTS entry_logs (
+            entry_id INTEGER PRIMARY KEY,
+            codec TEXT NOT NULL,
+            dict_id INTEGER,
+            raw_size INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            FOREIGN KEY (entry_id) REFERENCES entries (id),
+            FOREIGN KEY (dict_id) REFERENCES log_dicts (id)
+        )
+        """,
+        # 圧縮したログはトリガーから読めないため、全文検索の索引へのログの登録は保存する側 (db.py) で行う。
+        # 要約の更新だけはトリガーで反映する (索引側のチャットログはそのまま残す)
+        "DROP TRIGGER IF EXISTS entries_fts_after_insert",
+        "DROP TRIGGER IF EXISTS entries_fts_after_update",
+        """
+        CREATE TRIGGER IF NOT EXISTS entries_fts_after_update_summary AFTER UPDATE OF summary ON entries BEGIN
+            UPDATE entries_fts SET summary = IFNULL(new.summary, '') WHERE rowid = new.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS entry_logs_after_entry_delete AFTER DELETE ON entries BEGIN
+            DELETE FROM entry_logs WHERE entry_id = old.id;
+        END
+        """,
+    ]),
+    (8, "進行中のチャットをターンごとに保存するテーブル (chat_sessions, chat_turns)", [
+        # 'open' (会話中) / 'saved' (日記として保存済み。entry_id に保存先) / 'discarded' (破棄)
+        """
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open',
+            entry_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (entry_id) REFERENCES entries (id)
+        )
+        """,
+        # 会話中のセッションだけを載せる部分インデックス (ログイン時の再開用)
+        "CREATE INDEX IF NOT EXISTS idx_chat_sessions_open ON chat_sessions (user_id, updated_at) WHERE status = 'open'",
+        # 1ターン1行で追記する。日記として保存したら entry_logs に圧縮して移し、ここからは消す
+        """
+        CREATE TABLE IF NOT EXISTS chat_turns (
+            session_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,         -- セッション内の順番 (0 から)
+            role TEXT NOT NULL,           -- 'user' / 'model'
+            text TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (session_id, seq),
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (9, "ユーザーごとの感情スコアの集計テーブル (既存の日記は --rebuild-emotion-stats で集計)", [
+        # 日ごとの件数と感情スコアの合計。直近7日・30日の平均を最大30行の範囲検索で計算するために持つ
+        """
+        CREATE TABLE IF NOT EXISTS user_emotion_daily (
+            user_id INTEGER NOT NULL,
+            entry_date DATE NOT NULL,
+            entry_count INTEGER NOT NULL,
+            joy_sum INTEGER NOT NULL,
+            anger_sum INTEGER NOT NULL,
+            sadness_sum INTEGER NOT NULL,
+            anxiety_sum INTEGER NOT NULL,
+            relief_sum INTEGER NOT NULL,
+            PRIMARY KEY (user_id, entry_date)
+        ) WITHOUT ROWID
+        """,
+        # 画面に表示する集計値 (1ユーザー1行)。感情スコアを書き込むトランザクションの中で更新する。
+        # 直近の期間は最後に日記を書いた日 (last_entry_date) までの日数で数える
+        """
+        CREATE TABLE IF NOT EXISTS user_emotion_stats (
+            user_id INTEGER PRIMARY KEY,
+            entry_count INTEGER NOT NULL,      -- 感情スコアのある日記の数
+            first_entry_date DATE,
+            last_entry_date DATE,
+            streak_days INTEGER NOT NULL,      -- last_entry_date まで毎日日記を書いた日数
+            count_7d INTEGER NOT NULL,         -- 直近7日の日記の数
+            count_prev_7d INTEGER NOT NULL,    -- その前の7日 (前週比用)
+            count_30d INTEGER NOT NULL,
+            joy_7d REAL, anger_7d REAL, sadness_7d REAL, anxiety_7d REAL, relief_7d REAL,
+            joy_prev_7d REAL, anger_prev_7d REAL, sadness_prev_7d REAL, anxiety_prev_7d REAL, relief_prev_7d REAL,
+            joy_30d REAL, anger_30d REAL, sadness_30d REAL, anxiety_30d REAL, relief_30d REAL,
+            joy_total INTEGER NOT NULL, anger_total INTEGER NOT NULL, sadness_total INTEGER NOT NULL,
+            anxiety_total INTEGER NOT NULL, relief_total INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+    ]),
+    (10, "ユーザーのデータを置くシャード (users.shard_id。0 はこのファイル自身)", [
+        # シャードのファイルにも同じスキーマを適用する (users は使わない)
+        "ALTER TABLE users ADD COLUMN shard_id INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (11, "ログインセッション (ブラウザの再読み込み・アプリの再起動・別のプロセスでもログイン状態を保つ)", [
+        # トークンそのものではなく SHA-256 を保存する。時刻は UNIX 秒 (response_cache と同じ)
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_seen_at REAL NOT NULL,
+            expires_at REAL NOT NULL,     -- 使われるたびに延長する (スライディング方式)
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)",
+    ]),
+    (12, "アプリの鍵 (SESSION_SECRET が未設定のとき、生成したセッションの署名鍵を全てのプロセスで共有する)", [
+        """
+        CREATE TABLE IF NOT EXISTS app_secrets (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            created_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (13, "感情スコアのデータバージョン (user_emotion_stats.data_version。グラフのキャッシュを全てのプロセスで無効にする)", [
+        # 集計を書き込むたびに 1 増やす。プロセス内のバージョンと違い、別のプロセスの書き込みも分かる
+        "ALTER TABLE user_emotion_stats ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    """データベースに記録されているスキーマバージョン (PRAGMA user_version) を返す"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def apply_migrations(conn):
+    """
+    未適用のマイグレーションを番号順に適用する。
+    各マイグレーションは1つのトランザクションで実行し、成功したら user_version を更新する。
+    Returns:
+        int: 適用後のスキーマバージョン。
+    """
+    current_version = get_schema_version(conn)
+    previous_isolation_level = conn.isolation_level
+    conn.isolation_level = None # BEGIN/COMMIT を明示的に制御する
+    try:
+        for version, description, statements in MIGRATIONS:
+            if version <= current_version:
+                continue
+            logger.info(f"マイグレーション {version} を適用中: {description}")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 他のプロセスが先に適用した場合はスキップする
+                if get_schema_version(conn) >= version:
+                    conn.execute("ROLLBACK")
+                    current_version = get_schema_version(conn)
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+            current_version = version
+            logger.info(f"マイグレーション {version} を適用しました。")
+    finally:
+        conn.isolation_level = previous_isolation_level
+    return current_version
 
-        conn.commit()
-        print(f"[init_db] テーブル作成コミット完了。")
+# ID の上位ビットにシャード番号を入れるテーブル (db.shard_of_id で ID から置き場所を求める)
+SHARDED_ID_TABLES = ('entries', 'emotions', 'chat_sessions')
+
+def initialize_shard(path, base_id):
+    """
+    シャードの DB ファイルを作ってスキーマを適用し、SHARDED_ID_TABLES の採番を base_id の続きから始める。
+    既に初期化済みのファイルに対して実行しても何も変わらない。
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        apply_migrations(conn)
+        with conn:
+            for table in SHARDED_ID_TABLES:
+                # AUTOINCREMENT の採番は sqlite_sequence の値の続きから行われる
+                conn.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? "
+                    "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)",
+                    (table, base_id, table)
+                )
+    finally:
+        conn.close()
+
+def initialize_postgres():
+    """PostgreSQL のスキーマを最新にし、テストユーザーを追加する (DIARY_DB_BACKEND=postgres のとき)"""
+    import storage_postgres
+    version = storage_postgres.apply_migrations()
+    logger.info(f"PostgreSQL のスキーマは version {version} です。")
+    test_username = "testuser"
+    if db.get_user_by_username(test_username):
+        logger.debug(f"テストユーザー '{test_username}' は既に存在するため作成をスキップします。")
+    elif db.create_user(test_username, hash_password("password123")):
+        logger.info(f"テストユーザー '{test_username}' を作成しました。")
+
+def initialize_database():
+    """データベースファイルを初期化し、必要なテーブルを作成し、テストユーザーを追加する"""
+    if db.BACKEND == 'postgres':
+        initialize_postgres()
+        return
+    logger.debug("initialize_database() 開始") # 開始ログ
+    conn = None # 接続オブジェクトを初期化
+    cursor = None # カーソルオブジェクトも初期化
+    try:
+        logger.debug(f"データベース '{db.DB_NAME}' に接続試行...")
+        conn = sqlite3.connect(db.DB_NAME)
+        cursor = conn.cursor()
+        logger.debug("データベース接続成功。")
+
+        # テーブル・インデックスの作成 (未適用のマイグレーションのみ)
+        if get_schema_version(conn) >= SCHEMA_VERSION:
+            logger.debug(f"スキーマは最新です (version {SCHEMA_VERSION})。")
+        else:
+            version = apply_migrations(conn)
+            logger.info(f"スキーマを version {version} に更新しました。")
 
         # --- テストユーザーの追加 ---
-        print("[init_db] テストユーザー追加試行...")
+        logger.debug("テストユーザー追加試行...")
         try:
             test_username = "testuser"
             test_password = "password123"
-            hashed_password = hash_password(test_password)
-
-            # ユーザーを挿入 (既に存在する場合は無視する)
-            cursor.execute('''
-                INSERT OR IGNORE INTO users (username, password_hash)
-                VALUES (?, ?)
-            ''', (test_username, hashed_password))
-            conn.commit()
-            print(f"[init_db] テストユーザー '{test_username}' を作成/確認＆コミット完了。")
+
+            # 既に存在する場合は bcrypt ハッシュ (約250ms) を計算せずに済ませる
+            cursor.execute("SELECT 1 FROM users WHERE username = ?", (test_username,))
+            if cursor.fetchone():
+                logger.debug(f"テストユーザー '{test_username}' は既に存在するため作成をスキップします。")
+            else:
+                hashed_password = hash_password(test_password)
+
+                # ユーザーを挿入 (同時に作成された場合は無視する)
+                cursor.execute('''
+                    INSERT OR IGNORE INTO users (username, password_hash)
+                    VALUES (?, ?)
+                ''', (test_username, hashed_password))
+                conn.commit()
+                logger.info(f"テストユーザー '{test_username}' を作成/確認＆コミット完了。")
         except ImportError:
-            print("[init_db] エラー: auth.py または hash_password関数が見つかりません。")
+            logger.error("auth.py または hash_password関数が見つかりません。")
         except sqlite3.Error as e:
-            print(f"[init_db] テストユーザー作成中にデータベースエラー: {e}")
+            logger.error(f"テストユーザー作成中にデータベースエラー: {e}")
         except Exception as e:
-            print(f"[init_db] テストユーザー作成中に予期せぬエラー: {e}")
+            logger.exception(f"テストユーザー作成中に予期せぬエラー: {e}")
 
     except sqlite3.Error as e:
-        print(f"[init_db] データベース処理中にエラー: {e}") # DB関連エラーをキャッチ
+        logger.error(f"データベース処理中にエラー: {e}") # DB関連エラーをキャッチ
     except Exception as e:
-        print(f"[init_db] initialize_database内で予期せぬエラー: {e}") # その他のエラー
+        logger.exception(f"initialize_database内で予期せぬエラー: {e}") # その他のエラー
     finally:
         if conn:
-            print("[init_db] データベース接続を閉じます。")
+            logger.debug("データベース接続を閉じます。")
             conn.close()
         else:
-            print("[init_db] データベース接続が確立されなかったため、閉じられません。")
-        print("[init_db] initialize_database() 終了")
+            logger.debug("データベース接続が確立されなかったため、閉じられません。")
+        logger.debug("initialize_database() 終了")
+
+def backfill_search_index(batch_size=500, pause=0.05, db_name=None):
+    """
+    マイグレーション 6 より前に保存された日記を全文検索の索引 (entries_fts) に登録する。
+    batch_size 件ずつ短いトランザクションでコミットし、合間に pause 秒休むので、
+    実行中もアプリからの書き込みを長時間ブロックしない。何度実行しても二重には登録されない。
+    Returns:
+        int: 新たに登録した日記の数。
+    """
+    conn = sqlite3.connect(db_name or db.DB_NAME, timeout=30)
+    added = 0
+    last_id = 0
+    try:
+        if get_schema_version(conn) < 6:
+            apply_migrations(conn)
+        while True:
+            # 次のバッチの範囲 (id の上限) を決める
+            row = conn.execute(
+                "SELECT MAX(id) FROM (SELECT id FROM entries WHERE id > ? ORDER BY id LIMIT ?)",
+                (last_id, batch_size)
+            ).fetchone()
+            if row[0] is None:
+                break
+            with conn: # バッチごとにコミット
+                cursor = conn.execute("""
+                    INSERT INTO entries_fts (rowid, chat_log, summary, user_id)
+                    SELECT e.id, e.chat_log, IFNULL(e.summary, ''), e.user_id
+                    FROM entries e
+                    WHERE e.id > ? AND e.id <= ?
+                      AND NOT EXISTS (SELECT 1 FROM entries_fts f WHERE f.rowid = e.id)
+                """, (last_id, row[0]))
+                added += cursor.rowcount
+            last_id = row[0]
+            logger.info(f"検索索引: ID {last_id} まで確認 (新規登録 {added} 件)")
+            time.sleep(pause)
+        with conn:
+            conn.execute("INSERT INTO entries_fts (entries_fts) VALUES ('optimize')") # 索引のセグメントを統合する
+    finally:
+        conn.close()
+    return added
+
+def _database_bytes(conn):
+    """DBファイルのサイズ (ページ数 x ページサイズ)"""
+    return conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+
+def compress_chat_logs(batch_size=200, pause=0.05, train=True, sample_size=2000, vacuum=False, db_name=None):
+    """
+    マイグレーション 7 より前に保存された日記のチャットログ (entries.chat_log) を圧縮して entry_logs に移す。
+    train=True で共有辞書がまだなければ、最近のログ sample_size 件から辞書を作って使う。
+    backfill_search_index と同じく batch_size 件ずつコミットし、合間に pause 秒休む。何度実行しても安全。
+    全文検索の索引にまだ登録されていない日記は、ログを空にする前に登録する。
+    行が短くなっても空いた領域はファイルに残るため、ファイルを小さくするには vacuum=True にする
+    (VACUUM は実行中の書き込みをブロックするので、利用者の少ない時間に行う)。
+    Returns:
+        dict: 移したログの数 (entries)、元のサイズと圧縮後のサイズ (bytes)、移行前後のDBファイルのサイズ。
+    """
+    conn = sqlite3.connect(db_name or db.DB_NAME, timeout=30)
+    stats = {'entries': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+    last_id = 0
+    try:
+        if get_schema_version(conn) < 7:
+            apply_migrations(conn)
+        stats['db_bytes_before'] = _database_bytes(conn)
+        row = conn.execute("SELECT id, data FROM log_dicts ORDER BY id DESC LIMIT 1").fetchone()
+        dict_id, zdict = row if row else (None, None)
+        if dict_id is None and train:
+            samples = [r[0] for r in conn.execute(
+                "SELECT chat_log FROM entries WHERE chat_log != '' ORDER BY id DESC LIMIT ?", (sample_size,)
+            )]
+            if samples:
+                zdict = log_codec.train_dictionary(samples)
+                with conn:
+                    dict_id = conn.execute(
+                        "INSERT INTO log_dicts (data, sample_count) VALUES (?, ?)", (zdict, len(samples))
+                    ).lastrowid
+                logger.info(f"チャットログ {len(samples)} 件から圧縮用の辞書 (ID {dict_id}, {len(zdict)} bytes) を作成しました。")
+        while True:
+            rows = conn.execute("""
+                SELECT id, user_id, chat_log, IFNULL(summary, '')
+                FROM entries
+                WHERE id > ? AND chat_log != ''
+                ORDER BY id
+                LIMIT ?
+            """, (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            with conn: # バッチごとにコミット
+                for entry_id, user_id, chat_log, summary in rows:
+                    log_row = log_codec.entry_log_row(entry_id, chat_log, dict_id, zdict)
+                    conn.execute(log_codec.INSERT_ENTRY_LOG, log_row)
+                    conn.execute("""
+                        INSERT INTO entries_fts (rowid, chat_log, summary, user_id)
+                        SELECT ?, ?, ?, ?
+                        WHERE NOT EXISTS (SELECT 1 FROM entries_fts WHERE rowid = ?)
+                    """, (entry_id, chat_log, summary, user_id, entry_id))
+                    conn.execute("UPDATE entries SET chat_log = '' WHERE id = ?", (entry_id,))
+                    stats['raw_bytes'] += log_row[3]
+                    stats['compressed_bytes'] += len(log_row[4])
+            stats['entries'] += len(rows)
+            last_id = rows[-1][0]
+            logger.info(f"チャットログの圧縮: ID {last_id} まで ({stats['entries']} 件)")
+            time.sleep(pause)
+        if vacuum:
+            conn.execute("VACUUM")
+        stats['db_bytes_after'] = _database_bytes(conn)
+    finally:
+        conn.close()
+    return stats
+
+def bad_plan_steps(plan):
+    """EXPLAIN QUERY PLAN の各行のうち、テーブルの全件走査と ORDER BY 用の一時B木を返す"""
+    # FTS5 の MATCH は "SCAN ... VIRTUAL TABLE INDEX" と表示されるが、全文索引を使っている。
+    # INSERT ... SELECT ?, ? の "SCAN CONSTANT ROW" はテーブルの走査ではない
+    return [
+        step for step in plan
+        if (step.startswith("SCAN") and "VIRTUAL TABLE INDEX" not in step and step != "SCAN CONSTANT ROW")
+        or "TEMP B-TREE FOR ORDER BY" in step
+    ]
+
+def check_query_plans():
+    """
+    db.py のホットパスのクエリが全てインデックスを使うことを EXPLAIN QUERY PLAN で確認する。
+    最新スキーマを適用したメモリ上のDBで実行し、テーブルの全件走査や
+    ORDER BY 用の一時B木が現れたクエリの一覧を返す (空なら問題なし)。
+    """
+    conn = sqlite3.connect(":memory:")
+    problems = []
+    try:
+        apply_migrations(conn)
+        for name, (query, params) in db.HOT_QUERIES.items():
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+            logger.info(f"{name}: {' / '.join(plan)}")
+            bad_steps = bad_plan_steps(plan)
+            if bad_steps:
+                problems.append((name, bad_steps))
+    finally:
+        conn.close()
+    return problems
 
 # スクリプトとして直接実行された場合にも動作するように
 if __name__ == "__main__":
+    tracing.setup_logging()
+    sqlite_only = [arg for arg in ("--check-query-plans", "--backfill-search-index", "--compress-chat-logs") if arg in sys.argv]
+    if db.BACKEND != 'sqlite' and sqlite_only:
+        print(f"{sqlite_only[0]} は SQLite のバックエンドでのみ使えます (DIARY_DB_BACKEND={db.BACKEND})。")
+        sys.exit(1)
+
+    if "--check-query-plans" in sys.argv:
+        problems = check_query_plans()
+        for name, bad_steps in problems:
+            print(f"NG: {name} がインデックスを使っていません: {bad_steps}")
+        print("クエリプランの確認が完了しました。" if not problems else "クエリプランに問題があります。")
+        sys.exit(1 if problems else 0)
+
+    if "--backfill-search-index" in sys.argv:
+        started = time.perf_counter()
+        added = sum(backfill_search_index(db_name=db.get_shard_path(shard_id)) for shard_id in db.list_shards())
+        print(f"検索索引に {added} 件の日記を登録しました。({(time.perf_counter() - started):.1f} 秒)")
+        sys.exit(0)
+
+    if "--rebuild-emotion-stats" in sys.argv:
+        started = time.perf_counter()
+        count = db.rebuild_emotion_stats()
+        print(f"{count} 人分の感情スコアの集計を作り直しました。({(time.perf_counter() - started):.1f} 秒)")
+        sys.exit(0)
+
+    if "--compress-chat-logs" in sys.argv:
+        started = time.perf_counter()
+        stats = {}
+        for shard_id in db.list_shards(): # 共有辞書はシャードごとに作る
+            shard_stats = compress_chat_logs(vacuum="--vacuum" in sys.argv, db_name=db.get_shard_path(shard_id))
+            for key, value in shard_stats.items():
+                stats[key] = stats.get(key, 0) + value
+        ratio = stats['compressed_bytes'] / stats['raw_bytes'] if stats['raw_bytes'] else 0.0
+        print(f"チャットログ {stats['entries']} 件を圧縮しました。({(time.perf_counter() - started):.1f} 秒)")
+        print(f"  ログ: {stats['raw_bytes']:,} bytes -> {stats['compressed_bytes']:,} bytes ({ratio:.0%})")
+        print(f"  DBファイル: {stats['db_bytes_before']:,} bytes -> {stats['db_bytes_after']:,} bytes")
+        if "--vacuum" not in sys.argv:
+            print("  空いた領域をファイルから取り除くには --vacuum を付けて実行してください。")
+        sys.exit(0)
+
     print("init_db.py を直接実行しています...")
+    started = time.perf_counter()
     initialize_database()
-    print("データベースの初期化が完了しました。")
+    print(f"データベースの初期化が完了しました。({(time.perf_counter() - started) * 1000:.1f} ms)")
@@ -0,0 +1,87 @@
+# log_codec.py
+"""
+チャットログの圧縮・展開。
+
+チャットログは entry_logs テーブルに圧縮して保存する (entries.chat_log は空文字)。
+標準ライブラリの zlib を使い、既存のログから作った共有辞書 (log_dicts テーブル) があればそれを使う。
+短いログは単独では圧縮が効きにくいが、定型の質問文や「あなた: 」などの頻出行を辞書に入れておくと、
+1件目の出現からそれを参照できる。
+"""
+import zlib
+from collections import Counter
+
+CODEC_ZLIB = 'zlib'
+COMPRESS_LEVEL = 6
+DICT_MAX_BYTES = 32 * 1024 # zlib が参照できる距離 (窓サイズ)。これより長い辞書の先頭は使われない
+DICT_MIN_COUNT = 2 # 辞書に入れる行の最低出現数 (サンプル中のログ数)
+ROLE_LABELS = {'user': "あなた", 'model': "AI"} # チャットログの各行の先頭に付ける役割名
+ROLE_PREFIXES = tuple(f"{label}: " for label in reversed(ROLE_LABELS.values()))
+
+# entry_logs への保存 (同じエントリーのログは置き換える)
+INSERT_ENTRY_LOG = """
+    INSERT OR REPLACE INTO entry_logs (entry_id, codec, dict_id, raw_size, data)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+def compress(text, zdict=None):
+    """チャットログ (str) を圧縮したバイト列を返す"""
+    if zdict:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(COMPRESS_LEVEL)
+    return compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+
+def decompress(data, codec=CODEC_ZLIB, zdict=None):
+    """compress で圧縮したバイト列をチャットログ (str) に戻す"""
+    if codec != CODEC_ZLIB:
+        raise ValueError(f"未対応の圧縮形式です: {codec}")
+    decompressor = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+    return (decompressor.decompress(data) + decompressor.flush()).decode('utf-8')
+
+
+def entry_log_row(entry_id, text, dict_id=None, zdict=None):
+    """INSERT_ENTRY_LOG に渡す値を作る"""
+    return (entry_id, CODEC_ZLIB, dict_id, len(text.encode('utf-8')), compress(text, zdict))
+
+
+def format_turn(role, text):
+    """チャットの1ターンをチャットログの1行 (「あなた: ...」) にする"""
+    return f"{ROLE_LABELS.get(role, role)}: {text}"
+
+
+def compress_lines(lines, zdict=None):
+    """
+    行を順に圧縮しながら改行でつなぐ (ログ全体の文字列を作らずに compress と同じ結果になる)。
+    (圧縮前のバイト数, 圧縮したバイト列) を返す。
+    """
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zdict=zdict) if zdict else zlib.compressobj(COMPRESS_LEVEL)
+    raw_size = 0
+    chunks = []
+    for i, line in enumerate(lines):
+        data = (f"\n{line}" if i else line).encode('utf-8')
+        raw_size += len(data)
+        chunks.append(compressor.compress(data))
+    chunks.append(compressor.flush())
+    return raw_size, b"".join(chunks)
+
+
+def train_dictionary(samples, max_bytes=DICT_MAX_BYTES):
+    """
+    サンプルのチャットログから zlib の共有辞書を作る。
+    複数のログに現れる行 (AI の定型の質問など) を出現数の多い順に集める。
+    zlib は辞書の末尾に近い内容ほど短い距離で参照できるため、出現数の多い行を後ろに置く。
+    """
+    counts = Counter(line for text in samples for line in set(text.split("\n")) if line)
+    pieces = [prefix.encode('utf-8') for prefix in ROLE_PREFIXES]
+    size = sum(len(piece) for piece in pieces)
+    for line, count in counts.most_common():
+        if count < DICT_MIN_COUNT:
+            break
+        piece = f"{line}\n".encode('utf-8')
+        if size + len(piece) > max_bytes:
+            continue
+        pieces.append(piece)
+        size += len(piece)
+    return b"".join(reversed(pieces))
@@ -0,0 +1,78 @@
+# response_cache.py
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+
+import db
+
+# --- 設定 ---
+CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000")) # これを超えたら最終利用が古いものから削除
+CACHE_TTL = {
+    'analysis': float(os.getenv("ANALYSIS_CACHE_TTL", str(30 * 24 * 3600))), # 分析結果は30日
+    'chat': float(os.getenv("CHAT_CACHE_TTL", "600")), # チャット応答は再送対策なので10分
+}
+EVICT_EVERY = 100 # 保存 N 回ごとに期限切れ・件数超過の削除を行う
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_stores_since_evict = 0
+
+
+def normalize_text(text):
+    """改行・全角半角の揺れや行末の空白を揃え、見た目が同じ入力が同じキーになるようにする"""
+    text = unicodedata.normalize('NFKC', text).replace('\r\n', '\n').replace('\r', '\n')
+    return "\n".join(line.rstrip() for line in text.strip().split('\n'))
+
+
+def make_key(kind, content, prompt_version, model_name):
+    """入力内容・プロンプトのバージョン・モデル名からキャッシュキー (SHA-256) を作る"""
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+    material = "\0".join([kind, str(prompt_version), model_name, normalize_text(content)])
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def get(kind, cache_key):
+    """キャッシュから応答を取り出す (JSON をデコードした値)。無ければ None (cache_key が None なら常に None)。"""
+    if cache_key is None:
+        return None
+    payload = db.get_cached_response(cache_key, CACHE_TTL[kind])
+    with _lock:
+        _stats['hits' if payload is not None else 'misses'] += 1
+    return json.loads(payload) if payload is not None else None
+
+
+def put(kind, cache_key, value):
+    """応答をキャッシュに保存する (cache_key が None なら何もしない)。一定回数ごとに古いキャッシュを削除する。"""
+    global _stores_since_evict
+    if cache_key is None:
+        return
+    if not db.put_cached_response(cache_key, kind, json.dumps(value, ensure_ascii=False)):
+        return
+    with _lock:
+        _stats['stores'] += 1
+        _stores_since_evict += 1
+        should_evict = _stores_since_evict >= EVICT_EVERY
+        if should_evict:
+            _stores_since_evict = 0
+    if should_evict:
+        evict()
+
+
+def evict():
+    """期限切れ・件数超過のキャッシュを削除し、削除件数を返す"""
+    deleted = db.evict_cached_responses(CACHE_MAX_ENTRIES, CACHE_TTL)
+    with _lock:
+        _stats['evictions'] += deleted
+    return deleted
+
+
+def get_stats():
+    """ヒット・ミス・保存・削除の回数とヒット率を返す"""
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
@@ -0,0 +1,166 @@
+# session_store.py
+"""
+ログインセッション (ブラウザの再読み込み・アプリの再起動・別のプロセスでもログイン状態を保つ)。
+
+ログイン時にランダムなトークンを発行し、ブラウザの cookie に置く (app.py。URL には置かないので、履歴や共有したリンクに残らない)。
+トークンは「セッションID.署名」の形で、署名 (HMAC-SHA256) が合わないものは DB を見ずに断る。
+セッションは DB の sessions テーブルに保存し (IDの SHA-256 だけを保存する)、プロセス内の LRU に
+書き込みスルーでキャッシュするので、rerun ごとの確認はほとんどメモリ上の1回の参照で済む。
+有効期限は使われるたびに SESSION_TTL 秒先へ延ばす (DB への書き込みは SESSION_TOUCH_INTERVAL 秒に1回)。
+別のプロセスでのログアウト・期限切れの削除は、次に期限を延ばすときに DB で検知する。
+つまり、ログアウトしたセッションが他のプロセスで使えてしまうのは最大 SESSION_TOUCH_INTERVAL 秒
+(同じプロセスでのログアウトは即座に無効になる)。短くするほど確認のための DB への書き込みが増える。
+
+署名の鍵は SESSION_SECRET (全てのプロセスで同じ値にする)。未設定なら最初に使うときにランダムな鍵を作って
+DB の app_secrets に保存し、全てのプロセス・再起動後も同じ鍵を使う (DB に保存できなければ例外になる)。
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# --- 設定 ---
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 24 * 3600))) # 最後に使ってからこの秒数でログアウト
+SESSION_TOUCH_INTERVAL = float(os.getenv("SESSION_TOUCH_INTERVAL", "30")) # 有効期限を DB に書き込む間隔 (秒)。別のプロセスでのログアウトの反映の遅れの上限
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000")) # メモリに持つセッションの数 (LRU)
+EVICT_EVERY = 100 # ログイン N 回ごとに期限切れのセッションを DB から削除する
+
+SECRET_NAME = "session_secret" # SESSION_SECRET が未設定のときに DB に保存する鍵の名前
+
+_secret = os.getenv("SESSION_SECRET", "").encode('utf-8') or None
+_secret_lock = threading.Lock()
+
+_lock = threading.Lock()
+_cache = OrderedDict() # トークンのハッシュ -> {'user_id', 'username', 'expires_at', 'touched_at'} (LRU)
+_stats = {'hits': 0, 'misses': 0, 'creates': 0, 'touches': 0, 'rejected': 0, 'revoked': 0, 'evictions': 0}
+_creates_since_evict = 0
+
+
+def _get_secret():
+    """署名の鍵を返す (SESSION_SECRET が未設定なら DB に保存した鍵。なければ作って保存する)"""
+    global _secret
+    with _secret_lock:
+        if _secret is None:
+            _secret = db.get_or_create_secret(SECRET_NAME, secrets.token_urlsafe(32)).encode('utf-8')
+            logger.info("SESSION_SECRET が設定されていないため、DB に保存した鍵でセッションに署名します。")
+        return _secret
+
+
+def _sign(session_id):
+    digest = hmac.new(_get_secret(), session_id.encode('ascii'), hashlib.sha256).digest()[:18]
+    return base64.urlsafe_b64encode(digest).decode('ascii')
+
+
+def _parse(token):
+    """トークンの署名を確かめ、DB のキー (セッションIDの SHA-256) を返す (不正なら None)"""
+    session_id, _, signature = (token or '').partition('.')
+    if not session_id or not session_id.isascii() or not hmac.compare_digest(_sign(session_id), signature):
+        return None
+    return hashlib.sha256(session_id.encode('ascii')).hexdigest()
+
+
+def _remember(token_hash, session):
+    with _lock:
+        _cache[token_hash] = session
+        _cache.move_to_end(token_hash)
+        while len(_cache) > SESSION_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _forget(token_hash):
+    with _lock:
+        _cache.pop(token_hash, None)
+
+
+def create(user_id, username):
+    """ログインしたユーザーのセッションを作り、トークンを返す (保存できなければ None)"""
+    global _creates_since_evict
+    session_id = secrets.token_urlsafe(24)
+    token_hash = hashlib.sha256(session_id.encode('ascii')).hexdigest()
+    now = time.time()
+    if not db.create_session(token_hash, user_id, username, now + SESSION_TTL):
+        return None
+    _remember(token_hash, {'user_id': user_id, 'username': username, 'expires_at': now + SESSION_TTL, 'touched_at': now})
+    with _lock:
+        _stats['creates'] += 1
+        _creates_since_evict += 1
+        should_evict = _creates_since_evict >= EVICT_EVERY
+        if should_evict:
+            _creates_since_evict = 0
+    if should_evict:
+        evict()
+    return f"{session_id}.{_sign(session_id)}"
+
+
+def resolve(token):
+    """
+    トークンのセッションを確認し、{'user_id', 'username'} を返す (不正・期限切れ・ログアウト済みなら None)。
+    有効なら有効期限を延ばす。
+    """
+    token_hash = _parse(token)
+    if token_hash is None:
+        with _lock:
+            _stats['rejected'] += 1
+        return None
+    now = time.time()
+    with _lock:
+        session = _cache.get(token_hash)
+        if session is not None:
+            _cache.move_to_end(token_hash)
+        _stats['hits' if session is not None else 'misses'] += 1
+    if session is None:
+        row = db.get_session(token_hash)
+        if row is None:
+            return None
+        session = {'user_id': row['user_id'], 'username': row['username'],
+                   'expires_at': row['expires_at'], 'touched_at': float('-inf')}
+    if session['expires_at'] < now:
+        _forget(token_hash)
+        return None
+    if now - session['touched_at'] > SESSION_TOUCH_INTERVAL:
+        # 別のプロセスでログアウト・削除されていれば、ここで無効になる
+        if not db.touch_session(token_hash, now + SESSION_TTL):
+            _forget(token_hash)
+            return None
+        session = dict(session, expires_at=now + SESSION_TTL, touched_at=now)
+        with _lock:
+            _stats['touches'] += 1
+    _remember(token_hash, session)
+    return {'user_id': session['user_id'], 'username': session['username']}
+
+
+def revoke(token):
+    """セッションを削除する (ログアウト)"""
+    token_hash = _parse(token)
+    if token_hash is None:
+        return
+    _forget(token_hash)
+    db.delete_session(token_hash)
+    with _lock:
+        _stats['revoked'] += 1
+
+
+def evict():
+    """期限切れのセッションを DB とキャッシュから削除し、DB から削除した件数を返す"""
+    now = time.time()
+    deleted = db.evict_expired_sessions(now)
+    with _lock:
+        for token_hash in [key for key, session in _cache.items() if session['expires_at'] < now]:
+            del _cache[token_hash]
+        _stats['evictions'] += deleted
+    return deleted
+
+
+def get_stats():
+    """キャッシュのヒット・ミス、作成・期限延長・不正なトークン・ログアウト・期限切れの削除の回数と、キャッシュ中の件数を返す"""
+    with _lock:
+        return dict(_stats, cached=len(_cache))
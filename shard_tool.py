@@ -0,0 +1,105 @@
+# shard_tool.py
+"""
+シャード (ユーザーごとのデータを置く SQLite ファイル) の確認・移動ツール。
+
+ユーザーとシャードの対応は DB_NAME の users.shard_id にあり、アプリはそれをプロセス内にキャッシュする。
+ユーザーを移動するコマンド (move / rebalance / split) は、アプリを止めてから実行すること。
+1人ずつ「移動先へコピー → users.shard_id を更新 → 移動元から削除」の順に移すので、途中で止めても
+もう一度実行すれば続きから移せる。移動したユーザーの日記は新しい ID になるため、
+分析用エクスポート (emotion_export.py) は移動後に --full で作り直す。
+
+実行例:
+    python shard_tool.py status
+    python shard_tool.py rebalance --mode hash --shards 8      # user_id のハッシュで 8 個に振り分け直す
+    python shard_tool.py split 3                                # シャード 3 のユーザーの半分を新しいシャードへ
+    python shard_tool.py move 42 5                              # ユーザー 42 をシャード 5 へ
+"""
+import argparse
+import logging
+import sys
+import time
+
+import db
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+def plan_rebalance(mode, shard_count=None):
+    """mode / shard_count で割り当て直したときに移動するユーザーの [(ユーザーID, 移動元, 移動先)] を返す"""
+    return [
+        (user_id, shard_id, target)
+        for user_id, shard_id in db.get_user_shards()
+        if (target := db.assign_shard(user_id, mode, shard_count)) != shard_id
+    ]
+
+
+def plan_split(shard_id, new_shard=None):
+    """シャードのユーザーを ID 順に1人おきに新しいシャードへ移す計画 (移動先の省略時は最大の番号 + 1)"""
+    users = [user_id for user_id, user_shard in db.get_user_shards() if user_shard == shard_id]
+    if new_shard is None:
+        new_shard = max(db.list_shards()) + 1
+    return [(user_id, shard_id, new_shard) for user_id in users[1::2]]
+
+
+def apply_moves(moves):
+    """計画どおりにユーザーを移し、(移したユーザー数, 移した日記の数, 秒数) を返す"""
+    started = time.perf_counter()
+    entries = 0
+    for n, (user_id, source, target) in enumerate(moves, start=1):
+        entries += db.move_user_to_shard(user_id, target)
+        logger.info(f"移動 {n}/{len(moves)}: ユーザーID {user_id} (シャード {source} -> {target})")
+    return len(moves), entries, time.perf_counter() - started
+
+
+def print_status():
+    print(f"{'shard':>6}{'users':>8}{'entries':>10}{'MB':>9}  path")
+    for shard_id, stats in db.get_shard_stats().items():
+        print(f"{shard_id:>6}{stats['users']:>8,}{stats['entries']:>10,}{stats['bytes'] / 1e6:>9.1f}  {stats['path']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="シャードの確認・ユーザーの移動")
+    parser.add_argument("--db", help="使用するDBファイル (省略時は diary_app.db)")
+    parser.add_argument("--dry-run", action="store_true", help="移動するユーザーを表示するだけにする")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="シャードごとのユーザー数・日記の数・ファイルサイズ")
+    rebalance = commands.add_parser("rebalance", help="割り当て方・シャード数を変えて全ユーザーを振り分け直す")
+    rebalance.add_argument("--mode", choices=["none", "hash", "user"], default=db.SHARD_MODE)
+    rebalance.add_argument("--shards", type=int, default=db.SHARD_COUNT, help="hash のときのシャード数")
+    split = commands.add_parser("split", help="シャードのユーザーの半分を別のシャードへ移す")
+    split.add_argument("shard", type=int)
+    split.add_argument("--into", type=int, help="移動先のシャード番号 (省略時は新しい番号)")
+    move = commands.add_parser("move", help="1人のユーザーを指定のシャードへ移す")
+    move.add_argument("user_id", type=int)
+    move.add_argument("shard", type=int)
+    args = parser.parse_args(argv)
+
+    tracing.setup_logging()
+    if db.BACKEND != 'sqlite':
+        print(f"シャードは SQLite のバックエンドでのみ使えます (DIARY_DB_BACKEND={db.BACKEND})。")
+        return 1
+    if args.db:
+        db.DB_NAME = args.db
+    if args.command == "status":
+        print_status()
+        return 0
+    if args.command == "rebalance":
+        moves = plan_rebalance(args.mode, args.shards)
+    elif args.command == "split":
+        moves = plan_split(args.shard, args.into)
+    else:
+        moves = [(args.user_id, db.get_user_shard(args.user_id), args.shard)]
+    if args.dry_run:
+        for user_id, source, target in moves:
+            print(f"ユーザーID {user_id}: シャード {source} -> {target}")
+        print(f"{len(moves):,} 人を移動します (--dry-run のため移動していません)。")
+        return 0
+    users, entries, seconds = apply_moves(moves)
+    print(f"{users:,} 人 (日記 {entries:,} 件) を移動しました。({seconds:.1f} 秒)")
+    print_status()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
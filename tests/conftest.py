@@ -0,0 +1,78 @@
+# tests/conftest.py
+"""
+テスト共通のフィクスチャ。
+
+storage フィクスチャは同じテストを全てのストレージのバックエンドで実行する:
+- sqlite: 一時ディレクトリの SQLite (シャーディングなし)
+- sqlite-sharded: 同じく user_id のハッシュで 3 つのシャードに振り分ける
+- postgres: DIARY_TEST_DATABASE_URL のサーバー (docker-compose.yml)、なければ pgserver の埋め込みサーバー。
+  どちらも使えなければスキップする。テストごとに一時スキーマを作って削除する
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+
+import auth
+import db
+import init_db
+
+_pg_server = None
+
+
+def _postgres_dsn():
+    """テスト用の PostgreSQL の接続先を返す (使えなければ None)"""
+    global _pg_server
+    dsn = os.getenv("DIARY_TEST_DATABASE_URL")
+    if dsn:
+        return dsn
+    if _pg_server is None:
+        try:
+            import pgserver
+        except ImportError:
+            return None
+        _pg_server = pgserver.get_server(tempfile.mkdtemp(prefix="diary_pgtest_"), cleanup_mode='stop')
+    return _pg_server.get_uri()
+
+
+@pytest.fixture(autouse=True)
+def fast_bcrypt(monkeypatch):
+    monkeypatch.setattr(auth, "BCRYPT_ROUNDS", 4) # テストユーザーの作成を速くする
+
+
+@pytest.fixture(params=["sqlite", "sqlite-sharded", pytest.param("postgres", marks=pytest.mark.postgres)])
+def storage(request, tmp_path, monkeypatch):
+    """空のDBを初期化してバックエンドの名前を返す (testuser は作成済み)"""
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "test.db"))
+    monkeypatch.setattr(db, "SHARD_MODE", "hash" if request.param == "sqlite-sharded" else "none")
+    monkeypatch.setattr(db, "SHARD_COUNT", 3)
+    if request.param == "postgres":
+        try:
+            import psycopg # noqa: F401
+            import storage_postgres
+        except ImportError:
+            pytest.skip("psycopg がインストールされていません")
+        dsn = _postgres_dsn()
+        if not dsn:
+            pytest.skip("DIARY_TEST_DATABASE_URL が未設定で、pgserver もインストールされていません")
+        with storage_postgres.temporary_schema(dsn, prefix="diary_test") as schema_dsn:
+            db.use_backend("postgres", schema_dsn)
+            try:
+                init_db.initialize_database()
+                yield request.param
+            finally:
+                db.use_backend("sqlite")
+    else:
+        db.use_backend("sqlite")
+        init_db.initialize_database()
+        yield request.param
+        db.close_pool()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if _pg_server is not None:
+        _pg_server.cleanup()
+        shutil.rmtree(_pg_server.pgdata, ignore_errors=True)
@@ -0,0 +1,44 @@
+# tests/test_analysis_worker.py
+"""analysis_worker の再試行 (バックオフで待つ間はワーカーを空ける)"""
+import pytest
+
+import analysis_worker
+import db
+import gemini_chat
+
+
+@pytest.fixture
+def worker(storage, monkeypatch):
+    monkeypatch.setattr(analysis_worker, "MAX_WORKERS", 1)
+    monkeypatch.setattr(analysis_worker, "backoff_delay", lambda attempts: 0.5)
+    yield analysis_worker
+    analysis_worker.shutdown(wait=True)
+
+
+def test_backoff_does_not_hold_a_worker(worker, monkeypatch):
+    assert db.create_user("alice", "hash")
+    user_id = db.get_user_by_username("alice")['id']
+    failing_id = db.create_pending_entry(user_id, "2024-05-01", "ユーザー: 失敗する")
+    other_id = db.create_pending_entry(user_id, "2024-05-02", "ユーザー: 成功する")
+    calls = []
+
+    def analyze(chat_log):
+        calls.append(chat_log)
+        if "失敗" in chat_log:
+            return None, None
+        return "要約", {'joy': 50}
+    monkeypatch.setattr(gemini_chat, "analyze_diary_entry", analyze)
+
+    failing = worker.submit(failing_id)
+    assert worker.submit(failing_id) is failing # 実行中・再試行待ちの間は二重に登録しない
+    # ワーカーは1つだけだが、失敗したエントリーの再試行を待つ間に他のエントリーを分析できる
+    worker.submit(other_id).result(timeout=0.4)
+    assert db.get_entry_for_analysis(other_id)['analysis_status'] != db.ANALYSIS_PENDING
+    assert not failing.done()
+
+    failing.result(timeout=10) # MAX_ATTEMPTS 回失敗したら断念する
+    entry = db.get_entry_for_analysis(failing_id)
+    assert entry['analysis_status'] == db.ANALYSIS_FAILED
+    assert entry['analysis_attempts'] == analysis_worker.MAX_ATTEMPTS
+    assert calls.count("ユーザー: 失敗する") == analysis_worker.MAX_ATTEMPTS
+    assert worker.wait_idle(timeout=1)
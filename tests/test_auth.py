@@ -0,0 +1,21 @@
+# tests/test_auth.py
+"""auth のパスワード検証と、コスト変更時のハッシュの作り直し"""
+import auth
+
+
+def test_verify_and_update_rehashes_when_cost_changes():
+    old_hash = auth.hash_password("password123", rounds=5)
+    verified, new_hash = auth.verify_and_update("password123", old_hash)
+    assert verified and new_hash
+    assert auth.get_hash_rounds(new_hash) == auth.BCRYPT_ROUNDS
+    assert auth.verify_and_update("wrong", old_hash) == (False, None)
+
+
+def test_verify_and_update_logs_in_when_rehash_is_busy(monkeypatch):
+    old_hash = auth.hash_password("password123", rounds=5)
+
+    def busy_hash_password(password, rounds=None):
+        raise auth.AuthBusyError("busy")
+
+    monkeypatch.setattr(auth, "hash_password", busy_hash_password)
+    assert auth.verify_and_update("password123", old_hash) == (True, None)
@@ -0,0 +1,115 @@
+# tests/test_chat_stream.py
+"""チャット応答のストリーミングの失敗時の扱いと、応答キャッシュ"""
+import types
+
+import pytest
+
+import gemini_async
+import gemini_chat
+import gemini_client
+
+
+class BrokenStreamClient:
+    """最初の断片を返した後に接続が切れるクライアント"""
+    def stream(self, model, contents, deadline=None):
+        yield types.SimpleNamespace(text="今日は")
+        raise ConnectionError("connection reset")
+
+
+class BrokenAsyncStreamClient:
+    async def stream(self, model, contents, deadline=None):
+        yield types.SimpleNamespace(text="今日は")
+        raise ConnectionError("connection reset")
+
+
+@pytest.fixture
+def broken_stream(storage, monkeypatch):
+    monkeypatch.setattr(gemini_chat, "model", object())
+    monkeypatch.setattr(gemini_client, "get_client", lambda: BrokenStreamClient())
+    monkeypatch.setattr(gemini_async, "get_client", lambda: BrokenAsyncStreamClient())
+
+
+def test_stream_chat_response_raises_after_partial_reply(broken_stream):
+    history = [{'role': 'user', 'parts': ["こんにちは"]}]
+    chunks = []
+    with pytest.raises(gemini_chat.ChatStreamInterruptedError) as excinfo:
+        for text in gemini_chat.stream_chat_response(history, user_id=1):
+            chunks.append(text)
+    assert chunks == ["今日は"]
+    assert excinfo.value.partial_text == "今日は"
+    # 途中までの応答はキャッシュしない
+    cache_key = gemini_chat.chat_cache_key(gemini_chat._prepare_contents(history, None), 1)
+    assert gemini_chat.response_cache.get('chat', cache_key) is None
+
+
+def test_async_stream_chat_response_raises_after_partial_reply(broken_stream):
+    # app.py が使う同期ラッパー (共有のイベントループで実行する) からも同じ例外が届く
+    chunks = []
+    with pytest.raises(gemini_chat.ChatStreamInterruptedError) as excinfo:
+        for text in gemini_async.stream_chat_response([{'role': 'user', 'parts': ["こんにちは"]}]):
+            chunks.append(text)
+    assert chunks == ["今日は"]
+    assert excinfo.value.partial_text == "今日は"
+
+
+class RejectingStreamClient:
+    """最初の断片の前に失敗するクライアント (400 や安全性フィルタでのブロックなど)"""
+    def stream(self, model, contents, deadline=None):
+        yield types.SimpleNamespace(text=None) # 空の断片は飛ばす
+        raise ValueError("response was blocked")
+
+
+class RejectingAsyncStreamClient:
+    async def stream(self, model, contents, deadline=None):
+        raise ValueError("400 invalid argument")
+        yield
+
+
+@pytest.fixture
+def rejecting_stream(storage, monkeypatch):
+    monkeypatch.setattr(gemini_chat, "model", object())
+    monkeypatch.setattr(gemini_client, "get_client", lambda: RejectingStreamClient())
+    monkeypatch.setattr(gemini_async, "get_client", lambda: RejectingAsyncStreamClient())
+
+
+@pytest.mark.parametrize("stream", [gemini_chat.stream_chat_response, gemini_async.stream_chat_response])
+def test_stream_chat_response_raises_before_first_chunk(rejecting_stream, stream):
+    # エラー文を応答として返すと、履歴に保存されて Gemini にも送り返されてしまう
+    history = [{'role': 'user', 'parts': ["こんにちは"]}]
+    chunks = []
+    with pytest.raises(gemini_chat.ChatResponseError):
+        for text in stream(history, user_id=1):
+            chunks.append(text)
+    assert chunks == []
+    cache_key = gemini_chat.chat_cache_key(gemini_chat._prepare_contents(history, None), 1)
+    assert gemini_chat.response_cache.get('chat', cache_key) is None
+
+
+@pytest.mark.parametrize("stream", [gemini_chat.stream_chat_response, gemini_async.stream_chat_response])
+def test_stream_chat_response_raises_without_model(storage, monkeypatch, stream):
+    monkeypatch.setattr(gemini_chat, "model", None)
+    with pytest.raises(gemini_chat.ChatResponseError):
+        list(stream([{'role': 'user', 'parts': ["こんにちは"]}]))
+
+
+class CountingStreamClient:
+    """呼ばれるたびに違う応答を返すクライアント"""
+    def __init__(self):
+        self.calls = 0
+
+    def stream(self, model, contents, deadline=None):
+        self.calls += 1
+        yield types.SimpleNamespace(text=f"応答{self.calls}")
+
+
+def test_chat_cache_is_per_user(storage, monkeypatch):
+    client = CountingStreamClient()
+    monkeypatch.setattr(gemini_chat, "model", object())
+    monkeypatch.setattr(gemini_client, "get_client", lambda: client)
+    history = [{'role': 'user', 'parts': ["今日は疲れた"]}]
+
+    assert "".join(gemini_chat.stream_chat_response(history, user_id=1)) == "応答1"
+    assert "".join(gemini_chat.stream_chat_response(history, user_id=1)) == "応答1" # 再送はキャッシュから
+    assert "".join(gemini_chat.stream_chat_response(history, user_id=2)) == "応答2" # 別のユーザーには返さない
+    assert "".join(gemini_chat.stream_chat_response(history)) == "応答3" # ユーザーが分からなければキャッシュしない
+    assert "".join(gemini_chat.stream_chat_response(history)) == "応答4"
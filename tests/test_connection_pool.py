@@ -0,0 +1,55 @@
+# tests/test_connection_pool.py
+"""db.ConnectionPool と、シャードのプールの作成"""
+import threading
+import time
+
+import db
+
+
+def test_waiter_gets_connection_after_broken_one_is_discarded(tmp_path):
+    pool = db.ConnectionPool(str(tmp_path / "pool.db"), max_size=1, timeout=5)
+    conn = pool.acquire()
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.start()
+    while pool.stats()['waits'] == 0:
+        time.sleep(0.01)
+    conn.close() # 壊れた接続 (返却時の rollback の確認で失敗し、プールに戻さず破棄される)
+    started = time.monotonic()
+    pool.release(conn)
+    waiter.join(timeout=5)
+    assert acquired, "破棄で空いた枠を待っているスレッドに渡していない"
+    assert time.monotonic() - started < 1
+    assert acquired[0].execute("SELECT 1").fetchone()[0] == 1
+    assert pool.stats()['open'] == 1
+    pool.release(acquired[0])
+    pool.close()
+
+
+def test_shard_initialization_does_not_block_other_pools(tmp_path, monkeypatch):
+    import init_db
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "test.db"))
+    init_db.initialize_database()
+    started, release = threading.Event(), threading.Event()
+    initialize_shard = init_db.initialize_shard
+
+    def slow_initialize_shard(path, base_id):
+        started.set()
+        release.wait(5)
+        initialize_shard(path, base_id)
+
+    monkeypatch.setattr(init_db, "initialize_shard", slow_initialize_shard)
+    pools = []
+    opener = threading.Thread(target=lambda: pools.append(db.get_shard_pool(1)))
+    opener.start()
+    try:
+        assert started.wait(5)
+        # シャード 1 の初期化中でも、シャード 0 のプールはすぐに取れる
+        done = threading.Event()
+        threading.Thread(target=lambda: (db.get_pool(), done.set())).start()
+        assert done.wait(1)
+    finally:
+        release.set()
+        opener.join(5)
+    assert pools and db.get_shard_pool(1) is pools[0]
+    db.close_pool()
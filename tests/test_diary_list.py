@@ -0,0 +1,21 @@
+# tests/test_diary_list.py
+"""diary_list の年月一覧のキャッシュ (DB のデータバージョンで無効にする)"""
+import db
+import diary_list
+
+
+def test_months_cache_sees_writes_from_other_processes(storage, monkeypatch):
+    monkeypatch.setattr(diary_list, "_months_cache", diary_list.OrderedDict())
+    assert db.create_user("alice", "hash")
+    user_id = db.get_user_by_username("alice")['id']
+    db.create_entry_and_emotions(user_id, "2024-05-01", "ユーザー: 晴れ", "晴れた日", {'joy': 80})
+    assert diary_list.get_months(user_id) == [("2024-05", 1)]
+
+    db.create_pending_entry(user_id, "2024-05-02", "ユーザー: 未分析") # このプロセスでの保存
+    assert diary_list.get_months(user_id) == [("2024-05", 2)]
+
+    # 別のプロセスでの書き込み: このプロセスのデータバージョンは変わらない
+    monkeypatch.setattr(db, "mark_user_data_changed", lambda user_id: None)
+    db.bulk_insert_entries([{'user_id': user_id, 'entry_date': "2024-06-01", 'chat_log': "ユーザー: 雨",
+                             'summary': "雨の日", 'emotions': {'sadness': 70}}])
+    assert diary_list.get_months(user_id) == [("2024-06", 1), ("2024-05", 2)]
@@ -0,0 +1,20 @@
+# tests/test_emotion_chart.py
+"""emotion_chart のキャッシュ (DB のデータバージョンで無効にする)"""
+import db
+import emotion_chart
+
+
+def test_chart_cache_sees_writes_from_other_processes(storage, monkeypatch):
+    assert db.create_user("alice", "hash")
+    user_id = db.get_user_by_username("alice")['id']
+    db.create_entry_and_emotions(user_id, "2024-05-01", "ユーザー: 晴れ", "晴れた日", {'joy': 80})
+    first = emotion_chart.get_emotion_chart_png(user_id)
+    assert first is not None
+    assert emotion_chart.get_emotion_chart_png(user_id) is first # 変わっていなければキャッシュ
+
+    # 別のプロセスでの書き込み: このプロセスのデータバージョンは変わらない
+    monkeypatch.setattr(db, "mark_user_data_changed", lambda user_id: None)
+    db.create_entry_and_emotions(user_id, "2024-05-02", "ユーザー: 雨", "雨の日", {'sadness': 70})
+    second = emotion_chart.get_emotion_chart_png(user_id)
+    assert second is not first and second != first
+    assert len(emotion_chart.get_emotion_series(user_id)) == 2
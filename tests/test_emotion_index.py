@@ -0,0 +1,44 @@
+# tests/test_emotion_index.py
+"""emotion_index の行列のキャッシュ (書き込み通知での差分更新と、DB のデータバージョンでの読み直し)"""
+import pytest
+
+import db
+import emotion_index
+
+
+@pytest.fixture(autouse=True)
+def empty_index_cache(monkeypatch):
+    # テストごとに DB を作り直すので、前のテストで読み込んだ行列を使わないようにする
+    monkeypatch.setattr(emotion_index, "_indexes", emotion_index.OrderedDict())
+
+
+def make_user():
+    assert db.create_user("alice", "hash")
+    return db.get_user_by_username("alice")['id']
+
+
+def similar_ids(user_id, entry_id):
+    return [hit['id'] for hit in emotion_index.find_similar_entries(user_id, entry_id)]
+
+
+def test_index_applies_writes_in_this_process_without_reloading(storage):
+    user_id = make_user()
+    first = db.create_entry_and_emotions(user_id, "2024-05-01", "ユーザー: 晴れ", "晴れた日", {'joy': 80})
+    assert similar_ids(user_id, first) == []
+    loads = emotion_index.get_stats()['loads']
+
+    second = db.create_entry_and_emotions(user_id, "2024-05-02", "ユーザー: 晴れ", "また晴れた日", {'joy': 70})
+    assert similar_ids(user_id, first) == [second]
+    assert emotion_index.get_stats()['loads'] == loads # 通知で差分を反映したので読み直さない
+
+
+def test_index_sees_writes_from_other_processes(storage, monkeypatch):
+    user_id = make_user()
+    first = db.create_entry_and_emotions(user_id, "2024-05-01", "ユーザー: 晴れ", "晴れた日", {'joy': 80})
+    assert similar_ids(user_id, first) == []
+
+    # 別のプロセスでの書き込み: このプロセスには通知が届かない
+    monkeypatch.setattr(db, "_emotion_listeners", [])
+    second = db.create_entry_and_emotions(user_id, "2024-05-02", "ユーザー: 雨", "雨の日", {'sadness': 70})
+    assert similar_ids(user_id, first) == [second]
+    assert [hit['id'] for hit in emotion_index.find_entries_like(user_id, {'sadness': 70}, k=1)] == [second]
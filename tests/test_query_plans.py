@@ -0,0 +1,62 @@
+# tests/test_query_plans.py
+"""db.HOT_QUERIES の各クエリが想定したインデックスを使うことを、マイグレーション済みのDBで確認する"""
+import sqlite3
+
+import pytest
+
+import db
+import init_db
+
+# クエリ名 -> プランに現れるはずのインデックス (INTEGER PRIMARY KEY は rowid での検索)
+EXPECTED_INDEXES = {
+    'get_user_by_username': ["sqlite_autoindex_users_1"],
+    'get_entry_list_by_user': ["idx_entries_user_date"],
+    'get_entry_details': ["INTEGER PRIMARY KEY", "idx_emotions_entry_id"],
+    'get_emotions_by_user': ["idx_entries_user_date", "idx_emotions_entry_id"],
+    'get_emotion_vectors': ["idx_entries_user_date", "idx_emotions_entry_id"],
+    'get_unanalyzed_entries_by_user': ["idx_entries_analysis_pending"],
+    'get_emotion_series (raw)': ["idx_entries_user_date", "idx_emotions_entry_id"],
+    'get_emotion_series (month)': ["idx_entries_user_date", "idx_emotions_entry_id"],
+    'get_first_entry_date': ["idx_entries_user_date"],
+    'get_entry_page': ["idx_entries_user_date"],
+    'get_entry_months': ["idx_entries_user_date"],
+    'get_entry_brief': ["INTEGER PRIMARY KEY"],
+    'get_user_emotion_stats': ["INTEGER PRIMARY KEY"],
+    'get_emotion_data_version': ["INTEGER PRIMARY KEY"],
+    'user_emotion_stats (windows)': ["user_emotion_daily USING PRIMARY KEY"],
+    'get_chat_log': ["e USING INTEGER PRIMARY KEY", "l USING INTEGER PRIMARY KEY"],
+    'get_open_chat_session': ["idx_chat_sessions_open"],
+    'bulk_insert_entries (dedupe)': ["idx_entries_user_date"],
+    'get_emotion_rows_after': ["INTEGER PRIMARY KEY", "idx_emotions_entry_id"],
+    'iter_entries_for_export': ["INTEGER PRIMARY KEY", "idx_emotions_entry_id"],
+    'iter_chat_turns': ["chat_turns USING PRIMARY KEY"],
+    'search_entries': ["entries_fts VIRTUAL TABLE INDEX"],
+    'search_entries_short': ["idx_entries_user_date"],
+    'get_session': ["sessions USING PRIMARY KEY"],
+    'evict_expired_sessions': ["idx_sessions_expires_at"],
+}
+
+
+@pytest.fixture(scope="module")
+def migrated_conn():
+    conn = sqlite3.connect(":memory:")
+    init_db.apply_migrations(conn)
+    yield conn
+    conn.close()
+
+
+def test_every_hot_query_has_an_expected_index():
+    assert set(EXPECTED_INDEXES) == set(db.HOT_QUERIES)
+
+
+@pytest.mark.parametrize("name", list(db.HOT_QUERIES))
+def test_hot_query_uses_index(migrated_conn, name):
+    query, params = db.HOT_QUERIES[name]
+    plan = [row[3] for row in migrated_conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+    assert init_db.bad_plan_steps(plan) == [], plan
+    for index in EXPECTED_INDEXES[name]:
+        assert any(index in step for step in plan), plan
+
+
+def test_check_query_plans_reports_no_problems():
+    assert init_db.check_query_plans() == []
@@ -0,0 +1,215 @@
+# tests/test_storage.py
+"""ストレージの API (db.*) のテスト。storage フィクスチャで全てのバックエンドに同じシナリオを実行する"""
+import time
+from datetime import date
+
+import pytest
+
+import auth
+import db
+
+EMOTIONS = [
+    {'joy': 80, 'anger': 0, 'sadness': 10, 'anxiety': 20, 'relief': 60},
+    {'joy': 20, 'anger': 40, 'sadness': 50, 'anxiety': 70, 'relief': 10},
+    {'joy': 50, 'anger': 10, 'sadness': 30, 'anxiety': 40, 'relief': 50},
+]
+
+
+def make_user(username="alice"):
+    assert db.create_user(username, auth.hash_password("password123"))
+    return db.get_user_by_username(username)['id']
+
+
+def comparable_stats(stats):
+    """バックエンドによる型の違い (日付・数値) をならして比較する"""
+    return {k: (round(float(v), 6) if isinstance(v, (int, float)) else str(v)) for k, v in stats.items()
+            if v is not None and k not in ('updated_at', 'data_version')}
+
+
+def test_initialize_creates_testuser(storage):
+    import init_db
+    user = db.get_user_by_username("testuser")
+    assert user is not None
+    assert auth.verify_password("password123", user['password_hash'])
+    init_db.initialize_database() # 2回目は何もしない
+    assert db.get_user_by_username("testuser")['id'] == user['id']
+
+
+def test_create_user_rejects_duplicate(storage):
+    make_user("bob")
+    assert not db.create_user("bob", auth.hash_password("other"))
+
+
+def test_update_password_hash_is_compare_and_swap(storage):
+    user_id = make_user()
+    old_hash = db.get_user_by_username("alice")['password_hash']
+    assert db.update_password_hash(user_id, old_hash, "new-hash")
+    assert not db.update_password_hash(user_id, old_hash, "newer-hash")
+    assert db.get_user_by_username("alice")['password_hash'] == "new-hash"
+
+
+def test_emotion_stats_incremental_matches_rebuild(storage):
+    user_id = make_user()
+    db.create_entry_and_emotions(user_id, "2024-05-01", "ユーザー: 晴れ", "晴れた日", EMOTIONS[0])
+    db.create_entry_and_emotions(user_id, "2024-05-02", "ユーザー: 雨", "雨の日", EMOTIONS[1])
+    db.create_entry_and_emotions(user_id, "2024-04-28", "ユーザー: 前の日", "後から書いた日", EMOTIONS[2])
+    pending_id = db.create_pending_entry(user_id, "2024-05-03", "ユーザー: 未分析")
+    assert db.complete_entry_analysis(pending_id, "分析した日", EMOTIONS[0])
+
+    stats = db.get_user_emotion_stats(user_id)
+    assert stats['entry_count'] == 4
+    assert str(stats['first_entry_date']) == "2024-04-28"
+    assert str(stats['last_entry_date']) == "2024-05-03"
+    assert stats['streak_days'] == 3
+    assert stats['joy_mean'] == pytest.approx((80 + 20 + 50 + 80) / 4)
+
+    assert db.rebuild_emotion_stats([user_id]) == 1
+    assert comparable_stats(db.get_user_emotion_stats(user_id)) == comparable_stats(stats)
+
+
+def test_emotion_stats_windows_count_back_from_today(storage):
+    user_id = make_user()
+    for day, emotions in zip(("2024-05-01", "2024-05-02", "2024-05-03"), EMOTIONS):
+        db.create_entry_and_emotions(user_id, day, "ユーザー: 記録", "要約", emotions)
+
+    on_last_day = db.get_user_emotion_stats(user_id, today=date(2024, 5, 3))
+    assert (on_last_day['count_7d'], on_last_day['count_prev_7d']) == (3, 0)
+    assert on_last_day['joy_7d'] == pytest.approx(50)
+
+    # 書いていない日が続くと、直近7日から外れる
+    later = db.get_user_emotion_stats(user_id, today=date(2024, 5, 12))
+    assert (later['count_7d'], later['count_prev_7d'], later['count_30d']) == (0, 3, 3)
+    assert later['joy_7d'] is None
+    assert later['joy_prev_7d'] == pytest.approx(50)
+    assert db.get_user_emotion_stats(user_id, today=date(2024, 7, 1))['count_30d'] == 0
+
+
+def test_bulk_insert_entries_skips_duplicates(storage):
+    user_id = make_user()
+    records = [
+        {'user_id': user_id, 'entry_date': f"2024-06-{day:02d}", 'chat_log': f"ユーザー: {day}日目",
+         'summary': f"{day}日目の要約", 'emotions': EMOTIONS[day % 3]}
+        for day in range(1, 6)
+    ]
+    records.append({'user_id': user_id, 'entry_date': "2024-06-06", 'chat_log': "ユーザー: 未分析",
+                    'summary': None, 'emotions': None})
+    inserted, user_ids = db.bulk_insert_entries(records)
+    assert inserted == 6
+    assert user_ids == {user_id}
+    assert db.bulk_insert_entries(records) == (0, set()) # 再インポートしても重複しない
+
+    stats = db.get_user_emotion_stats(user_id)
+    assert stats['entry_count'] == 5 # 分析待ちは集計に含めない
+    assert stats['streak_days'] == 5
+    pending = db.get_unanalyzed_entries_by_user(user_id)
+    assert len(pending) == 1
+
+    exported = list(db.iter_entries_for_export(user_id))
+    assert [str(e['entry_date']) for e in exported] == [r['entry_date'] for r in records]
+    assert exported[0]['chat_log'] == "ユーザー: 1日目"
+    assert exported[-1]['emotions'] is None
+
+
+def test_chat_session_save_is_idempotent(storage):
+    user_id = make_user()
+    session_id = db.start_chat_session(user_id)
+    assert db.get_open_chat_session(user_id) == session_id
+    db.append_chat_turns(session_id, 0, [
+        {'role': 'user', 'parts': ["今日は散歩した"]},
+        {'role': 'model', 'parts': ["いいですね"]},
+        {'role': 'user', 'parts': ["届かなかった発言"]},
+    ])
+    db.truncate_chat_turns(session_id, 2)
+    db.append_chat_turns(session_id, 1, [{'role': 'model', 'parts': ["いいですね！"]}]) # 同じ seq は置き換える
+    assert db.get_chat_history(session_id) == [
+        {'role': 'user', 'parts': ["今日は散歩した"]},
+        {'role': 'model', 'parts': ["いいですね！"]},
+    ]
+
+    assert db.save_chat_session(session_id, user_id + 1000, "2024-07-01") is None # 他人のセッション
+    entry_id = db.save_chat_session(session_id, user_id, "2024-07-01")
+    assert entry_id is not None
+    assert db.save_chat_session(session_id, user_id, "2024-07-01") == entry_id
+    assert db.get_open_chat_session(user_id) is None
+    assert db.get_chat_history(session_id) == []
+
+    chat_log = db.get_chat_log(entry_id)
+    assert "今日は散歩した" in chat_log and "いいですね！" in chat_log
+    assert db.get_entry_for_analysis(entry_id)['analysis_status'] == db.ANALYSIS_PENDING
+    assert entry_id in db.get_pending_entry_ids()
+
+
+def test_entry_paging_months_and_search(storage):
+    user_id = make_user()
+    db.bulk_insert_entries([
+        {'user_id': user_id, 'entry_date': f"2024-{month:02d}-{day:02d}",
+         'chat_log': f"ユーザー: {'猫と遊んだ' if day == 2 else '普通の日'}", 'summary': f"{month}月{day}日",
+         'emotions': EMOTIONS[0]}
+        for month in (1, 2) for day in range(1, 4)
+    ])
+    assert db.get_entry_months(user_id) == [("2024-02", 3), ("2024-01", 3)]
+
+    page, cursor = db.get_entry_page(user_id, limit=4)
+    assert [str(e['entry_date']) for e in page] == ["2024-02-03", "2024-02-02", "2024-02-01", "2024-01-03"]
+    rest, cursor = db.get_entry_page(user_id, before=cursor, limit=4)
+    assert [str(e['entry_date']) for e in rest] == ["2024-01-02", "2024-01-01"]
+    assert cursor is None
+    january, _ = db.get_entry_page(user_id, month="2024-01")
+    assert len(january) == 3
+
+    hits = db.search_entries(user_id, "猫と遊")
+    assert sorted(str(hit['entry_date']) for hit in hits) == ["2024-01-02", "2024-02-02"]
+    assert db.search_entries(user_id, "猫") and db.search_entries(user_id, "犬") == []
+    details = db.get_entry_details(hits[0]['id'])
+    assert details['joy'] == 80
+
+
+def test_sessions(storage):
+    user_id = make_user()
+    now = time.time()
+    assert db.create_session("a" * 64, user_id, "alice", now + 60)
+    assert db.create_session("b" * 64, user_id, "alice", now - 1)
+    assert db.get_session("a" * 64)['username'] == "alice"
+    assert db.touch_session("a" * 64, now + 120)
+    assert db.get_session("a" * 64)['expires_at'] == pytest.approx(now + 120)
+    assert db.evict_expired_sessions(now) == 1
+    db.delete_session("a" * 64)
+    assert db.get_session("a" * 64) is None
+    assert not db.touch_session("a" * 64, now + 120)
+
+
+def test_response_cache(storage):
+    assert db.get_cached_response("key", 60) is None
+    assert db.put_cached_response("key", "chat", '{"text": "こんにちは"}')
+    assert db.get_cached_response("key", 60) == '{"text": "こんにちは"}'
+    assert db.get_cached_response("key", -1) is None # 期限切れ
+
+
+def test_backend_implements_protocol(storage):
+    backend = db.get_backend()
+    assert isinstance(backend, db.StorageBackend)
+    assert backend.name == db.BACKEND == storage.split('-')[0]
+    with pytest.raises(TypeError):
+        db.use_backend(object())
+
+
+def test_get_or_create_secret_keeps_first_value(storage):
+    assert db.get_or_create_secret("session_secret", "first") == "first"
+    assert db.get_or_create_secret("session_secret", "second") == "first"
+
+
+def test_emotion_data_version_changes_on_every_write(storage):
+    user_id = make_user()
+    assert db.get_emotion_data_version(user_id) == 0
+    versions = []
+    db.create_entry_and_emotions(user_id, "2024-05-01", "ユーザー: 晴れ", "晴れた日", EMOTIONS[0])
+    versions.append(db.get_emotion_data_version(user_id))
+    db.bulk_insert_entries([{'user_id': user_id, 'entry_date': "2024-05-02", 'chat_log': "ユーザー: 雨",
+                             'summary': "雨の日", 'emotions': EMOTIONS[1]}])
+    versions.append(db.get_emotion_data_version(user_id))
+    pending_id = db.create_pending_entry(user_id, "2024-05-03", "ユーザー: 未分析")
+    db.complete_entry_analysis(pending_id, "分析した日", EMOTIONS[2])
+    versions.append(db.get_emotion_data_version(user_id))
+    db.rebuild_emotion_stats([user_id]) # 作り直しても巻き戻らない
+    versions.append(db.get_emotion_data_version(user_id))
+    assert versions == sorted(set(versions)) and versions[0] > 0
@@ -0,0 +1,327 @@
+# tracing.py
+"""
+処理時間の計測 (スパン・カウンター) とログ出力の設定。
+
+- span(name) / @traced(): 区間の所要時間を名前ごとに集計し、DEBUG ログ (遅いものは INFO) に出す
+- incr(name): 回数などのカウンター
+- snapshot() / to_json() / to_prometheus(): 集計結果 (p50/p95、回数、送受信バイト数) の出力
+- profile(): 1回の rerun を cProfile で計測し、重い関数の一覧をログに出す (TRACE_PROFILE=1 のときだけ)
+- setup_logging(): ログを QueueHandler 経由で別スレッドから出力する (呼び出し側は書き込みを待たない)
+"""
+import atexit
+import cProfile
+import functools
+import inspect
+import io
+import json
+import logging
+import logging.handlers
+import math
+import os
+import pstats
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# --- 設定 ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text") # "json" で1行1 JSON のログにする
+SLOW_SPAN_MS = float(os.getenv("TRACE_SLOW_MS", "500")) # これより遅い区間は INFO で出す
+PROFILE_RERUNS = os.getenv("TRACE_PROFILE", "0") == "1" # rerun ごとに cProfile で計測する
+PROFILE_TOP = 25 # プロファイル結果として出す関数の数
+SNAPSHOT_PATH = os.getenv("TRACE_SNAPSHOT_PATH") # 指定すると集計結果を Prometheus のテキスト形式で書き出す
+SNAPSHOT_INTERVAL = 10.0 # 集計結果を書き出す最短の間隔 (秒)
+SAMPLE_SIZE = 1024 # パーセンタイルの計算に使う直近の所要時間の数 (区間の名前ごと)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_spans = {} # 区間の名前 -> _SpanStats
+_counters = {} # カウンターの名前 -> 値
+_profile_lock = threading.Lock() # cProfile は同時に1つしか有効にできない
+_last_snapshot_write = 0.0
+_listener = None
+
+
+class _SpanStats:
+    __slots__ = ('count', 'errors', 'total', 'max', 'bytes_sent', 'bytes_received', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+
+class Span:
+    """
+    1つの区間の計測。with で使い、抜けたときに所要時間を集計してログに出す。
+    例外で抜けた場合もエラーとして数える (例外はそのまま伝わる)。
+    """
+
+    def __init__(self, name, level=logging.DEBUG, **attrs):
+        self.name = name
+        self.level = level
+        self.attrs = attrs
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.duration = None
+        self._started = None
+
+    def set(self, **attrs):
+        """ログに出す属性を追加する"""
+        self.attrs.update(attrs)
+
+    def add_bytes(self, sent=0, received=0):
+        self.bytes_sent += sent
+        self.bytes_received += received
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._started
+        # st.stop() / st.rerun() などの制御用の例外 (Exception ではない) は失敗として数えない
+        failed = exc_type is not None and issubclass(exc_type, Exception)
+        _record(self, failed)
+        if failed:
+            self.attrs['error'] = exc_type.__name__
+        duration_ms = self.duration * 1000
+        level = logging.INFO if duration_ms >= SLOW_SPAN_MS and self.level < logging.INFO else self.level
+        if logger.isEnabledFor(level):
+            fields = {'span': self.name, 'duration_ms': round(duration_ms, 2), 'status': 'error' if failed else 'ok'}
+            if self.bytes_sent or self.bytes_received:
+                fields.update(bytes_sent=self.bytes_sent, bytes_received=self.bytes_received)
+            fields.update(self.attrs)
+            logger.log(level, " ".join(f"{key}={value}" for key, value in fields.items()), extra={'fields': fields})
+        return False
+
+
+def _record(span, failed):
+    with _lock:
+        stats = _spans.get(span.name)
+        if stats is None:
+            stats = _spans[span.name] = _SpanStats()
+        stats.count += 1
+        stats.errors += failed
+        stats.total += span.duration
+        stats.max = max(stats.max, span.duration)
+        stats.bytes_sent += span.bytes_sent
+        stats.bytes_received += span.bytes_received
+        stats.samples.append(span.duration)
+
+
+def span(name, level=logging.DEBUG, **attrs):
+    """区間の所要時間を計測する。with tracing.span('db.get_entry_page', user_id=1): ..."""
+    return Span(name, level, **attrs)
+
+
+def traced(name=None):
+    """
+    関数の呼び出しを1つの区間として計測するデコレーター。
+    名前を省略した場合は「モジュール名.関数名」(例: db.get_entry_page) にする。async 関数にも使える。
+    """
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__qualname__}"
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with Span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def incr(name, amount=1):
+    """カウンターを増やす"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def payload_bytes(contents):
+    """Gemini に送る内容 (文字列、またはチャット履歴) の UTF-8 でのバイト数"""
+    if isinstance(contents, str):
+        return len(contents.encode('utf-8'))
+    return sum(len(str(part).encode('utf-8')) for message in contents for part in message.get('parts', []))
+
+
+def _percentile(sorted_values, pct):
+    """昇順ソート済みのリストから pct パーセンタイル (最近傍法) を返す"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(1, math.ceil(pct / 100 * len(sorted_values))) - 1]
+
+
+def snapshot():
+    """区間ごとの回数・エラー数・所要時間 (ms、p50/p95 は直近 SAMPLE_SIZE 件から) と、カウンターの値を返す"""
+    with _lock:
+        spans = {name: (stats.count, stats.errors, stats.total, stats.max, stats.bytes_sent,
+                        stats.bytes_received, sorted(stats.samples))
+                 for name, stats in _spans.items()}
+        counters = dict(_counters)
+    result = {}
+    for name, (count, errors, total, longest, sent, received, samples) in sorted(spans.items()):
+        result[name] = {
+            'count': count,
+            'errors': errors,
+            'total_ms': total * 1000,
+            'mean_ms': total / count * 1000 if count else 0.0,
+            'p50_ms': _percentile(samples, 50) * 1000,
+            'p95_ms': _percentile(samples, 95) * 1000,
+            'max_ms': longest * 1000,
+            'bytes_sent': sent,
+            'bytes_received': received,
+        }
+    return {'spans': result, 'counters': dict(sorted(counters.items()))}
+
+
+def to_json(indent=None):
+    return json.dumps(snapshot(), ensure_ascii=False, indent=indent)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def to_prometheus(prefix="aidiary"):
+    """集計結果を Prometheus のテキスト形式で返す (node_exporter の textfile collector などで読み込める)"""
+    snap = snapshot()
+    metrics = [
+        ('span_calls_total', 'counter', '区間の実行回数', 'count', 1),
+        ('span_errors_total', 'counter', '例外で終わった区間の数', 'errors', 1),
+        ('span_duration_seconds_sum', 'counter', '区間の所要時間の合計', 'total_ms', 0.001),
+        ('span_duration_p50_seconds', 'gauge', '区間の所要時間の p50 (直近)', 'p50_ms', 0.001),
+        ('span_duration_p95_seconds', 'gauge', '区間の所要時間の p95 (直近)', 'p95_ms', 0.001),
+        ('span_bytes_sent_total', 'counter', '区間で送信したバイト数', 'bytes_sent', 1),
+        ('span_bytes_received_total', 'counter', '区間で受信したバイト数', 'bytes_received', 1),
+    ]
+    lines = []
+    for metric, kind, help_text, key, scale in metrics:
+        lines.append(f"# HELP {prefix}_{metric} {help_text}")
+        lines.append(f"# TYPE {prefix}_{metric} {kind}")
+        for name, stats in snap['spans'].items():
+            lines.append(f'{prefix}_{metric}{{span="{_label(name)}"}} {stats[key] * scale:g}')
+    lines.append(f"# HELP {prefix}_counter カウンター")
+    lines.append(f"# TYPE {prefix}_counter counter")
+    for name, value in snap['counters'].items():
+        lines.append(f'{prefix}_counter{{name="{_label(name)}"}} {value:g}')
+    return "\n".join(lines) + "\n"
+
+
+def write_snapshot(path=None, force=False):
+    """
+    集計結果を Prometheus のテキスト形式でファイルに書き出す (SNAPSHOT_INTERVAL 秒に1回まで)。
+    path を省略した場合は TRACE_SNAPSHOT_PATH。どちらもなければ何もしない。
+    """
+    global _last_snapshot_write
+    path = path or SNAPSHOT_PATH
+    if not path:
+        return
+    now = time.monotonic()
+    with _lock:
+        if not force and now - _last_snapshot_write < SNAPSHOT_INTERVAL:
+            return
+        _last_snapshot_write = now
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(to_prometheus())
+        os.replace(tmp_path, path) # 読み込み途中のファイルを見せない
+    except OSError as e:
+        logger.warning("計測結果の書き出しに失敗しました (%s): %s", path, e)
+
+
+def reset():
+    """集計結果を消す (ベンチマークや検証用)"""
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+@contextmanager
+def profile(label, enabled=None):
+    """
+    with の中の処理を cProfile で計測し、累積時間の長い関数をログに出す。
+    enabled を省略した場合は TRACE_PROFILE=1 のときだけ計測する。
+    他のスレッドで計測中の場合は (cProfile を同時に使えないため) 計測しない。
+    """
+    enabled = PROFILE_RERUNS if enabled is None else enabled
+    if not enabled or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        logger.info("プロファイル (%s):\n%s", label, out.getvalue())
+    finally:
+        _profile_lock.release()
+
+
+@contextmanager
+def rerun(name='app.rerun', **attrs):
+    """
+    Streamlit の1回の rerun 全体を計測する (INFO で出す)。TRACE_PROFILE=1 なら cProfile も取る。
+    st.stop() / st.rerun() で抜けた場合も計測し、最後に集計結果を書き出す (TRACE_SNAPSHOT_PATH 指定時)。
+    """
+    try:
+        with profile(name), Span(name, logging.INFO, **attrs):
+            yield
+    finally:
+        write_snapshot()
+
+
+class JsonFormatter(logging.Formatter):
+    """ログを1行1 JSON で出す。区間のログは計測値 (fields) もキーとして含める。"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=None, fmt=None):
+    """
+    ルートロガーにキュー経由のハンドラーを設定する (2回目以降は何もしない)。
+    ログを出すスレッドはキューに入れるだけで、標準エラー出力への書き込みは別スレッドが行う。
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        handler = logging.StreamHandler()
+        if (fmt or LOG_FORMAT) == 'json':
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        log_queue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+        _listener.start()
+        root = logging.getLogger()
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        root.setLevel(level or LOG_LEVEL)
+    atexit.register(_listener.stop)